@@ -95,3 +95,33 @@ class TrainCfg:
     # Include the early_stopping configuration as a nested attribute
     earlystopping: EarlyStopping = field(default_factory=EarlyStopping)
     net_batch_size: int = field(default=100, metadata={"help": "Batch size of regression network."})
+    batch_schedule: str = field(
+        default="fixed",
+        metadata={
+            "help": "'fixed' tests batch_size samples per sequence, 'adaptive' sizes the next test batch from the "
+            "wealth and the validation loss (between min_batch_size and max_batch_size).",
+            "omit_default": True,
+        },
+    )
+    min_batch_size: int = field(
+        default=20, metadata={"help": "Smallest test batch of the adaptive schedule.", "omit_default": True}
+    )
+    max_batch_size: int = field(
+        default=400, metadata={"help": "Largest test batch of the adaptive schedule.", "omit_default": True}
+    )
+    futility_patience: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Stop a fold for futility once, for this many sequences in a row, the growth of the log-wealth "
+            "estimated from the validation loss would not reach 1 / alpha with the remaining samples of the fold. "
+            "None disables futility stopping.",
+            "omit_default": True,
+        },
+    )
+    wandb_log_interval: int = field(
+        default=1,
+        metadata={
+            "help": "Log every n-th epoch to wandb (with the mean of the epochs in between); 1 logs every epoch.",
+            "affects_results": False,
+        },
+    )
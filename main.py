@@ -11,7 +11,6 @@ from typing import Optional, Dict, List
 from arguments import TrainCfg
 
 # from logging_config import setup_logging
-from src.utils.utils import load_config
 
 os.environ["PYDEVD_DISABLE_FILE_VALIDATION"] = "1"
 
@@ -32,6 +31,50 @@ def main(cfg: DictConfig):
     # Convert configuration to a dictionary if needed
     # cfg_dict = OmegaConf.to_container(cfg, resolve=True)
 
+    # Record spans of all stages, including those of worker processes, and export them when the run ends
+    tracing_cfg = cfg.get("tracing") or {}
+    trace_dir = None
+    if tracing_cfg.get("enabled", False):
+        from src.utils.tracing import enable_tracing
+        from src.utils.utils import create_run_string
+
+        trace_dir = tracing_cfg.get("trace_dir") or Path(cfg.dir_prefix) / "traces" / create_run_string()
+        enable_tracing(Path(__file__).resolve().parent / trace_dir)
+
+    # Flush throughput metrics periodically, so that stalls can be spotted while the run is going
+    metrics_cfg = cfg.get("metrics") or {}
+    if metrics_cfg.get("enabled", False):
+        from src.utils.metrics import enable_metrics
+        from src.utils.utils import create_run_string
+
+        metrics_dir = metrics_cfg.get("metrics_dir") or Path(cfg.dir_prefix) / "metrics" / create_run_string()
+        enable_metrics(
+            Path(__file__).resolve().parent / metrics_dir,
+            interval_s=metrics_cfg.get("interval_s", 30),
+            formats=list(metrics_cfg.get("formats") or []),
+            use_wandb=metrics_cfg.get("use_wandb", False),
+        )
+
+    try:
+        run_experiment(cfg)
+    finally:
+        if trace_dir is not None:
+            from src.utils.tracing import finish_tracing
+
+            finish_tracing()
+        if metrics_cfg.get("enabled", False):
+            from src.utils.metrics import disable_metrics
+
+            disable_metrics()
+
+
+def get_train_cfg(cfg: DictConfig) -> TrainCfg:
+    """TrainCfg with the overrides of the train_cfg section of the experiment config, e.g. futility_patience."""
+    overrides = cfg.get("train_cfg")
+    return TrainCfg(**OmegaConf.to_container(overrides, resolve=True)) if overrides else TrainCfg()
+
+
+def run_experiment(cfg: DictConfig):
     # Determine which experiment to run based on cfg.exp
     if cfg.exp == "generation":
         # Instantiate and run the GenerationExperiment
@@ -44,10 +87,48 @@ def main(cfg: DictConfig):
         # Instantiate and run the appropriate TestExperiment
         from src.test.experiments import TestExperiment
 
-        train_cfg = TrainCfg()
+        train_cfg = get_train_cfg(cfg)
         experiment = TestExperiment(cfg, train_cfg)
         experiment.run()
 
+    elif cfg.exp == "sweep":
+        # Run a whole grid of tests (model pairs, fold sizes, noise values) in one pool of worker processes
+        from src.test.experiments import SweepExperiment
+
+        train_cfg = get_train_cfg(cfg)
+        experiment = SweepExperiment(cfg, train_cfg)
+        experiment.run()
+
+    elif cfg.exp == "pipeline":
+        # Recompute only the stale artifacts from generations to distance plots, or show them with pipeline.dry_run
+        from src.test.experiments import PipelineExperiment
+
+        train_cfg = get_train_cfg(cfg)
+        experiment = PipelineExperiment(cfg, train_cfg)
+        experiment.run()
+
+    elif cfg.exp == "power_simulation":
+        # Predict power and samples to rejection for a grid of fold and batch sizes without running the test
+        from src.test.experiments import PowerSimulationExperiment
+
+        train_cfg = get_train_cfg(cfg)
+        experiment = PowerSimulationExperiment(cfg, train_cfg)
+        experiment.run()
+
+    elif cfg.exp == "null_calibration":
+        # Estimate the type-I error of the test from the scores of single models, without a second generation seed
+        from src.test.experiments import NullCalibrationExperiment
+
+        train_cfg = get_train_cfg(cfg)
+        experiment = NullCalibrationExperiment(cfg, train_cfg)
+        experiment.run()
+
+    elif cfg.exp == "model_server":
+        # Start the resident generation service that keeps models loaded between generation runs
+        from src.evaluation.model_server import serve
+
+        serve(OmegaConf.to_container(cfg, resolve=True))
+
 
 if __name__ == "__main__":
     main()
@@ -20,10 +20,24 @@ project_root = Path(__file__).resolve().parents[2]
 if str(project_root) not in sys.path:
     sys.path.append(str(project_root))
 
+from src.analysis.bootstrap import bootstrap_distances
 from src.analysis.distance import (
     empirical_wasserstein_distance_p1,
+    TRAINING_FREE_DISTANCES,
     NeuralNetDistance,
+    BatchedNeuralNetDistance,
 )
+from src.analysis.distance_cache import DistanceCache
+from src.analysis.distance_jobs import DistanceJob, run_distance_jobs
+from src.analysis.resampling import ResamplingPlan
+from src.analysis.results_store import (
+    ResultsStore,
+    adaptive_power_curve,
+    get_results_store,
+    is_adaptive_schedule,
+    summarize_folds,
+)
+from src.analysis.sketch import load_score_sketch
 from src.utils.utils import load_config
 from arguments import TrainCfg
 
@@ -51,7 +65,9 @@ def extract_data_for_models(
     dir_prefix: Optional[str] = None,
     noise: float = 0,
     extract_stats: bool = False,
+    schedule: str = "",
 ):
+    """schedule is the suffix of runs with a non-default batch schedule, see get_schedule_suffix."""
     assert model_name2 or (
         checkpoint and checkpoint_base_name
     ), "Either model_name2 or checkpoint and checkpoint_base_name must be provided"
@@ -62,6 +78,7 @@ def extract_data_for_models(
 
     continuation_str = "_continuations" if only_continuations else ""
     noise_string = f"_noise_{noise}" if noise > 0 else ""
+    run_string = f"{noise_string}{schedule}"
 
     if model_name2:
         base_path = f"{test_dir}/{model_name1}_{seed1}_{model_name2}_{seed2}"
@@ -69,13 +86,13 @@ def extract_data_for_models(
         base_path = f"{test_dir}/{model_name1}_{seed1}_{checkpoint_base_name}{checkpoint}_{seed2}"
 
     if fold_size == 4000:
-        file_path = f"{base_path}/kfold_test_results{continuation_str}_epsilon_{epsilon}{noise_string}.csv"
+        file_path = f"{base_path}/kfold_test_results{continuation_str}_epsilon_{epsilon}{run_string}.csv"
         if not Path(file_path).exists():
             file_path = (
-                f"{base_path}/kfold_test_results{continuation_str}_{fold_size}_epsilon_{epsilon}{noise_string}.csv"
+                f"{base_path}/kfold_test_results{continuation_str}_{fold_size}_epsilon_{epsilon}{run_string}.csv"
             )
     else:
-        file_path = f"{base_path}/kfold_test_results{continuation_str}_{fold_size}_epsilon_{epsilon}{noise_string}.csv"
+        file_path = f"{base_path}/kfold_test_results{continuation_str}_{fold_size}_epsilon_{epsilon}{run_string}.csv"
 
     if not Path(file_path).exists():
         raise FileNotFoundError(f"File not found: {file_path}")
@@ -87,7 +104,7 @@ def extract_data_for_models(
     logger.info(f"Number of folds: {data['fold_number'].max()}")
 
     if extract_stats:
-        file_path = f"{base_path}/kfold_test_stats{continuation_str}_{fold_size}_epsilon_{epsilon}{noise_string}.csv"
+        file_path = f"{base_path}/kfold_test_stats{continuation_str}_{fold_size}_epsilon_{epsilon}{run_string}.csv"
         df = pd.read_csv(file_path)
 
         # Group by fold_number
@@ -122,9 +139,28 @@ def extract_data_for_models(
     return data
 
 
-def get_power_over_sequences_from_whole_ds(data: pd.DataFrame, fold_size: int = 4000):
-    """ """
+def get_power_over_sequences_from_whole_ds(
+    data: pd.DataFrame, fold_size: int = 4000, keep_all_data: bool = False, adaptive: bool = False
+):
+    """
+    Fraction of folds whose test has stopped by each sequence.
+
+    A fold counts as stopped at a sequence if it has no entry for that sequence (the test ended earlier) or if the
+    sequence is the one at which the experiment ended. Folds that stopped for futility (see OfflineTrainer.is_futile)
+    did not reject, so they count as running until the end. Instead of looking up every (fold, sequence) pair, the
+    sequences at which a fold was still running are counted with one histogram over all folds.
+
+    Args:
+        data: test results of all folds, see extract_data_for_models
+        fold_size: number of samples per fold
+        keep_all_data: whether to also return the number of folds that stopped exactly at each sequence ("Stopped")
+            and the number of folds ("Num Folds")
+        adaptive: whether the run used the adaptive batch schedule; its power is computed over the scored samples
+            instead of the sequences, see adaptive_power_curve
+    """
     bs = data.loc[0, "samples"]
+    if adaptive:
+        return adaptive_power_curve(summarize_folds(data), fold_size, bs, keep_all_data=keep_all_data)
 
     max_sequences = (fold_size + bs - 1) // bs
     selected_columns = data[
@@ -135,43 +171,43 @@ def get_power_over_sequences_from_whole_ds(data: pd.DataFrame, fold_size: int =
             "sequences_until_end_of_experiment",  # TODO: can remove this later, just a sanity check!
             "test_positive",
         ]
+        + (["futility_stop"] if "futility_stop" in data.columns else [])
     ]
 
     filtered_df = selected_columns.drop_duplicates(subset=["sequence", "fold_number"])
 
     num_folds = filtered_df["fold_number"].nunique()
-    # Set 'sequence' as the index of the DataFrame
-    indexed_df = filtered_df.set_index("sequence")
+    num_fold_entries = len(filtered_df["fold_number"].unique())
 
-    unique_fold_numbers = indexed_df["fold_number"].unique()
+    sequences = filtered_df["sequence"].to_numpy()
+    in_range = filtered_df["fold_number"].notna().to_numpy() & (sequences >= 0) & (sequences < max_sequences)
+    is_end = (filtered_df["sequences_until_end_of_experiment"].to_numpy() == sequences) & in_range
 
-    # Initialize a dictionary to store the counts
-    sequence_counts = {sequence: 0 for sequence in range(max_sequences)}
+    for sequence in sequences[is_end & (filtered_df["test_positive"].to_numpy() != 1)]:
+        logger.error(f"Current sequence {sequence} == sequence until end of experiment, but test is not positive")
 
-    # Iterate over each fold number
-    for fold in unique_fold_numbers:
-        fold_data = indexed_df[indexed_df["fold_number"] == fold]
+    # number of folds that are still running at each sequence
+    running = np.bincount(sequences[in_range & ~is_end].astype(int), minlength=max_sequences)
 
-        for sequence in range(max_sequences):  # sequence_counts.keys()
-            if sequence in fold_data.index and fold_data.loc[sequence, "sequences_until_end_of_experiment"] == sequence:
-                try:
-                    assert (
-                        fold_data.loc[sequence, "test_positive"] == 1
-                    ), f"Current sequence {sequence} == sequence until end of experiment, but test is not positive"
-                except AssertionError as e:
-                    logger.error(e)
-                sequence_counts[sequence] += 1
+    if "futility_stop" in filtered_df.columns:
+        futile_df = filtered_df[filtered_df["futility_stop"] == 1]
+        last_sequences = futile_df.groupby("fold_number")["sequence"].max().to_numpy().astype(int)
+        ends = np.bincount(np.clip(last_sequences + 1, 0, max_sequences), minlength=max_sequences + 1)
+        running = running + np.cumsum(ends)[:max_sequences]
 
-            elif sequence not in fold_data.index:
-                sequence_counts[sequence] += 1
-
-    # Convert the result to a DataFrame for better visualization
-    result_df = pd.DataFrame(list(sequence_counts.items()), columns=["Sequence", "Count"])
+    result_df = pd.DataFrame(
+        {
+            "Sequence": np.arange(max_sequences),
+            "Count": num_fold_entries - running,
+        }
+    )
     result_df["Power"] = result_df["Count"] / num_folds
     result_df["Samples per Test"] = fold_size
     result_df["Samples"] = result_df["Sequence"] * bs
 
-    result_df.reset_index()
+    if keep_all_data:
+        result_df["Stopped"] = np.bincount(sequences[is_end].astype(int), minlength=max_sequences)
+        result_df["Num Folds"] = num_folds
 
     return result_df
 
@@ -191,47 +227,81 @@ def get_power_over_sequences_for_models_or_checkpoints(
     dir_prefix: Optional[str] = None,
     metric="perspective",
     noise: float = 0,
+    keep_all_data: bool = False,
+    use_results_store: bool = True,
+    schedule: str = "",
 ):
-    """ """
+    """
+    Power over sequences of a test run. If use_results_store, the power curve is computed from the per-fold results
+    in the ResultsStore; runs that are not in the store yet are read from their csv file once and added to it.
+    schedule selects runs with a non-default batch schedule, see get_schedule_suffix.
+    """
     assert model_name2 or (
         checkpoint and checkpoint_base_name
     ), "Either model_name2 or checkpoint and checkpoint_base_name must be provided"
 
+    store = get_results_store(dir_prefix, test_dir, metric) if use_results_store else None
+    store_key = ResultsStore.make_key(
+        metric,
+        model_name1,
+        seed1,
+        model_name2 if model_name2 else f"{checkpoint_base_name}{checkpoint}",
+        seed2,
+        fold_size,
+        epsilon=epsilon,
+        noise=noise,
+        only_continuations=only_continuations,
+        schedule=schedule,
+    )
+    result_df = store.get_power_curve(store_key, keep_all_data=keep_all_data) if store is not None else None
+
     if model_name2:
-        data = extract_data_for_models(
-            model_name1,
-            seed1,
-            seed2,
-            model_name2=model_name2,
-            epsilon=epsilon,
-            only_continuations=only_continuations,
-            fold_size=fold_size,
-            test_dir=test_dir,
-            dir_prefix=dir_prefix,
-            metric=metric,
-            noise=noise,
-        )
-        result_df = get_power_over_sequences_from_whole_ds(data, fold_size=fold_size, keep_all_data=keep_all_data)
+        if result_df is None:
+            data = extract_data_for_models(
+                model_name1,
+                seed1,
+                seed2,
+                model_name2=model_name2,
+                epsilon=epsilon,
+                only_continuations=only_continuations,
+                fold_size=fold_size,
+                test_dir=test_dir,
+                dir_prefix=dir_prefix,
+                metric=metric,
+                noise=noise,
+                schedule=schedule,
+            )
+            result_df = get_power_over_sequences_from_whole_ds(
+                data, fold_size=fold_size, keep_all_data=keep_all_data, adaptive=is_adaptive_schedule(schedule)
+            )
+            if store is not None:
+                store.add_run(store_key, data)
         result_df["model_name1"] = model_name1
         result_df["seed1"] = seed1
         result_df["model_name2"] = model_name2
         result_df["seed2"] = seed2
         result_df["epsilon"] = epsilon
     else:
-        data = extract_data_for_models(
-            model_name1,
-            seed1,
-            seed2,
-            checkpoint=checkpoint,
-            checkpoint_base_name=checkpoint_base_name,
-            fold_size=fold_size,
-            only_continuations=only_continuations,
-            epsilon=epsilon,
-            test_dir=test_dir,
-            dir_prefix=dir_prefix,
-            noise=noise,
-        )
-        result_df = get_power_over_sequences_from_whole_ds(data, fold_size, keep_all_data=keep_all_data)
+        if result_df is None:
+            data = extract_data_for_models(
+                model_name1,
+                seed1,
+                seed2,
+                checkpoint=checkpoint,
+                checkpoint_base_name=checkpoint_base_name,
+                fold_size=fold_size,
+                only_continuations=only_continuations,
+                epsilon=epsilon,
+                test_dir=test_dir,
+                dir_prefix=dir_prefix,
+                noise=noise,
+                schedule=schedule,
+            )
+            result_df = get_power_over_sequences_from_whole_ds(
+                data, fold_size, keep_all_data=keep_all_data, adaptive=is_adaptive_schedule(schedule)
+            )
+            if store is not None:
+                store.add_run(store_key, data)
         result_df["Checkpoint"] = checkpoint
         result_df["epsilon"] = epsilon
 
@@ -399,6 +469,26 @@ def get_power_over_sequences(
     return final_df
 
 
+def get_distance_file_name(num_train_samples: Union[int, List[int]], num_runs: int, noise: float = 0) -> str:
+    """
+    Name of the csv file with the distance scores of a model pair. If several training set sizes are used, the file
+    is named after the largest one.
+    """
+    if isinstance(num_train_samples, list):
+        num_train_samples = max(num_train_samples)
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+    return f"distance_scores_{num_train_samples}_{num_runs}{noise_string}.csv"
+
+
+def save_distance_scores(dist_df: pd.DataFrame, dist_path: Path, overwrite: bool = False):
+    """ """
+    dist_path.parent.mkdir(parents=True, exist_ok=True)
+    if not dist_path.exists() or overwrite:
+        dist_df.to_csv(dist_path, index=False)
+    else:
+        logger.info(f"File {dist_path} already exists. Use overwrite=True to overwrite it.")
+
+
 def get_distance_scores(
     model_name1: str,
     seed1: int,
@@ -426,9 +516,26 @@ def get_distance_scores(
     save: bool = False,
     overwrite: bool = False,
     noise: float = 0,
+    batch_runs: bool = True,
+    use_cache: bool = True,
+    only_from_cache: bool = False,
     **kwargs,
 ) -> pd.DataFrame:
-    """ """
+    """
+    Computes the distance between the score distributions of two models for num_runs random train/test splits and
+    each training set size in num_samples.
+
+    If batch_runs, the neural net distance of all runs and training set sizes is trained at once with
+    BatchedNeuralNetDistance instead of one NeuralNetDistance after the other.
+
+    Besides "NeuralNet" and "Wasserstein", distance_measures can contain the training-free measures in
+    TRAINING_FREE_DISTANCES ("MMD" for the block MMD, "Energy" for the energy distance). They are computed on the test
+    set of every run and on the full data ("MMD_full", "Energy_full").
+
+    If use_cache, results are stored in a DistanceCache under {dir_prefix}/{test_dir}/distance_cache, keyed by the
+    contents of the score file and all parameters that influence the distances, and reused unless overwrite is set.
+    With only_from_cache, None is returned instead of computing distances that are not in the cache.
+    """
     np.random.seed(random_seed)
     random.seed(random_seed)
     if not (checkpoint and checkpoint_base_name) and not model_name2:
@@ -449,6 +556,41 @@ def get_distance_scores(
     if not isinstance(num_samples, list):
         num_samples = [num_samples]
 
+    cache = DistanceCache(SCRIPT_DIR / dir_prefix / test_dir / "distance_cache") if use_cache else None
+    # everything that influences the distances, apart from the scores themselves
+    cache_config = {
+        "metric": metric,
+        "distance_measures": distance_measures,
+        "net_cfg": net_cfg,
+        "train_cfg": train_cfg,
+        "pre_shuffle": pre_shuffle,
+        "random_seed": random_seed,
+        "num_samples": num_samples,
+        "num_test_samples": num_test_samples,
+        "test_split": test_split,
+        "evaluate_wasserstein_on_full": evaluate_wasserstein_on_full,
+        "evaluate_nn_on_full": evaluate_nn_on_full,
+        "compare_wasserstein": compare_wasserstein,
+        "num_runs": num_runs,
+        "use_scipy_wasserstein": use_scipy_wasserstein,
+        "batch_runs": batch_runs,
+    }
+    cache_key = None
+
+    if cache is not None and score_path.exists():
+        cache_key = cache.make_key(score_path, cache_config)
+        cached_df = None if overwrite else cache.get(cache_key)
+        if cached_df is not None:
+            logger.info(f"Loaded distance scores for {score_path} from cache entry {cache_key}.")
+            if save:
+                save_distance_scores(
+                    cached_df, score_dir / get_distance_file_name(num_samples, num_runs, noise), overwrite=overwrite
+                )
+            return cached_df
+
+    if only_from_cache:
+        return None
+
     try:
         with open(score_path, "r") as f:
             data = json.load(f)
@@ -460,25 +602,31 @@ def get_distance_scores(
 
         dist_data = []
 
+        full_dist_dict = {"num_samples": len(scores1)}
         if evaluate_wasserstein_on_full:
             if "Wasserstein" in distance_measures:
-                wasserstein_dist_dict = {"num_samples": len(scores1)}
                 if use_scipy_wasserstein:
-                    wasserstein_dist_dict["Wasserstein_full"] = wasserstein_distance(scores1, scores2)
+                    full_dist_dict["Wasserstein_full"] = wasserstein_distance(scores1, scores2)
                 else:
-                    wasserstein_dist_dict["Wasserstein_full"] = empirical_wasserstein_distance_p1(scores1, scores2)
+                    full_dist_dict["Wasserstein_full"] = empirical_wasserstein_distance_p1(scores1, scores2)
+        # the training-free measures are cheap enough to always evaluate them on the full data as well
+        for measure, distance_func in TRAINING_FREE_DISTANCES.items():
+            if measure in distance_measures:
+                full_dist_dict[f"{measure}_full"] = distance_func(scores1, scores2)
         if evaluate_nn_on_full:
             if "NeuralNet" in distance_measures:
                 assert net_cfg, "net_dict must be provided for neuralnet distance"
                 assert train_cfg, "train_cfg must be provided for neuralnet distance"
 
-                shuffled_scores1, shuffled_scores2 = shuffle(scores1, scores2, random_state=random_seed)
+                shuffled_scores1, shuffled_scores2 = shuffle(
+                    np.asarray(scores1, dtype=float), np.asarray(scores2, dtype=float), random_state=random_seed
+                )
 
                 kf = KFold(n_splits=num_runs, shuffle=False)
 
                 for train_index, _ in kf.split(shuffled_scores1):
-                    fold_scores1 = [shuffled_scores1[i] for i in train_index]
-                    fold_scores2 = [shuffled_scores2[i] for i in train_index]
+                    fold_scores1 = shuffled_scores1[train_index]
+                    fold_scores2 = shuffled_scores2[train_index]
 
                     # Only keep folds that are of equal length
                     if len(fold_scores1) == len(scores1) // num_runs:
@@ -493,10 +641,10 @@ def get_distance_scores(
                         test_indices = indices[:fold_num_test_samples]
                         train_indices = indices[fold_num_test_samples:]
 
-                        train_scores1 = [fold_scores1[i] for i in train_indices]
-                        train_scores2 = [fold_scores2[i] for i in train_indices]
-                        test_scores1 = [fold_scores1[i] for i in test_indices]
-                        test_scores2 = [fold_scores2[i] for i in test_indices]
+                        train_scores1 = fold_scores1[train_indices]
+                        train_scores2 = fold_scores2[train_indices]
+                        test_scores1 = fold_scores1[test_indices]
+                        test_scores2 = fold_scores2[test_indices]
 
                         logger.info(f"Training neural net distance on {len(train_scores1)} samples.")
 
@@ -533,28 +681,43 @@ def get_distance_scores(
                                     test_scores1, test_scores2
                                 )
 
+                        for measure, distance_func in TRAINING_FREE_DISTANCES.items():
+                            if measure in distance_measures:
+                                dist_dict[measure] = distance_func(test_scores1, test_scores2)
+
                         dist_data.append(dist_dict)
 
         else:
-            if "NeuralNet" in distance_measures:
+            if any(measure in distance_measures for measure in ["NeuralNet", *TRAINING_FREE_DISTANCES]):
                 num_train_samples_list = []
+                batched_samples = []
                 if isinstance(num_samples, int):
                     num_samples = [num_samples]
 
+                # draw the train/test splits of all runs up front; the train sets of different sizes are nested
+                resampling_plan = ResamplingPlan(
+                    len(scores1),
+                    num_test_samples,
+                    num_samples,
+                    num_runs=num_runs,
+                    random_seed=random_seed,
+                )
+                scores1_array = np.asarray(scores1, dtype=float)
+                scores2_array = np.asarray(scores2, dtype=float)
+                run_scores = [resampling_plan.gather(scores1_array, scores2_array, run) for run in range(num_runs)]
+
                 for num_train_samples in num_samples:
+                    num_train_samples = resampling_plan.get_num_train_samples(num_train_samples)
+
                     for run in range(num_runs):
                         logger.info(f"Num runs: {num_runs}, Run: {run}")
-                        np.random.seed(random_seed + run)
-                        random_test_indices = np.random.choice(len(scores1), num_test_samples, replace=False)
+                        train_scores1, train_scores2, test_scores1, test_scores2 = run_scores[run]
 
                         dist_dict = {
                             "num_train_samples": num_train_samples,
                             "num_test_samples": num_test_samples,
                         }
 
-                        test_scores1 = [scores1[i] for i in random_test_indices]
-                        test_scores2 = [scores2[i] for i in random_test_indices]
-
                         logger.info(f"Testing neural net distance on {len(test_scores1)} samples.")
 
                         if "Wasserstein" in distance_measures:
@@ -565,21 +728,28 @@ def get_distance_scores(
                                     test_scores1, test_scores2
                                 )
 
-                        train_scores1 = [scores1[i] for i in range(len(scores1)) if i not in random_test_indices]
-                        train_scores2 = [scores2[i] for i in range(len(scores2)) if i not in random_test_indices]
-
-                        if num_train_samples > len(train_scores1):
-                            logger.warning(
-                                f"Number of train samples {num_train_samples} is greater than the number of available samples {len(train_scores1)}. We are training on all available samples."
-                            )
-                            num_train_samples = len(train_scores1)
+                        for measure, distance_func in TRAINING_FREE_DISTANCES.items():
+                            if measure in distance_measures:
+                                dist_dict[measure] = distance_func(test_scores1, test_scores2)
 
                         num_train_samples_list.append(num_train_samples)
                         dist_dict["num_train_samples"] = int(num_train_samples)
 
-                        random_train_indices = np.random.choice(len(train_scores1), num_train_samples, replace=False)
-                        current_train_scores1 = [train_scores1[i] for i in random_train_indices]
-                        current_train_scores2 = [train_scores2[i] for i in random_train_indices]
+                        if "NeuralNet" not in distance_measures:
+                            dist_data.append(dist_dict)
+                            continue
+
+                        # prefix views of the gathered train scores, no copies
+                        current_train_scores1 = train_scores1[:num_train_samples]
+                        current_train_scores2 = train_scores2[:num_train_samples]
+
+                        if batch_runs:
+                            # all runs are trained together below
+                            batched_samples.append(
+                                (current_train_scores1, current_train_scores2, test_scores1, test_scores2)
+                            )
+                            dist_data.append(dist_dict)
+                            continue
 
                         logger.info(f"Training neural net distance on {len(current_train_scores1)} samples.")
 
@@ -609,32 +779,57 @@ def get_distance_scores(
 
                         dist_data.append(dist_dict)
 
+                if batch_runs and batched_samples:
+                    logger.info(
+                        f"Training neural net distance for {len(batched_samples)} runs with training set sizes {num_samples} at once."
+                    )
+                    samples1_list, samples2_list, test_samples1_list, test_samples2_list = map(
+                        list, zip(*batched_samples)
+                    )
+                    if pre_shuffle:
+                        unpaired_distances = BatchedNeuralNetDistance(
+                            net_cfg,
+                            deepcopy(samples1_list),
+                            deepcopy(samples2_list),
+                            deepcopy(test_samples1_list),
+                            deepcopy(test_samples2_list),
+                            train_cfg,
+                            pre_shuffle=pre_shuffle,
+                            random_seed=random_seed,
+                        ).train()
+                    distances = BatchedNeuralNetDistance(
+                        net_cfg,
+                        samples1_list,
+                        samples2_list,
+                        test_samples1_list,
+                        test_samples2_list,
+                        train_cfg,
+                        pre_shuffle=False,
+                        random_seed=random_seed,
+                    ).train()
+
+                    for i, dist_dict in enumerate(dist_data):
+                        if pre_shuffle:
+                            dist_dict["NeuralNet_unpaired"] = unpaired_distances[i].item()
+                        dist_dict["NeuralNet"] = distances[i].item()
+
         if dist_data:
             dist_df = pd.DataFrame(dist_data)
-            if evaluate_wasserstein_on_full:
-                dist_df["Wasserstein_full"] = wasserstein_dist_dict["Wasserstein_full"]
-                dist_df["total_samples"] = wasserstein_dist_dict["num_samples"]
+            full_columns = [col for col in full_dist_dict if col != "num_samples"]
+            if full_columns:
+                for col in full_columns:
+                    dist_df[col] = full_dist_dict[col]
+                dist_df["total_samples"] = full_dist_dict["num_samples"]
         else:
-            if evaluate_wasserstein_on_full:
-                dist_df = pd.DataFrame([wasserstein_dist_dict])
-
-        if save:
-            if not score_dir.exists():
-                score_dir.mkdir(parents=True, exist_ok=True)
+            dist_df = pd.DataFrame([full_dist_dict])
 
-            dist_file = "distance_scores"
-            nts_list = list(set(num_train_samples_list))
-            for nts in nts_list:
-                dist_file += f"_{nts}"
-            dist_file += noise_string
-            dist_file += f"_{num_runs}.csv"
+        if cache_key is not None:
+            cache.put(cache_key, dist_df, score_path, cache_config)
 
-            dist_path = score_dir / dist_file
-
-            if not dist_path.exists() or overwrite:
-                dist_df.to_csv(dist_path, index=False)
-            else:
-                logger.info(f"File {dist_path} already exists. Use overwrite=True to overwrite it.")
+        if save:
+            save_distance_scores(
+                dist_df, score_dir / get_distance_file_name(num_samples, num_runs, noise), overwrite=overwrite
+            )
 
         return dist_df
 
@@ -645,6 +840,66 @@ def get_distance_scores(
             logger.error(f"File for model {model_name2} does not exist yet")
 
 
+def get_bootstrap_distance_scores(
+    model_name1: str,
+    seed1: int,
+    seed2: int,
+    checkpoint: Optional[str] = None,
+    checkpoint_base_name: Optional[str] = None,
+    model_name2: Optional[str] = None,
+    metric: str = "perspective",
+    test_dir: str = "test_outputs",
+    dir_prefix: Optional[str] = None,
+    num_bootstrap: int = 1000,
+    paired: bool = True,
+    random_seed: int = 0,
+    only_continuations: bool = True,
+    save: bool = False,
+    overwrite: bool = False,
+    noise: float = 0,
+) -> Optional[pd.DataFrame]:
+    """
+    Bootstrap replicates of the W1 distance, KS distance, mean and std differences and W2 distance between the scores
+    of two models, see bootstrap_distances. Gives error bars for the point estimates without retraining any distances.
+    """
+    if not (checkpoint and checkpoint_base_name) and not model_name2:
+        raise ValueError("Either checkpoint and checkpoint_base_name or model_name2 must be provided")
+
+    cont_string = "continuation_" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+
+    if not dir_prefix:
+        dir_prefix = metric
+
+    model_name2 = f"{checkpoint_base_name}{checkpoint}" if checkpoint else model_name2
+
+    score_dir = SCRIPT_DIR / dir_prefix / test_dir / f"{model_name1}_{seed1}_{model_name2}_{seed2}"
+    score_path = score_dir / f"{cont_string}scores{noise_string}.json"
+
+    try:
+        with open(score_path, "r") as f:
+            data = json.load(f)
+
+    except FileNotFoundError:
+        logger.error(f"Score file {score_path} does not exist yet")
+        return None
+
+    bootstrap_df = bootstrap_distances(
+        data[f"{metric}_scores1"],
+        data[f"{metric}_scores2"],
+        num_bootstrap=num_bootstrap,
+        paired=paired,
+        random_seed=random_seed,
+    )
+
+    if save:
+        save_distance_scores(
+            bootstrap_df, score_dir / f"bootstrap_distances_{num_bootstrap}{noise_string}.csv", overwrite=overwrite
+        )
+
+    return bootstrap_df
+
+
 def get_mean_and_std_for_nn_distance(df):
     """"""
 
@@ -690,6 +945,7 @@ def get_power_over_sequences_for_ranked_checkpoints(
     test_dir="test_outputs",
     dir_prefix: Optional[str] = None,
     noise: float = 0,
+    num_workers: Optional[int] = None,
 ):
     if not isinstance(checkpoints, list):
         checkpoints = [checkpoints]
@@ -698,26 +954,37 @@ def get_power_over_sequences_for_ranked_checkpoints(
 
     result_dfs = []
 
-    for checkpoint, seed in zip(checkpoints, seeds):
-        logger.info(
-            f"Base_model: {base_model_name}, base_model_seed: {base_model_seed}, checkpoint: {checkpoint_base_name}{checkpoint}, seed: {seed}"
-        )
-
-        dist_df = get_distance_scores(
+    # compute the distances of all checkpoints in parallel
+    dist_jobs = [
+        DistanceJob(
             base_model_name,
             base_model_seed,
+            f"{checkpoint_base_name}{checkpoint}",
             seed,
-            checkpoint=checkpoint,
-            checkpoint_base_name=checkpoint_base_name,
-            metric=metric,
-            test_dir=test_dir,
-            dir_prefix=dir_prefix,
-            distance_measures=[distance_measure],
-            num_runs=num_runs_distance,
-            evaluate_wasserstein_on_full=True,  # the distance measure is currently hard coded
-            only_continuations=only_continuations,
-            noise=noise,
+            dist_kwargs={
+                "metric": metric,
+                "test_dir": test_dir,
+                "dir_prefix": dir_prefix,
+                "distance_measures": [distance_measure],
+                "num_runs": num_runs_distance,
+                "evaluate_wasserstein_on_full": True,  # the distance measure is currently hard coded
+                "only_continuations": only_continuations,
+                "noise": noise,
+            },
         )
+        for checkpoint, seed in zip(checkpoints, seeds)
+    ]
+    dist_dfs = run_distance_jobs(dist_jobs, num_workers=num_workers)
+
+    for checkpoint, seed, dist_df in zip(checkpoints, seeds, dist_dfs):
+        if dist_df is None:
+            logger.warning(f"Skipping checkpoint {checkpoint_base_name}{checkpoint}, its scores do not exist yet.")
+            continue
+
+        logger.info(
+            f"Base_model: {base_model_name}, base_model_seed: {base_model_seed}, checkpoint: {checkpoint_base_name}{checkpoint}, seed: {seed}"
+        )
+
         dist = dist_df[f"{distance_measure}_full"].mean()
 
         result_df = get_power_over_sequences_for_models_or_checkpoints(
@@ -759,6 +1026,7 @@ def get_power_over_sequences_for_ranked_checkpoints_wrapper(
     test_dir="test_outputs",
     dir_prefix: Optional[str] = None,
     noise: float = 0,
+    num_workers: Optional[int] = None,
 ):
     """
     This is a wrapper for get_power_over_sequences_for_ranked_checkpoints to use to multiple fold sizes and returns a concatenated dataframe.
@@ -782,6 +1050,7 @@ def get_power_over_sequences_for_ranked_checkpoints_wrapper(
                 test_dir=test_dir,
                 dir_prefix=dir_prefix,
                 noise=noise,
+                num_workers=num_workers,
             )
         )
 
@@ -903,7 +1172,13 @@ def get_mean_tox_scores(
     only_continuations=False,
     diff=False,
     noise: float = 0,
+    use_sketches: bool = False,
 ):
+    """
+    Mean, std and median of the scores of each model. If use_sketches, they are read from the quantile sketches
+    stored next to the score files (the median is then approximate) instead of loading the full score arrays; this
+    does not apply to diff or only_on_toxic_prompts, which need the individual scores.
+    """
     if dir_prefix is None:
         dir_prefix = metric
 
@@ -923,6 +1198,16 @@ def get_mean_tox_scores(
 
     for model_file in model_files:
         try:
+            if use_sketches and not diff and not only_on_toxic_prompts:
+                score_path = score_dir / model_file / f"{cont_string}scores{noise_string}.json"
+                sketch = load_score_sketch(score_path, metric=metric)
+                if sketch is None:
+                    raise FileNotFoundError(f"No scores found at {score_path}")
+                all_scores.append(
+                    {"model": model_file, "mean": sketch.mean(), "std": sketch.std(), "median": sketch.median()}
+                )
+                continue
+
             if not diff:
                 score_path = score_dir / model_file / f"{cont_string}scores{noise_string}.json"
                 with open(score_path, "r") as f:
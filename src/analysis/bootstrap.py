@@ -0,0 +1,184 @@
+import logging
+import numpy as np
+import pandas as pd
+import sys
+
+from pathlib import Path
+from typing import Optional, Iterator, Tuple
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+# columns of the bootstrap dataframe, followed by Wasserstein_{p} for the order p of bootstrap_distances;
+# Wasserstein_comparison matches the column of get_distance_scores
+BOOTSTRAP_METRICS = ["Wasserstein_comparison", "KS", "Mean_difference", "Std_difference"]
+
+# upper bound on the number of floats held in memory per chunk
+MAX_CHUNK_ELEMENTS = 10_000_000
+
+
+def draw_bootstrap_indices(
+    num_samples: int, num_bootstrap: int, chunk_size: int, rng: np.random.Generator
+) -> Iterator[np.ndarray]:
+    """Yields the bootstrap index matrices of shape (chunk_size, num_samples), chunk by chunk."""
+    for start in range(0, num_bootstrap, chunk_size):
+        size = min(chunk_size, num_bootstrap - start)
+        yield rng.integers(0, num_samples, size=(size, num_samples))
+
+
+def batched_w1_and_ks(samples1: np.ndarray, samples2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    W1 and Kolmogorov-Smirnov distance between the rows of samples1 (b, n) and samples2 (b, m).
+
+    Both samples are sorted jointly; walking through the sorted values, the difference of the empirical CDFs goes up
+    by 1/n for every value of samples1 and down by 1/m for every value of samples2, so it is a cumulative sum. W1 is
+    the integral of its absolute value, KS its maximum at the end of each group of tied values.
+    """
+    n, m = samples1.shape[1], samples2.shape[1]
+
+    combined = np.concatenate([samples1, samples2], axis=1)
+    order = np.argsort(combined, axis=1, kind="stable")
+    sorted_values = np.take_along_axis(combined, order, axis=1)
+
+    steps = np.where(order < n, 1 / n, -1 / m)
+    cdf_diff = np.cumsum(steps, axis=1)
+
+    gaps = np.diff(sorted_values, axis=1)
+    w1 = np.sum(np.abs(cdf_diff[:, :-1]) * gaps, axis=1)
+
+    # within a group of tied values the cumulative sum is not a CDF difference yet
+    group_end = np.concatenate([gaps != 0, np.ones((len(gaps), 1), dtype=bool)], axis=1)
+    ks = np.max(np.where(group_end, np.abs(cdf_diff), 0), axis=1)
+
+    return w1, ks
+
+
+def batched_wasserstein_p(samples1: np.ndarray, samples2: np.ndarray, p: float = 2) -> np.ndarray:
+    """
+    p-Wasserstein distance between the rows of samples1 (b, n) and samples2 (b, m), matching wasserstein_p: the rows
+    are sorted and their quantile functions compared on the same grid of max(n, m) quantile levels, with the
+    interpolation indices shared by all rows.
+    """
+    n, m = samples1.shape[1], samples2.shape[1]
+    quantiles = np.linspace(0, 1, max(n, m), endpoint=True)
+
+    def quantile_rows(samples, num_samples):
+        ranks = quantiles * (num_samples - 1)
+        lower = np.floor(ranks).astype(int)
+        upper = np.minimum(lower + 1, num_samples - 1)
+        sorted_samples = np.sort(samples, axis=1)
+        return sorted_samples[:, lower] + (sorted_samples[:, upper] - sorted_samples[:, lower]) * (ranks - lower)
+
+    q1 = quantile_rows(samples1, n)
+    q2 = quantile_rows(samples2, m)
+    return np.mean(np.abs(q1 - q2) ** p, axis=1) ** (1 / p)
+
+
+def bootstrap_distances(
+    scores1,
+    scores2,
+    num_bootstrap: int = 1000,
+    paired: bool = True,
+    chunk_size: Optional[int] = None,
+    random_seed: int = 0,
+    p: float = 2,
+) -> pd.DataFrame:
+    """
+    Bootstrap replicates of the W1 distance, KS distance, the differences in mean and std and the p-Wasserstein
+    distance between two score distributions. The index matrices of a chunk of replicates are drawn at once and all metrics are computed for the
+    whole chunk in vectorized numpy, so memory is bounded by chunk_size.
+
+    Args:
+        scores1: scores of model 1
+        scores2: scores of model 2
+        num_bootstrap: number of bootstrap replicates
+        paired: whether the scores are paired (continuations of the same prompts); paired scores are resampled with
+            the same indices
+        chunk_size: number of replicates per chunk, chosen to hold at most MAX_CHUNK_ELEMENTS floats if None
+        random_seed: seed of the resampling
+        p: order of the Wasserstein distance of the last column (see batched_wasserstein_p)
+
+    Returns:
+        Dataframe with one row per replicate and the columns in BOOTSTRAP_METRICS and Wasserstein_{p}
+    """
+    scores1 = np.asarray(scores1, dtype=float)
+    scores2 = np.asarray(scores2, dtype=float)
+    n, m = len(scores1), len(scores2)
+
+    if paired and n != m:
+        raise ValueError(f"Paired bootstrap needs the same number of scores, got {n} and {m}.")
+
+    if chunk_size is None:
+        # the joint sort holds a few (b, n + m) arrays, the quantile functions a few (b, max(n, m)) arrays
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (4 * (n + m) + 4 * max(n, m)))
+
+    rng = np.random.default_rng(random_seed)
+    results = []
+
+    indices2_iter = None if paired else draw_bootstrap_indices(m, num_bootstrap, chunk_size, rng)
+    for indices1 in draw_bootstrap_indices(n, num_bootstrap, chunk_size, rng):
+        indices2 = indices1 if paired else next(indices2_iter)
+
+        samples1 = scores1[indices1]
+        samples2 = scores2[indices2]
+
+        w1, ks = batched_w1_and_ks(samples1, samples2)
+        results.append(
+            np.stack(
+                [
+                    w1,
+                    ks,
+                    samples1.mean(axis=1) - samples2.mean(axis=1),
+                    samples1.std(axis=1) - samples2.std(axis=1),
+                    batched_wasserstein_p(samples1, samples2, p=p),
+                ],
+                axis=1,
+            )
+        )
+
+    bootstrap_df = pd.DataFrame(np.concatenate(results), columns=[*BOOTSTRAP_METRICS, f"Wasserstein_{p:g}"])
+    bootstrap_df.insert(0, "replicate", np.arange(num_bootstrap))
+
+    return bootstrap_df
+
+
+def summarize_bootstrap(bootstrap_df: pd.DataFrame, confidence: float = 0.95) -> pd.DataFrame:
+    """
+    Percentile confidence intervals of the bootstrap replicates.
+
+    Returns:
+        Dataframe with one row per metric and the columns mean, std, lower and upper
+    """
+    alpha = 1 - confidence
+    metrics = [col for col in bootstrap_df.columns if col != "replicate"]
+
+    return pd.DataFrame(
+        {
+            "mean": bootstrap_df[metrics].mean(),
+            "std": bootstrap_df[metrics].std(),
+            "lower": bootstrap_df[metrics].quantile(alpha / 2),
+            "upper": bootstrap_df[metrics].quantile(1 - alpha / 2),
+        }
+    )
+
+
+def bootstrap_mean_interval(
+    values, num_bootstrap: int = 1000, confidence: float = 0.95, random_seed: int = 0
+) -> Tuple[float, float]:
+    """
+    Percentile bootstrap confidence interval of the mean of values, e.g. of the neural net distances of all runs.
+    All replicates are drawn as one index matrix.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+
+    rng = np.random.default_rng(random_seed)
+    means = values[rng.integers(0, len(values), size=(num_bootstrap, len(values)))].mean(axis=1)
+
+    alpha = 1 - confidence
+    lower, upper = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return lower, upper
@@ -1,8 +1,6 @@
 import importlib
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
 import sys
 import torch
 
@@ -11,7 +9,7 @@ from scipy.stats import kstest, wasserstein_distance
 from sklearn.model_selection import train_test_split
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-from typing import List
+from typing import List, Optional
 
 # Add paths to sys.path if not already present
 project_root = Path(__file__).resolve().parents[2]
@@ -22,7 +20,8 @@ if str(project_root) not in sys.path:
 from arguments import TrainCfg
 from src.utils.utils import initialize_from_config, time_block, load_config
 from src.test.dataloader import ScoresDataset, collate_fn
-from src.analysis.nn_distance import CMLP
+from src.analysis.nn_distance import CMLP, StackedCMLP
+from src.analysis.wasserstein import wasserstein_p
 
 # Import from submodule (which is at project root)
 submodule_path = project_root / "deep-anytime-testing"
@@ -138,16 +137,110 @@ def empirical_wasserstein_distance(samples1, samples2, p=1):
     if p == 1:
         wasserstein_dist = empirical_wasserstein_distance_p1(samples1, samples2)
     else:
-        n = len(samples1)
-        m = len(samples2)
+        wasserstein_dist = wasserstein_p(samples1, samples2, p=p)
 
-        quantiles = np.linspace(0, 1, max(n, m), endpoint=True)
+    return wasserstein_dist
 
-        q1 = np.array([empirical_quantile_function(samples1, q) for q in quantiles])
-        q2 = np.array([empirical_quantile_function(samples2, q) for q in quantiles])
-        wasserstein_dist = (np.sum(np.abs(q1 - q2) ** p * (1 / len(quantiles)))) ** (1 / p)
 
-    return wasserstein_dist
+def median_heuristic_bandwidth(samples1, samples2, max_samples: int = 1000, random_seed: int = 0) -> float:
+    """
+    Median of the pairwise distances of (a subsample of) the pooled samples, the usual bandwidth of the RBF kernel.
+    Falls back to the std of the pooled samples (or 1) if most samples are tied and the median distance is zero.
+    """
+    pooled = np.concatenate([np.asarray(samples1, dtype=float), np.asarray(samples2, dtype=float)])
+    if len(pooled) > max_samples:
+        pooled = np.random.default_rng(random_seed).choice(pooled, max_samples, replace=False)
+
+    bandwidth = np.median(np.abs(pooled[:, None] - pooled[None, :]))
+    if bandwidth <= 0:
+        bandwidth = np.std(pooled)
+    return bandwidth if bandwidth > 0 else 1.0
+
+
+def rbf_kernel(x, y, bandwidth: float):
+    """ """
+    return np.exp(-((x - y) ** 2) / (2 * bandwidth**2))
+
+
+def linear_time_mmd(samples1, samples2, bandwidth: Optional[float] = None) -> float:
+    """
+    Linear-time estimate of the squared MMD with an RBF kernel (Gretton et al., 2012). The paired samples are split
+    into consecutive pairs (x, x'), (y, y') and h = k(x, x') + k(y, y') - k(x, y') - k(x', y) is averaged over them.
+    """
+    samples1 = np.asarray(samples1, dtype=float)
+    samples2 = np.asarray(samples2, dtype=float)
+    if bandwidth is None:
+        bandwidth = median_heuristic_bandwidth(samples1, samples2)
+
+    num_pairs = min(len(samples1), len(samples2)) // 2
+    x, x_prime = samples1[0 : 2 * num_pairs : 2], samples1[1 : 2 * num_pairs : 2]
+    y, y_prime = samples2[0 : 2 * num_pairs : 2], samples2[1 : 2 * num_pairs : 2]
+
+    h = (
+        rbf_kernel(x, x_prime, bandwidth)
+        + rbf_kernel(y, y_prime, bandwidth)
+        - rbf_kernel(x, y_prime, bandwidth)
+        - rbf_kernel(x_prime, y, bandwidth)
+    )
+    return np.mean(h)
+
+
+def block_mmd(
+    samples1, samples2, block_size: int = 100, bandwidth: Optional[float] = None, blocks_per_chunk: int = 100
+) -> float:
+    """
+    Block estimate of the squared MMD with an RBF kernel (Zaremba et al., 2013): the unbiased quadratic-time
+    estimate within blocks of block_size samples, averaged over the blocks. Linear in the number of samples for a
+    fixed block size, with a lower variance than linear_time_mmd. Blocks are processed blocks_per_chunk at a time.
+    """
+    samples1 = np.asarray(samples1, dtype=float)
+    samples2 = np.asarray(samples2, dtype=float)
+    if bandwidth is None:
+        bandwidth = median_heuristic_bandwidth(samples1, samples2)
+
+    num_samples = min(len(samples1), len(samples2))
+    block_size = max(2, min(block_size, num_samples))
+    num_blocks = num_samples // block_size
+
+    blocks1 = samples1[: num_blocks * block_size].reshape(num_blocks, block_size)
+    blocks2 = samples2[: num_blocks * block_size].reshape(num_blocks, block_size)
+    off_diagonal = ~np.eye(block_size, dtype=bool)
+
+    block_estimates = []
+    for start in range(0, num_blocks, blocks_per_chunk):
+        x = blocks1[start : start + blocks_per_chunk]
+        y = blocks2[start : start + blocks_per_chunk]
+
+        k_xx = rbf_kernel(x[:, :, None], x[:, None, :], bandwidth)
+        k_yy = rbf_kernel(y[:, :, None], y[:, None, :], bandwidth)
+        k_xy = rbf_kernel(x[:, :, None], y[:, None, :], bandwidth)
+
+        h = k_xx + k_yy - k_xy - k_xy.transpose(0, 2, 1)
+        block_estimates.append(h[:, off_diagonal].sum(axis=1) / (block_size * (block_size - 1)))
+
+    return np.mean(np.concatenate(block_estimates))
+
+
+def energy_distance_1d(samples1, samples2) -> float:
+    """
+    Energy distance between two 1-d samples, as scipy.stats.energy_distance, in O(n log n): in 1-d it equals
+    sqrt(2 * integral of (F1 - F2)^2), and the difference of the empirical CDFs is a cumulative sum over the jointly
+    sorted samples.
+    """
+    samples1 = np.asarray(samples1, dtype=float)
+    samples2 = np.asarray(samples2, dtype=float)
+    n, m = len(samples1), len(samples2)
+
+    combined = np.concatenate([samples1, samples2])
+    order = np.argsort(combined, kind="stable")
+    cdf_diff = np.cumsum(np.where(order < n, 1 / n, -1 / m))
+
+    gaps = np.diff(combined[order])
+    return np.sqrt(2 * np.sum(cdf_diff[:-1] ** 2 * gaps))
+
+
+# distance measures that need no training, by their column name in the distance dataframe
+TRAINING_FREE_DISTANCES = {"MMD": block_mmd, "Energy": energy_distance_1d}
 
 
 class NeuralNetDistance:
@@ -302,7 +395,191 @@ class NeuralNetDistance:
             return aggregated_loss / num_samples
 
 
+class BatchedNeuralNetDistance:
+    """
+    Trains the neural net distance for several runs (e.g. different random splits and training set sizes) at once.
+
+    The networks of all runs are stacked into one model (see StackedCMLP) and trained in lockstep on padded data with
+    per-run masks. Every run keeps its own train/val split, minibatches, Adam state and early stopper, so each run
+    follows the same procedure as NeuralNetDistance.train. Runs that have run out of minibatches in an epoch or that
+    have stopped early are masked out of the optimizer update.
+    """
+
+    def __init__(
+        self,
+        net_cfg,
+        samples1_list,
+        samples2_list,
+        test_samples1_list,
+        test_samples2_list,
+        train_cfg,
+        random_seed=0,
+        epochs=100,
+        pre_shuffle=False,
+    ):
+        """
+        Initializes the BatchedNeuralNetDistance object.
+
+        Args:
+        - net_cfg (dict): Configuration dictionary for the neural network.
+        - samples1_list (List[List]): Per run, list of training samples from distribution 1.
+        - samples2_list (List[List]): Per run, list of training samples from distribution 2.
+        - test_samples1_list (List[List]): Per run, list of test samples from distribution 1.
+        - test_samples2_list (List[List]): Per run, list of test samples from distribution 2.
+        - train_cfg (dict): Configuration dictionary for training the neural network.
+        - random_seed (int): Random seed for reproducibility.
+        """
+        assert (
+            len(samples1_list) == len(samples2_list) == len(test_samples1_list) == len(test_samples2_list)
+        ), "All sample lists must contain one entry per run."
+
+        # train params
+        self.random_seed = random_seed
+        self.epochs = epochs
+        self.lr = train_cfg.lr
+        self.patience = train_cfg.earlystopping.patience
+        self.delta = train_cfg.earlystopping.delta
+        self.net_bs = train_cfg.net_batch_size
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.pre_shuffle = pre_shuffle
+
+        self.num_runs = len(samples1_list)
+
+        samples1_list = [list(samples) for samples in samples1_list]
+        samples2_list = [list(samples) for samples in samples2_list]
+        test_samples1_list = [list(samples) for samples in test_samples1_list]
+        test_samples2_list = [list(samples) for samples in test_samples2_list]
+
+        if self.pre_shuffle:
+            # Shuffle samples1 and samples2 randomly
+            for samples in samples1_list + samples2_list + test_samples1_list + test_samples2_list:
+                np.random.shuffle(samples)
+
+        # same train/val split per run as in NeuralNetDistance.train
+        train1, train2, val1, val2 = [], [], [], []
+        for samples1, samples2 in zip(samples1_list, samples2_list):
+            train_indices, val_indices = train_test_split(
+                np.arange(len(samples1)), test_size=0.2, random_state=self.random_seed
+            )
+            train1.append([samples1[i] for i in train_indices])
+            train2.append([samples2[i] for i in train_indices])
+            val1.append([samples1[i] for i in val_indices])
+            val2.append([samples2[i] for i in val_indices])
+
+        self.train_x, self.train_y, self.train_counts = self.pad(train1, train2)
+        self.val_x, self.val_y, self.val_counts = self.pad(val1, val2)
+        self.test_x, self.test_y, self.test_counts = self.pad(test_samples1_list, test_samples2_list)
+
+        # initialize one network per run; L2 regularization is the weight decay of Adam
+        self.nets = StackedCMLP(
+            net_cfg,
+            self.num_runs,
+            self.lr,
+            weight_decay=train_cfg.l2_lambda,
+            l1_lambda=train_cfg.l1_lambda,
+            device=self.device,
+        )
+
+    def pad(self, samples1_list, samples2_list):
+        """Pads the per-run samples to a common length. Returns tensors of shape (num_runs, max_len) and the counts."""
+        counts = torch.tensor([len(samples) for samples in samples1_list], device=self.device)
+        max_len = max(int(counts.max()), 1)
+
+        x = torch.zeros((self.num_runs, max_len), dtype=torch.float32)
+        y = torch.zeros((self.num_runs, max_len), dtype=torch.float32)
+        for run, (samples1, samples2) in enumerate(zip(samples1_list, samples2_list)):
+            x[run, : len(samples1)] = torch.tensor(samples1, dtype=torch.float32)
+            y[run, : len(samples2)] = torch.tensor(samples2, dtype=torch.float32)
+
+        return x.to(self.device), y.to(self.device), counts
+
+    def train_epoch(self, stopped, generator):
+        """One epoch of minibatch training with an independent shuffle per run."""
+        max_len = self.train_x.shape[1]
+        positions = torch.arange(max_len, device=self.device)
+        valid = positions.unsqueeze(0) < self.train_counts.unsqueeze(1)
+
+        # random order of the valid samples of each run, padding sorted to the end
+        keys = torch.rand((self.num_runs, max_len), generator=generator).to(self.device)
+        keys = torch.where(valid, keys, torch.full_like(keys, 2.0))
+        order = torch.argsort(keys, dim=1)
+
+        num_batches = int(np.ceil(int(self.train_counts.max()) / self.net_bs))
+        for batch_num in range(num_batches):
+            batch_positions = positions[batch_num * self.net_bs : (batch_num + 1) * self.net_bs]
+            idx = order[:, batch_positions]
+            mask = (batch_positions.unsqueeze(0) < self.train_counts.unsqueeze(1)).float()
+            active = (mask.sum(dim=1) > 0) & ~stopped
+            if not active.any():
+                break
+
+            self.nets.train_step(
+                torch.gather(self.train_x, 1, idx), torch.gather(self.train_y, 1, idx), mask, active
+            )
+
+    @torch.no_grad()
+    def evaluate(self, x, y, counts, mode="val"):
+        """
+        Per-run validation loss or, for mode "test", per-run neural net distance, computed in batches.
+        """
+        aggregated = torch.zeros(self.num_runs, device=self.device)
+        positions = torch.arange(x.shape[1], device=self.device)
+        for start in range(0, x.shape[1], self.net_bs):
+            batch_positions = positions[start : start + self.net_bs]
+            mask = (batch_positions.unsqueeze(0) < counts.unsqueeze(1)).float()
+            out = self.nets.forward(x[:, batch_positions], y[:, batch_positions])
+
+            if mode == "test":
+                # 1 + g(X)- g(Y) -1 = g(X) - g(Y)
+                aggregated += ((torch.exp(out) - 1) * mask).sum(dim=1)
+            else:
+                aggregated += -(out * mask).sum(dim=1)
+
+        if mode == "test":
+            return torch.abs(aggregated) / counts.clamp(min=1)
+        return aggregated / counts.clamp(min=1)
+
+    def train(self):
+        """
+        Returns:
+        - distances (torch.Tensor): Neural net distance per run, in the order of the given sample lists.
+        """
+        generator = torch.Generator().manual_seed(self.random_seed)
+
+        distances = torch.zeros(self.num_runs, device=self.device)
+        stopped = torch.zeros(self.num_runs, dtype=torch.bool, device=self.device)
+
+        # vectorized version of the early stopper
+        min_val_loss = torch.full((self.num_runs,), float("inf"), device=self.device)
+        counter = torch.zeros(self.num_runs, dtype=torch.long, device=self.device)
+
+        for epoch in tqdm(range(self.epochs)):
+            self.train_epoch(stopped, generator)
+            val_loss = self.evaluate(self.val_x, self.val_y, self.val_counts, mode="val")
+
+            improved = val_loss < min_val_loss
+            worse = ~improved & (val_loss > min_val_loss + self.delta)
+            min_val_loss = torch.where(improved & ~stopped, val_loss, min_val_loss)
+            counter = torch.where(improved, torch.zeros_like(counter), counter + worse.long())
+            stop_now = ~stopped & (counter >= self.patience)
+            if (epoch + 1) == self.epochs:
+                stop_now = ~stopped
+
+            if stop_now.any():
+                test_distances = self.evaluate(self.test_x, self.test_y, self.test_counts, mode="test")
+                distances = torch.where(stop_now, test_distances, distances)
+                stopped = stopped | stop_now
+
+            if stopped.all():
+                break
+
+        return distances
+
+
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     samples_N01 = np.random.normal(0, 1, 100000)
 
     # Generate 100,000 samples from N(0.5, 1)
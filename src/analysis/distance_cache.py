@@ -0,0 +1,149 @@
+import dataclasses
+import fcntl
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+from datetime import datetime
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from pathlib import Path
+from typing import Optional, Dict, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+# bump this when the way distances are computed changes, so that old entries are not reused
+DISTANCE_CACHE_VERSION = 1
+
+# (path, size, mtime) -> sha256 of the file contents
+_file_hashes = {}
+
+
+def to_serializable(obj):
+    """
+    Converts configs (dataclasses, OmegaConf configs, numpy types, paths, nested containers) into json-serializable
+    objects. Dataclass fields with metadata {"affects_results": False} (e.g. logging options) are left out, so that
+    they do not change cache keys, and so are fields with metadata {"omit_default": True} while they have their
+    default value, so that options added later do not invalidate the results computed before.
+    """
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {
+            f.name: to_serializable(getattr(obj, f.name))
+            for f in dataclasses.fields(obj)
+            if f.metadata.get("affects_results", True)
+            and not (f.metadata.get("omit_default", False) and getattr(obj, f.name) == f.default)
+        }
+    if isinstance(obj, (DictConfig, ListConfig)):
+        return to_serializable(OmegaConf.to_container(obj, resolve=True))
+    if isinstance(obj, dict):
+        return {str(k): to_serializable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_serializable(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Path):
+        return str(obj)
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        # plain config objects, e.g. OmegaConf-like attribute containers
+        return to_serializable(vars(obj))
+    return obj
+
+
+def canonical_json(config: Dict) -> str:
+    """ """
+    return json.dumps(to_serializable(config), sort_keys=True)
+
+
+def hash_file(path: Union[str, Path]) -> str:
+    """sha256 of the file contents, memoized per (path, size, mtime)."""
+    stat = os.stat(path)
+    memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+
+class DistanceCache:
+    """
+    Cache for distance results, keyed by the contents of the score file and the full distance config (net, train
+    and sampling parameters). Results are stored as {key}.csv in cache_dir. The index file index.json records the
+    score file, score hash and config of every entry.
+
+    Unlike the distance_scores_*.csv files, lookups do not depend on file names, so a result is only reused if it
+    was computed from the same scores with the same config.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path]):
+        self.cache_dir = Path(cache_dir)
+        self.index_path = self.cache_dir / "index.json"
+
+    def make_key(self, score_path: Union[str, Path], config: Dict) -> str:
+        """ """
+        payload = f"{DISTANCE_CACHE_VERSION}\n{hash_file(score_path)}\n{canonical_json(config)}"
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get_entry_path(self, key: str) -> Path:
+        """ """
+        return self.cache_dir / f"{key}.csv"
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """Returns the cached distance dataframe or None if there is no entry for key."""
+        entry_path = self.get_entry_path(key)
+        if not entry_path.exists():
+            return None
+        return pd.read_csv(entry_path)
+
+    def put(self, key: str, dist_df: pd.DataFrame, score_path: Union[str, Path], config: Dict):
+        """Stores the distance dataframe under key and records the entry in the index."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first, so that concurrent readers never see a partial entry
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.tmp")
+        dist_df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, entry_path)
+
+        self.update_index(
+            key,
+            {
+                "score_file": str(score_path),
+                "score_hash": hash_file(score_path),
+                "config": to_serializable(config),
+                "num_rows": len(dist_df),
+                "version": DISTANCE_CACHE_VERSION,
+                "created": datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+            },
+        )
+
+    def update_index(self, key: str, info: Dict):
+        """Adds an entry to the index; the index is locked so that several workers can update it at the same time."""
+        with open(self.cache_dir / "index.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self.load_index()
+                index[key] = info
+                tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(index, f, indent=4)
+                os.replace(tmp_path, self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_index(self) -> Dict:
+        """ """
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
@@ -0,0 +1,174 @@
+import logging
+import os
+import pandas as pd
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Optional, Dict, List
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.analysis.distance_cache import canonical_json
+from src.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DistanceJob:
+    """
+    A request for the distance scores between two models, computed with get_distance_scores(**dist_kwargs).
+
+    If dist_path is given, the resulting dataframe is also saved there. Whether a job has to be computed is decided
+    by the distance cache, not by the existence of dist_path.
+    """
+
+    model_name1: str
+    seed1: str
+    model_name2: str
+    seed2: str
+    dist_kwargs: Dict = field(default_factory=dict)
+    dist_path: Optional[Path] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.model_name1}_{self.seed1}_{self.model_name2}_{self.seed2}"
+
+    @property
+    def key(self) -> str:
+        """Identifies jobs that compute the same distances."""
+        return f"{self.name}\n{canonical_json(self.dist_kwargs)}"
+
+
+def get_cached_distance_scores(job: DistanceJob) -> Optional[pd.DataFrame]:
+    """Returns the distance scores of the job from the distance cache, or None if they have not been computed yet."""
+    from src.analysis.analyze import get_distance_scores
+
+    return get_distance_scores(
+        job.model_name1,
+        job.seed1,
+        job.seed2,
+        model_name2=job.model_name2,
+        only_from_cache=True,
+        **job.dist_kwargs,
+    )
+
+
+def init_worker(threads_per_worker: int):
+    """Limits the number of threads per worker process so that the workers do not oversubscribe the cpus."""
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[var] = str(threads_per_worker)
+
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+
+
+def run_distance_job(job: DistanceJob) -> Optional[pd.DataFrame]:
+    """
+    Computes the distance scores for a single job and saves them to job.dist_path. Returns None if the scores of the
+    pair do not exist yet, so that one missing pair does not abort the whole batch.
+    """
+    from src.analysis.analyze import get_distance_scores
+
+    with span("distance", "distance", model_name2=job.model_name2, num_runs=job.dist_kwargs.get("num_runs")):
+        dist_df = get_distance_scores(
+            job.model_name1,
+            job.seed1,
+            job.seed2,
+            model_name2=job.model_name2,
+            **job.dist_kwargs,
+        )
+
+    if dist_df is None:
+        logger.warning(f"Skipping distance job {job.name}, its scores do not exist yet.")
+        return None
+
+    if job.dist_path is not None:
+        Path(job.dist_path).parent.mkdir(parents=True, exist_ok=True)
+        dist_df.to_csv(job.dist_path, index=False)
+        logger.info(f"Distance analysis results saved to {job.dist_path}.")
+
+    return dist_df
+
+
+def run_distance_jobs(
+    jobs: List[DistanceJob],
+    num_workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    overwrite: bool = False,
+) -> List[pd.DataFrame]:
+    """
+    Computes the distance scores for a batch of jobs in parallel.
+
+    Jobs whose results are already in the distance cache are loaded instead of recomputed, identical jobs are only
+    computed once. The remaining jobs are distributed over a process pool in which every worker uses
+    threads_per_worker threads.
+
+    Args:
+        jobs: distance jobs
+        num_workers: number of worker processes; defaults to the number of cpus divided by threads_per_worker
+        threads_per_worker: number of torch threads per worker; defaults to an even split of the cpus over the workers
+        overwrite: whether to recompute jobs whose results already exist
+
+    Returns:
+        List of distance dataframes, in the order of the jobs; None for jobs whose scores do not exist yet
+    """
+    results = [None] * len(jobs)
+    pending = {}
+
+    for i, job in enumerate(jobs):
+        dist_df = None if overwrite else get_cached_distance_scores(job)
+        if dist_df is not None:
+            logger.info(f"Loaded existing distance analysis for {job.name} from cache.")
+            if job.dist_path is not None:
+                Path(job.dist_path).parent.mkdir(parents=True, exist_ok=True)
+                dist_df.to_csv(job.dist_path, index=False)
+            results[i] = dist_df
+        else:
+            pending.setdefault(job.key, []).append(i)
+
+    if not pending:
+        return results
+
+    num_cpus = os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = num_cpus if threads_per_worker is None else max(1, num_cpus // threads_per_worker)
+    num_workers = min(num_workers, len(pending))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, num_cpus // num_workers)
+
+    logger.info(
+        f"Computing {len(pending)} distance jobs with {num_workers} workers and {threads_per_worker} threads per worker."
+    )
+
+    if num_workers == 1:
+        init_worker(threads_per_worker)
+        for indices in pending.values():
+            dist_df = run_distance_job(jobs[indices[0]])
+            for i in indices:
+                results[i] = dist_df
+        return results
+
+    # spawn instead of fork, so that workers do not inherit the thread pools (or cuda context) of the parent
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+    ) as executor:
+        futures = {executor.submit(run_distance_job, jobs[indices[0]]): indices for indices in pending.values()}
+        for future in as_completed(futures):
+            indices = futures[future]
+            dist_df = future.result()
+            logger.info(f"Finished distance job {jobs[indices[0]].name}.")
+            for i in indices:
+                results[i] = dist_df
+
+    return results
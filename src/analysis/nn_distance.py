@@ -2,6 +2,7 @@ import importlib
 import torch
 import sys
 
+from copy import deepcopy
 from pathlib import Path
 
 # Add paths to sys.path if not already present
@@ -98,3 +99,103 @@ class CMLP(MLP):
         output = torch.log(1 + 0.5 * self.sigma(g_x) - 0.5 * self.sigma(g_y))
 
         return output
+
+
+class StackedCMLP:
+    """
+    One CMLP per run, stacked with torch.func.stack_module_state and evaluated under vmap, so that many networks can
+    be trained in lockstep. Every run has its own Adam state (with the L2 penalty as in torch.optim.Adam) and only the
+    active runs are updated, so runs can stop at different times.
+    """
+
+    def __init__(self, net_cfg, num_runs: int, lr: float, weight_decay: float = 0, l1_lambda: float = 0, device="cpu"):
+        self.num_runs = num_runs
+        self.lr = lr
+        self.weight_decay = weight_decay
+        self.l1_lambda = l1_lambda
+        self.device = device
+
+        # Adam defaults, as in torch.optim.Adam
+        self.betas = (0.9, 0.999)
+        self.eps = 1e-8
+
+        nets = [
+            CMLP(
+                net_cfg["input_size"],
+                net_cfg["hidden_layer_size"],
+                1,
+                net_cfg["layer_norm"],
+                False,
+                0.4,
+                net_cfg["bias"],
+            ).to(device)
+            for _ in range(num_runs)
+        ]
+        params, buffers = torch.func.stack_module_state(nets)
+        self.params = {name: param.detach().requires_grad_(True) for name, param in params.items()}
+        self.buffers = buffers
+
+        self.base_net = deepcopy(nets[0]).to("meta")
+        self.base_net.eval()
+
+        self.exp_avg = {name: torch.zeros_like(param) for name, param in self.params.items()}
+        self.exp_avg_sq = {name: torch.zeros_like(param) for name, param in self.params.items()}
+        self.steps = torch.zeros(num_runs, device=device)
+
+    def forward(self, x, y) -> torch.Tensor:
+        """
+        Forward pass of all runs. x and y have shape (num_runs, batch_size), the output has the same shape.
+        """
+
+        def run_forward(run_params, run_buffers, run_x, run_y):
+            return torch.func.functional_call(
+                self.base_net, (run_params, run_buffers), (run_x.unsqueeze(-1), run_y.unsqueeze(-1))
+            )
+
+        return torch.vmap(run_forward)(self.params, self.buffers, x, y).squeeze(-1)
+
+    def l1_regularization(self) -> torch.Tensor:
+        l1_regularization = torch.zeros(self.num_runs, device=self.device)
+        for name, param in self.params.items():
+            if "bias" not in name:
+                l1_regularization = l1_regularization + param.abs().flatten(start_dim=1).sum(dim=1)
+        return l1_regularization
+
+    def adam_step(self, grads, active):
+        """Adam update (with L2 penalty as in torch.optim.Adam) applied only to the active runs."""
+        beta1, beta2 = self.betas
+        self.steps = self.steps + active.float()
+        bias_correction1 = 1 - beta1 ** self.steps.clamp(min=1)
+        bias_correction2 = 1 - beta2 ** self.steps.clamp(min=1)
+
+        with torch.no_grad():
+            for name, param in self.params.items():
+                shape = (-1,) + (1,) * (param.dim() - 1)
+                mask = active.view(shape)
+                grad = grads[name]
+                if self.weight_decay != 0:
+                    grad = grad + self.weight_decay * param
+
+                exp_avg = torch.where(mask, beta1 * self.exp_avg[name] + (1 - beta1) * grad, self.exp_avg[name])
+                exp_avg_sq = torch.where(
+                    mask, beta2 * self.exp_avg_sq[name] + (1 - beta2) * grad * grad, self.exp_avg_sq[name]
+                )
+                self.exp_avg[name] = exp_avg
+                self.exp_avg_sq[name] = exp_avg_sq
+
+                denom = (exp_avg_sq.sqrt() / bias_correction2.sqrt().view(shape)) + self.eps
+                update = self.lr / bias_correction1.view(shape) * exp_avg / denom
+                param.sub_(torch.where(mask, update, torch.zeros_like(update)))
+
+    def train_step(self, x, y, mask, active):
+        """
+        One optimizer step on a minibatch of every run: the loss of a run is its mean negative log betting score over
+        the valid (mask) samples plus the L1 penalty. x, y and mask have shape (num_runs, batch_size).
+        """
+        batch_counts = mask.sum(dim=1)
+        out = self.forward(x, y)
+        loss = -(out * mask).sum(dim=1) / batch_counts.clamp(min=1) + self.l1_lambda * self.l1_regularization()
+        loss = (loss * active.float()).sum()
+
+        grads = torch.autograd.grad(loss, list(self.params.values()))
+        self.adam_step(dict(zip(self.params.keys(), grads)), active)
@@ -82,8 +82,12 @@ def distance_box_plot(
     dir_prefix: Optional[str] = None,
     overwrite: bool = False,
     noise: float = 0,
+    bootstrap_df: Optional[pd.DataFrame] = None,
 ):
-    """ """
+    """
+    Box plot of the Wasserstein and neural net distances over runs. If bootstrap_df (see bootstrap_distances) is
+    given, the bootstrap replicates of the Wasserstein distance are added as a separate box.
+    """
 
     if dir_prefix is None:
         dir_prefix = metric
@@ -116,6 +120,13 @@ def distance_box_plot(
         # Concatenate the dataframes
         combined_df = pd.concat([wasserstein_df, neuralnet_df[["Distance", "Group"]]])
 
+        if bootstrap_df is not None:
+            bootstrap_wasserstein_df = bootstrap_df[["Wasserstein_comparison"]].rename(
+                columns={"Wasserstein_comparison": "Distance"}
+            )
+            bootstrap_wasserstein_df["Group"] = "Wasserstein (bootstrap)"
+            combined_df = pd.concat([combined_df, bootstrap_wasserstein_df])
+
         # Plotting the box plot using Seaborn
         plt.figure(figsize=(10, 6))
         sns.boxplot(x="Group", y="Distance", data=combined_df)
@@ -815,7 +826,14 @@ def plot_alpha_over_sequences(
     metric: str = "perspective",
     test_dir: str = "test_outputs",
     noise: float = 0,
+    result_df: Optional[pd.DataFrame] = None,
 ):
+    """
+    Args:
+        result_df: precomputed alpha over sequences, e.g. of run_null_calibration, instead of the results of the
+            same-model tests; its confidence intervals ("Alpha Lower", "Alpha Upper") are drawn as bands. Results of
+            the proxy bettor ("Bettor" is "proxy") are labelled as its sanity check, not as the alpha of the test
+    """
     # ROOT_DIR = os.path.dirname(__file__)
     if dir_prefix is None:
         dir_prefix = metric
@@ -825,18 +843,21 @@ def plot_alpha_over_sequences(
 
     noise_string = f"_noise_{noise}" if noise > 0 else ""
 
-    result_df = get_alpha_wrapper(
-        model_names,
-        seeds1,
-        seeds2,
-        fold_size=fold_size,
-        epsilon=epsilon,
-        only_continuations=only_continuations,
-        dir_prefix=dir_prefix,
-        test_dir=test_dir,
-        metric=metric,
-        noise=noise,
-    )
+    simulated = result_df is not None
+    proxy = simulated and "Bettor" in result_df.columns and (result_df["Bettor"] == "proxy").any()
+    if not simulated:
+        result_df = get_alpha_wrapper(
+            model_names,
+            seeds1,
+            seeds2,
+            fold_size=fold_size,
+            epsilon=epsilon,
+            only_continuations=only_continuations,
+            dir_prefix=dir_prefix,
+            test_dir=test_dir,
+            metric=metric,
+            noise=noise,
+        )
     group_by_model = "model_id" in result_df.columns
 
     # Create the plot
@@ -855,6 +876,15 @@ def plot_alpha_over_sequences(
                 label=model,
                 markersize=10,
             )
+            if "Alpha Lower" in result_df.columns:
+                model_df = result_df[result_df["model_id"] == model]
+                plt.fill_between(
+                    model_df["Samples"],
+                    model_df["Alpha Lower"],
+                    model_df["Alpha Upper"],
+                    color=palette[i % len(palette)],
+                    alpha=0.2,
+                )
     else:
         sns.lineplot(
             data=result_df,
@@ -865,10 +895,18 @@ def plot_alpha_over_sequences(
             color="black",
             markersize=10,
         )
+        if "Alpha Lower" in result_df.columns:
+            plt.fill_between(
+                result_df["Samples"], result_df["Alpha Lower"], result_df["Alpha Upper"], color="black", alpha=0.2
+            )
 
     # Customize the plot
     plt.xlabel("samples", fontsize=18)
-    plt.ylabel("proportion of triggered tests", fontsize=18)
+    if proxy:
+        plt.ylabel("proportion of triggered proxy tests", fontsize=18)
+        plt.title("Sanity check of the simulated proxy bettor, not the type-I error of the test", fontsize=16)
+    else:
+        plt.ylabel("proportion of triggered tests", fontsize=18)
     plt.xticks(fontsize=14)
     plt.yticks(fontsize=14)
     # plt.yticks(np.arange(0, 1.1, 0.1), fontsize=14)
@@ -901,7 +939,13 @@ def plot_alpha_over_sequences(
     directory = f"{plot_dir}/alpha_plots"
     if not Path(directory).exists():
         Path(directory).mkdir(parents=True, exist_ok=True)
-    fig_path = f"{directory}/alpha_error_over_number_of_sequences{noise_string}"
+    if proxy:
+        simulated_string = "proxy_bettor_"
+    elif simulated:
+        simulated_string = "null_calibration_"
+    else:
+        simulated_string = ""
+    fig_path = f"{directory}/{simulated_string}alpha_error_over_number_of_sequences{noise_string}"
     if isinstance(model_names, str):
         fig_path += f"_{model_names}"
     elif isinstance(model_names, list):
@@ -1195,8 +1239,14 @@ def plot_calibrated_detection_rate(
     dir_prefix: Optional[str] = None,
     metric="perspective",
     noise: float = 0,
+    epsilon_interval: Optional[Tuple[float, float]] = None,
 ):
-    """Plot calibrated detection rate without legend and with a text label for the vertical line."""
+    """
+    Plot calibrated detection rate without legend and with a text label for the vertical line.
+
+    If draw_in_std, the range true_epsilon +- std_epsilon is shaded, or epsilon_interval if given (e.g. a bootstrap
+    confidence interval, see bootstrap_mean_interval).
+    """
     if dir_prefix is None:
         dir_prefix = metric
 
@@ -1284,9 +1334,13 @@ def plot_calibrated_detection_rate(
         lighter_l = min(1, l + (1 - l) * 0.3)
         lighter_line_color = colorsys.hls_to_rgb(h, lighter_l, s)
 
+        lower_epsilon, upper_epsilon = (
+            epsilon_interval if epsilon_interval is not None else (true_epsilon - std_epsilon, true_epsilon + std_epsilon)
+        )
+
         plt.axvspan(
-            true_epsilon - std_epsilon,
-            true_epsilon + std_epsilon,
+            lower_epsilon,
+            upper_epsilon,
             alpha=0.2,
             color=lighter_line_color,
             label="Std Dev Range",
@@ -0,0 +1,731 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+import sys
+
+from copy import deepcopy
+from dataclasses import replace
+from pathlib import Path
+from scipy import stats
+from typing import Dict, List, Tuple, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.analysis.results_store import ResultsStore, get_results_store, get_schedule_suffix, power_curve_from_folds
+from src.test.preprocessing import load_score_file
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# fractions of the wealth the simulated bettor can stake; 0 means not betting on a sequence
+DEFAULT_BET_FRACTIONS = (0.0, 0.25, 0.5, 0.75, 0.95)
+
+# upper bound on the number of simulated scores per model held in memory at once
+MAX_CHUNK_SCORES = 4_000_000
+
+
+def normalize_scores(scores: np.ndarray, lower_lim: float = 0.0, upper_lim: float = 1.0) -> np.ndarray:
+    """Maps scores to [0, 1] with the limits of the metric."""
+    return np.clip((scores - lower_lim) / (upper_lim - lower_lim), 0, 1)
+
+
+def fit_beta(scores: np.ndarray, eps: float = 1e-6) -> Tuple[float, float]:
+    """Maximum likelihood fit of Beta(a, b) to scores in [0, 1]."""
+    a, b, _, _ = stats.beta.fit(np.clip(scores, eps, 1 - eps), floc=0, fscale=1)
+    return float(a), float(b)
+
+
+class ScoreModel:
+    """
+    Model of the score distributions of a pair from which the simulated tests draw their batches. Scores are mapped
+    to [0, 1] with the limits of the metric, and pairs with a NaN score are dropped.
+
+    Args:
+        scores1: scores of model 1
+        scores2: scores of model 2, the i-th scores of both models belong to the same prompt
+        kind: "empirical" resamples prompts, i.e. pairs of scores, with replacement, which treats the sampling noise
+            of the observed scores as a difference between the models, see simulate_power; "beta" samples both
+            models independently from Beta distributions fitted to their scores
+        lower_lim: lower limit of the metric
+        upper_lim: upper limit of the metric
+    """
+
+    def __init__(
+        self,
+        scores1,
+        scores2,
+        kind: str = "empirical",
+        lower_lim: float = 0.0,
+        upper_lim: float = 1.0,
+    ):
+        if kind not in ["empirical", "beta"]:
+            raise ValueError(f"Unknown score model {kind}, use 'empirical' or 'beta'.")
+
+        scores1 = np.asarray(scores1, dtype=float)
+        scores2 = np.asarray(scores2, dtype=float)
+        if len(scores1) != len(scores2):
+            raise ValueError("Scores are not the same length.")
+
+        keep = ~(np.isnan(scores1) | np.isnan(scores2))
+        self.scores1 = normalize_scores(scores1[keep], lower_lim, upper_lim)
+        self.scores2 = normalize_scores(scores2[keep], lower_lim, upper_lim)
+        self.kind = kind
+
+        if kind == "beta":
+            self.params1 = fit_beta(self.scores1)
+            self.params2 = fit_beta(self.scores2)
+            logger.info(f"Fitted Beta{self.params1} to the scores of model 1 and Beta{self.params2} to model 2.")
+
+    def sample(self, rng: np.random.Generator, shape: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """Draws scores of both models of the given shape, e.g. (replicates, sequences, batch size)."""
+        if self.kind == "empirical":
+            indices = rng.integers(0, len(self.scores1), size=shape)
+            return self.scores1[indices], self.scores2[indices]
+        return rng.beta(*self.params1, size=shape), rng.beta(*self.params2, size=shape)
+
+    def exchanged(self, random_seed: int = 0) -> "ScoreModel":
+        """
+        Null version of the model: the scores of both models are swapped in a random half of the pairs, so that both
+        models have the same score distribution, but as many observed pairs as this model.
+        """
+        swap = np.random.default_rng(random_seed).random(len(self.scores1)) < 0.5
+        return ScoreModel(
+            np.where(swap, self.scores2, self.scores1), np.where(swap, self.scores1, self.scores2), kind=self.kind
+        )
+
+
+def split_null_replicates(
+    num_scores: int, num_replicates: int, replicate_size: int, rng: np.random.Generator
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices of null replicates of a single model: every replicate draws twice replicate_size scores without
+    replacement and splits them into two halves, so that both "models" are exchangeable. If the model has too few
+    scores for that, they are drawn with replacement.
+    """
+    replace = 2 * replicate_size > num_scores
+    indices = np.stack([rng.choice(num_scores, 2 * replicate_size, replace=replace) for _ in range(num_replicates)])
+    return indices[:, :replicate_size], indices[:, replicate_size:]
+
+
+class NullScoreModel:
+    """
+    Null model built from the scores of a single model, in place of two generation seeds of the same model, see
+    split_null_replicates.
+
+    Args:
+        scores: scores of the model
+        lower_lim: lower limit of the metric
+        upper_lim: upper limit of the metric
+    """
+
+    def __init__(self, scores, lower_lim: float = 0.0, upper_lim: float = 1.0):
+        scores = np.asarray(scores, dtype=float)
+        self.scores = normalize_scores(scores[~np.isnan(scores)], lower_lim, upper_lim)
+
+    def sample(self, rng: np.random.Generator, shape: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """Draws scores of both halves of the given shape, e.g. (replicates, sequences, batch size)."""
+        indices1, indices2 = split_null_replicates(len(self.scores), shape[0], int(np.prod(shape[1:])), rng)
+        return self.scores[indices1].reshape(shape), self.scores[indices2].reshape(shape)
+
+
+def betting_log_wealth(
+    scores1: np.ndarray,
+    scores2: np.ndarray,
+    num_bins: int = 20,
+    epsilon: float = 0,
+    T: int = 0,
+    bet_fractions: Tuple[float, ...] = DEFAULT_BET_FRACTIONS,
+) -> np.ndarray:
+    """
+    Log-wealth of the betting test for many replicates at once.
+
+    The betting network of OfflineTrainer is replaced by a witness that is constant on num_bins bins of the scores: at
+    sequence k it is (n1 - n2) / (n1 + n2 + 1), with n1 and n2 the counts of the scores of both models in the batches
+    0, ..., k - 1, and it bets the fraction of the wealth that maximizes the log-wealth on batch k - 1. Like CMLP, the
+    betting score of batch k is prod(1 + fraction * (w(x) - w(y)) / 2) * exp(-epsilon * batch size), and like the
+    trainer, the first batch is only tested (here, without betting) and the wealth is the product of the betting
+    scores from sequence T on.
+
+    Args:
+        scores1: scores of model 1 in [0, 1], of shape (replicates, sequences, batch size)
+        scores2: scores of model 2 in [0, 1], of the same shape
+
+    Returns:
+        Log-wealth after every sequence, of shape (replicates, sequences)
+    """
+    num_replicates, num_sequences, batch_size = scores1.shape
+    bins1 = np.minimum((scores1 * num_bins).astype(int), num_bins - 1)
+    bins2 = np.minimum((scores2 * num_bins).astype(int), num_bins - 1)
+
+    # counts per replicate, sequence and bin, in one bincount over the flattened bin indices
+    offsets = (np.arange(num_replicates * num_sequences) * num_bins).reshape(num_replicates, num_sequences, 1)
+    size = num_replicates * num_sequences * num_bins
+    counts1 = np.bincount((bins1 + offsets).ravel(), minlength=size).reshape(num_replicates, num_sequences, num_bins)
+    counts2 = np.bincount((bins2 + offsets).ravel(), minlength=size).reshape(num_replicates, num_sequences, num_bins)
+
+    # the witness of sequence k (k >= 1) is fitted on the batches 0, ..., k - 1
+    cum_counts1 = np.cumsum(counts1, axis=1)[:, :-1]
+    cum_counts2 = np.cumsum(counts2, axis=1)[:, :-1]
+    witness = (cum_counts1 - cum_counts2) / (cum_counts1 + cum_counts2 + 1)
+
+    def witness_difference(batch_bins1, batch_bins2):
+        return np.take_along_axis(witness, batch_bins1, axis=2) - np.take_along_axis(witness, batch_bins2, axis=2)
+
+    fit_difference = witness_difference(bins1[:, :-1], bins2[:, :-1])
+    test_difference = witness_difference(bins1[:, 1:], bins2[:, 1:])
+
+    # the bet fraction is chosen on the last training batch, like the early stopping of the trainer on its
+    # validation loss
+    fit_log_wealth = np.stack(
+        [np.log1p(0.5 * fraction * fit_difference).sum(axis=2) for fraction in bet_fractions], axis=-1
+    )
+    fractions = np.asarray(bet_fractions)[np.argmax(fit_log_wealth, axis=-1)]
+
+    log_betting_scores = np.full((num_replicates, num_sequences), -epsilon * batch_size, dtype=float)
+    log_betting_scores[:, 1:] += np.log1p(0.5 * fractions[..., None] * test_difference).sum(axis=2)
+    log_betting_scores[:, :T] = 0
+
+    return np.cumsum(log_betting_scores, axis=1)
+
+
+def summarize_simulated_folds(log_wealth: np.ndarray, alpha: float = 0.05) -> pd.DataFrame:
+    """
+    Per-fold summary of simulated tests in the format of summarize_folds: a replicate stops at the first sequence at
+    which its wealth exceeds 1 / alpha.
+    """
+    num_replicates, num_sequences = log_wealth.shape
+    rejected = log_wealth > np.log(1.0 / alpha)
+    test_positive = rejected.any(axis=1)
+    stop_sequence = np.where(test_positive, rejected.argmax(axis=1), np.nan)
+    last_sequence = np.where(test_positive, stop_sequence, num_sequences - 1).astype(int)
+
+    return pd.DataFrame(
+        {
+            "fold_number": np.arange(num_replicates),
+            "last_sequence": last_sequence,
+            "stop_sequence": stop_sequence,
+            "final_wealth": np.exp(log_wealth[np.arange(num_replicates), last_sequence]),
+            "test_positive": test_positive.astype(int),
+        }
+    )
+
+
+def simulate_betting_tests(
+    score_model: Union[ScoreModel, NullScoreModel],
+    fold_size: int,
+    batch_size: int,
+    num_replicates: int = 2000,
+    seqs: int = 60,
+    alpha: float = 0.05,
+    epsilon: float = 0,
+    T: int = 0,
+    num_bins: int = 20,
+    random_seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Simulates num_replicates folds of kfold_davtt with fold_size samples, tested in batches of batch_size for at
+    most seqs sequences.
+
+    Returns:
+        Per-fold summary in the format of summarize_folds
+    """
+    rng = np.random.default_rng(random_seed)
+    num_sequences = min(seqs, (fold_size + batch_size - 1) // batch_size)
+    chunk_size = max(1, MAX_CHUNK_SCORES // (num_sequences * batch_size))
+
+    log_wealth = []
+    for start in range(0, num_replicates, chunk_size):
+        scores1, scores2 = score_model.sample(rng, (min(chunk_size, num_replicates - start), num_sequences, batch_size))
+        log_wealth.append(betting_log_wealth(scores1, scores2, num_bins=num_bins, epsilon=epsilon, T=T))
+
+    return summarize_simulated_folds(np.concatenate(log_wealth), alpha=alpha)
+
+
+def simulate_power(
+    score_model: ScoreModel,
+    fold_sizes: List[int],
+    batch_sizes: List[int],
+    num_replicates: int = 2000,
+    seqs: int = 60,
+    alpha: float = 0.05,
+    epsilon: float = 0,
+    T: int = 0,
+    num_bins: int = 20,
+    random_seed: int = 0,
+    num_null_models: int = 10,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Predicts the power of the test for a grid of fold and batch sizes.
+
+    The prediction has two known biases, measured against the test with the betting network on synthetic Beta pairs
+    (see src/benchmark/simulation_check.py):
+    - It is biased upward when the fold size approaches the number of observed pairs: the simulated folds are drawn
+      from the observed scores, whose sampling noise is a difference between the models of its own. E.g. two samples
+      of 4000 scores of Beta(2, 8) get a predicted power of 0.06, 0.12 and 0.3 at fold sizes 1000, 2000 and 4000
+      (alpha 0.05), where the test rejects at most 4% of the folds. The summary therefore also contains the mean
+      predicted power of num_null_models exchanged score models (see ScoreModel.exchanged), which have no
+      difference between the models but the same number of observed pairs: a predicted power close to it is an
+      artifact of the observed sample.
+    - The binned witness is a weaker bettor than the network, so small differences are underestimated, e.g. 0.19 and
+      0.48 instead of 0.3 and 0.65 at fold sizes 1000 and 2000 for Beta(2, 8) vs Beta(2.2, 8). With the "beta" score
+      model, which has no resampling bias, this is the only bias (0.13 and 0.32).
+    Large differences (e.g. Beta(2.5, 8)) are predicted correctly by both score models.
+
+    Returns:
+        Power over sequences in the format of get_power_over_sequences_from_whole_ds, with an additional column
+        "Batch Size", and a summary with one row per fold and batch size: the power at the end of the fold, the
+        expected number of samples until rejection (of the rejecting folds), the expected number of samples a fold
+        uses and the power of the exchanged score models
+    """
+    # the replicates are split between the exchanged models, so that the null power costs as much as the power
+    null_models = [score_model.exchanged(random_seed + k) for k in range(num_null_models)]
+    num_null_replicates = max(1, num_replicates // max(1, num_null_models))
+    sim_kwargs = dict(
+        seqs=seqs,
+        alpha=alpha,
+        epsilon=epsilon,
+        T=T,
+        num_bins=num_bins,
+    )
+
+    power_dfs = []
+    summary = []
+    for fold_size in fold_sizes:
+        for batch_size in batch_sizes:
+            if batch_size > fold_size:
+                logger.warning(f"Skipping batch size {batch_size}, which is larger than the fold size {fold_size}.")
+                continue
+
+            folds = simulate_betting_tests(
+                score_model, fold_size, batch_size, num_replicates=num_replicates, random_seed=random_seed, **sim_kwargs
+            )
+            null_powers = [
+                simulate_betting_tests(
+                    null_model,
+                    fold_size,
+                    batch_size,
+                    num_replicates=num_null_replicates,
+                    random_seed=random_seed + k,
+                    **sim_kwargs,
+                )["test_positive"].mean()
+                for k, null_model in enumerate(null_models)
+            ]
+
+            power_df = power_curve_from_folds(folds, fold_size, batch_size)
+            power_df["Batch Size"] = batch_size
+            power_dfs.append(power_df)
+
+            samples_until_stop = (folds["stop_sequence"] + 1) * batch_size
+            summary.append(
+                {
+                    "fold_size": fold_size,
+                    "batch_size": batch_size,
+                    "num_sequences": min(seqs, (fold_size + batch_size - 1) // batch_size),
+                    "power": folds["test_positive"].mean(),
+                    "expected_samples_to_rejection": samples_until_stop.mean(),
+                    "expected_samples": ((folds["last_sequence"] + 1) * batch_size).mean(),
+                    "null_power": np.mean(null_powers) if null_powers else np.nan,
+                    "num_replicates": num_replicates,
+                }
+            )
+
+    return pd.concat(power_dfs, ignore_index=True), pd.DataFrame(summary)
+
+
+def clopper_pearson(count: np.ndarray, num_trials: int, confidence: float = 0.95) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact binomial confidence interval of the rate count / num_trials."""
+    count = np.asarray(count, dtype=float)
+    tail = (1 - confidence) / 2
+    with np.errstate(invalid="ignore"):
+        lower = stats.beta.ppf(tail, count, num_trials - count + 1)
+        upper = stats.beta.ppf(1 - tail, count + 1, num_trials - count)
+    return np.where(count == 0, 0.0, lower), np.where(count == num_trials, 1.0, upper)
+
+
+def simulate_alpha(
+    null_model: NullScoreModel,
+    fold_size: int,
+    batch_size: int,
+    num_replicates: int = 2000,
+    seqs: int = 60,
+    alpha: float = 0.05,
+    epsilon: float = 0,
+    T: int = 0,
+    num_bins: int = 20,
+    confidence: float = 0.95,
+    random_seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Proportion of triggered tests of the simulated proxy bettor (see betting_log_wealth) on null replicates of a
+    single model. Its bets are fixed before each batch is seen, so by Ville's inequality it triggers in at most alpha
+    of the replicates: this is a sanity check of the simulation, not an estimate of the type-I error of the test with
+    the trained betting network, see network_alpha.
+
+    Returns:
+        The proportion of triggered tests over sequences in the format of get_alpha_wrapper ("Power"), with its
+        Clopper-Pearson confidence interval in "Alpha Lower" and "Alpha Upper"
+    """
+    if 2 * fold_size > len(null_model.scores):
+        logger.warning(
+            f"{len(null_model.scores)} scores are too few for null replicates of fold size {fold_size} without "
+            f"replacement; drawing them with replacement."
+        )
+
+    folds = simulate_betting_tests(
+        null_model,
+        fold_size,
+        batch_size,
+        num_replicates=num_replicates,
+        seqs=seqs,
+        alpha=alpha,
+        epsilon=epsilon,
+        T=T,
+        num_bins=num_bins,
+        random_seed=random_seed,
+    )
+
+    alpha_df = power_curve_from_folds(folds, fold_size, batch_size)
+    alpha_df["Alpha Lower"], alpha_df["Alpha Upper"] = clopper_pearson(alpha_df["Count"], num_replicates, confidence)
+    alpha_df["Bettor"] = "proxy"
+    return alpha_df
+
+
+def get_null_replicates(
+    scores, fold_size: int, num_replicates: int, random_seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Scores of the two halves of every null replicate of a single model, see split_null_replicates."""
+    scores = np.asarray(scores, dtype=float)
+    scores = scores[~np.isnan(scores)]
+    if 2 * fold_size > len(scores):
+        logger.warning(
+            f"{len(scores)} scores are too few for null replicates of fold size {fold_size} without replacement; "
+            f"drawing them with replacement."
+        )
+
+    rng = np.random.default_rng(random_seed)
+    indices1, indices2 = split_null_replicates(len(scores), num_replicates, fold_size, rng)
+    return scores[indices1], scores[indices2]
+
+
+def write_null_folds(
+    scores,
+    directory: Union[str, Path],
+    fold_size: int,
+    num_replicates: int,
+    metric: str = "perspective",
+    only_continuations: bool = True,
+    random_seed: int = 0,
+):
+    """
+    Writes one fold file per null replicate of a single model (see get_null_replicates) to directory, in the format
+    of create_folds, so that kfold_davtt tests every replicate as one fold.
+    """
+    scores1, scores2 = get_null_replicates(scores, fold_size, num_replicates, random_seed=random_seed)
+
+    cont_string = "continuation_" if only_continuations else ""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for fold_num in range(num_replicates):
+        fold_data = {
+            "metadata1": {"null_replicate": fold_num},
+            "metadata2": {"null_replicate": fold_num},
+            f"{metric}_scores1": scores1[fold_num].tolist(),
+            f"{metric}_scores2": scores2[fold_num].tolist(),
+        }
+        with open(directory / f"{cont_string}scores_fold_{fold_num}.json", "w") as f:
+            json.dump(fold_data, f)
+
+
+def network_alpha(
+    cfg: Dict,
+    train_cfg,
+    scores,
+    model_name: str,
+    seed: str,
+    fold_size: int,
+    num_replicates: int = 200,
+    confidence: float = 0.95,
+    random_seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Empirical type-I error of the test over sequences: every null replicate of the model is tested as one fold with
+    the betting network. With the fixed batch schedule, all replicates are tested at once by BatchedOfflineTrainer.
+    The folds of the adaptive schedule test different batches, so they are tested one after the other by kfold_davtt
+    in {dir_prefix}/null_calibration, apart from the results of real model pairs.
+
+    Returns:
+        The proportion of triggered tests over sequences in the format of get_alpha_wrapper ("Power" is the empirical
+        alpha), with its Clopper-Pearson confidence interval in "Alpha Lower" and "Alpha Upper"
+    """
+    if train_cfg.batch_schedule == "fixed":
+        from src.test.batched_trainer import BatchedOfflineTrainer
+
+        scores1, scores2 = get_null_replicates(scores, fold_size, num_replicates, random_seed=random_seed)
+        folds = BatchedOfflineTrainer(train_cfg, cfg["net"], scores1, scores2, epsilon=cfg.get("epsilon", 0)).train()
+        alpha_df = power_curve_from_folds(folds, fold_size, train_cfg.batch_size)
+    else:
+        alpha_df = kfold_null_alpha(cfg, train_cfg, scores, model_name, seed, fold_size, num_replicates, random_seed)
+
+    alpha_df["Alpha Lower"], alpha_df["Alpha Upper"] = clopper_pearson(alpha_df["Count"], num_replicates, confidence)
+    alpha_df["Bettor"] = "network"
+    return alpha_df
+
+
+def kfold_null_alpha(
+    cfg: Dict,
+    train_cfg,
+    scores,
+    model_name: str,
+    seed: str,
+    fold_size: int,
+    num_replicates: int,
+    random_seed: int = 0,
+) -> pd.DataFrame:
+    """Tests every null replicate as one fold of kfold_davtt and returns the power curve of the run."""
+    from src.test.test import AuditingTest
+
+    metric = cfg["metric"]["metric"]
+    only_continuations = cfg["test_params"]["only_continuations"]
+    epsilon = cfg.get("epsilon", 0)
+    dir_prefix = str(ROOT_DIR / cfg["dir_prefix"] / "null_calibration")
+
+    # the scores already contain the noise of the config, if any
+    job_cfg = deepcopy(cfg)
+    job_cfg["epsilon"] = epsilon
+    job_cfg["test_params"]["fold_size"] = fold_size
+    job_cfg["test_params"]["noise"] = 0
+
+    test = AuditingTest(
+        job_cfg, train_cfg, dir_prefix, overwrite=True, use_wandb=False, only_continuations=only_continuations
+    )
+    write_null_folds(
+        scores,
+        test.test_dir / f"{model_name}_{seed}_{model_name}_{seed}",
+        fold_size,
+        num_replicates,
+        metric=metric,
+        only_continuations=only_continuations,
+        random_seed=random_seed,
+    )
+    test.run(model_name, seed, model_name, seed, fold_size=fold_size, analyze_distance=False, create_folds=False)
+
+    key = ResultsStore.make_key(
+        metric,
+        model_name,
+        seed,
+        model_name,
+        seed,
+        fold_size,
+        epsilon=epsilon,
+        only_continuations=only_continuations,
+        schedule=get_schedule_suffix(train_cfg),
+    )
+    return get_results_store(dir_prefix, metric=metric).get_power_curve(key)
+
+
+def load_model_scores(
+    model_name: str,
+    seed: str,
+    metric: str = "perspective",
+    score_dir: Union[str, Path] = "model_scores",
+    only_continuations: bool = True,
+    noise: float = 0,
+) -> List[float]:
+    """Scores of a model, as written by evaluate_single_model."""
+    cont_string = "continuation_" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+
+    data = load_score_file(Path(score_dir) / f"{model_name}_{seed}" / f"{cont_string}scores{noise_string}.json")
+    return data[f"{metric}_scores"]
+
+
+def load_pair_scores(
+    model_name1: str,
+    seed1: str,
+    model_name2: str,
+    seed2: str,
+    metric: str = "perspective",
+    score_dir: Union[str, Path] = "model_scores",
+    only_continuations: bool = True,
+    noise: float = 0,
+) -> Tuple[List[float], List[float]]:
+    """Scores of both models of a pair, as written by evaluate_single_model."""
+    return (
+        load_model_scores(model_name1, seed1, metric, score_dir, only_continuations, noise),
+        load_model_scores(model_name2, seed2, metric, score_dir, only_continuations, noise),
+    )
+
+
+def run_power_simulation(cfg: Dict, train_cfg) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Predicts power and samples to rejection of the pair tau1/tau2 for the fold and batch sizes of the simulation
+    section of the config, and saves both tables to the test directory of the pair.
+    """
+    sim_cfg = cfg.get("simulation") or {}
+    model_name1, seed1 = cfg["tau1"]["model_id"], cfg["tau1"]["gen_seed"]
+    model_name2, seed2 = cfg["tau2"]["model_id"], cfg["tau2"]["gen_seed"]
+    metric = cfg["metric"]["metric"]
+    only_continuations = cfg["test_params"]["only_continuations"]
+    noise = cfg["test_params"].get("noise", 0)
+
+    scores1, scores2 = load_pair_scores(
+        model_name1,
+        seed1,
+        model_name2,
+        seed2,
+        metric=metric,
+        score_dir=ROOT_DIR / cfg["dir_prefix"] / "model_scores",
+        only_continuations=only_continuations,
+        noise=noise,
+    )
+    score_model = ScoreModel(
+        scores1,
+        scores2,
+        kind=sim_cfg.get("score_model", "empirical"),
+        lower_lim=cfg["metric"].get("lower_lim", 0.0),
+        upper_lim=cfg["metric"].get("upper_lim", 1.0),
+    )
+
+    power_df, summary_df = simulate_power(
+        score_model,
+        sim_cfg.get("fold_sizes") or [cfg["test_params"]["fold_size"]],
+        sim_cfg.get("batch_sizes") or [train_cfg.batch_size],
+        num_replicates=sim_cfg.get("num_replicates", 2000),
+        seqs=sim_cfg.get("seqs") or train_cfg.seqs,
+        alpha=train_cfg.alpha,
+        epsilon=cfg.get("epsilon", 0),
+        T=train_cfg.T,
+        num_bins=sim_cfg.get("num_bins", 20),
+        random_seed=sim_cfg.get("random_seed", 0),
+        num_null_models=sim_cfg.get("num_null_models", 10),
+    )
+
+    cont_string = "_continuations" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+    out_dir = ROOT_DIR / cfg["dir_prefix"] / "test_outputs" / f"{model_name1}_{seed1}_{model_name2}_{seed2}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    power_df.to_csv(out_dir / f"simulated_power{cont_string}{noise_string}.csv", index=False)
+    summary_df.to_csv(out_dir / f"simulated_power_summary{cont_string}{noise_string}.csv", index=False)
+
+    logger.info(
+        f"Simulated power of {model_name1}_{seed1} vs {model_name2}_{seed2}:\n{summary_df.to_string(index=False)}"
+    )
+    biased = summary_df[summary_df["null_power"] > train_cfg.alpha]
+    if len(biased):
+        logger.warning(
+            f"With {len(score_model.scores1)} scored pairs, the simulation predicts a power above alpha even for "
+            f"models without a difference (null_power) at fold sizes {sorted(set(biased['fold_size']))}; the "
+            f"predicted power of these fold sizes is biased upward, see simulate_power."
+        )
+
+    return power_df, summary_df
+
+
+def run_null_calibration(cfg: Dict, train_cfg) -> pd.DataFrame:
+    """
+    Estimates the type-I error over sequences of every model of the null_calibration section of the config (tau1 by
+    default) from null replicates of its own scores, and saves it to {dir_prefix}/test_outputs. With bettor: network
+    (default) the replicates are tested with the betting network, see network_alpha; bettor: proxy only runs the
+    sanity check of the simulated proxy bettor, see simulate_alpha.
+    """
+    null_cfg = cfg.get("null_calibration") or {}
+    models = null_cfg.get("models") or [{"model_id": cfg["tau1"]["model_id"], "gen_seed": cfg["tau1"]["gen_seed"]}]
+    metric = cfg["metric"]["metric"]
+    only_continuations = cfg["test_params"]["only_continuations"]
+    noise = cfg["test_params"].get("noise", 0)
+    fold_size = null_cfg.get("fold_size") or cfg["test_params"]["fold_size"]
+    bettor = null_cfg.get("bettor", "network")
+    if bettor not in ("network", "proxy"):
+        raise ValueError(f"Unknown bettor {bettor} of the null calibration, expected network or proxy.")
+    if null_cfg.get("batch_size"):
+        train_cfg = replace(train_cfg, batch_size=null_cfg["batch_size"])
+
+    alpha_dfs = []
+    for model in models:
+        scores = load_model_scores(
+            model["model_id"],
+            model["gen_seed"],
+            metric=metric,
+            score_dir=ROOT_DIR / cfg["dir_prefix"] / "model_scores",
+            only_continuations=only_continuations,
+            noise=noise,
+        )
+        if bettor == "network":
+            alpha_df = network_alpha(
+                cfg,
+                train_cfg,
+                scores,
+                model["model_id"],
+                model["gen_seed"],
+                fold_size,
+                num_replicates=null_cfg.get("num_replicates", 200),
+                confidence=null_cfg.get("confidence", 0.95),
+                random_seed=null_cfg.get("random_seed", 0),
+            )
+        else:
+            null_model = NullScoreModel(
+                scores, lower_lim=cfg["metric"].get("lower_lim", 0.0), upper_lim=cfg["metric"].get("upper_lim", 1.0)
+            )
+            alpha_df = simulate_alpha(
+                null_model,
+                fold_size,
+                train_cfg.batch_size,
+                num_replicates=null_cfg.get("num_replicates", 2000),
+                seqs=train_cfg.seqs,
+                alpha=train_cfg.alpha,
+                epsilon=cfg.get("epsilon", 0),
+                T=train_cfg.T,
+                num_bins=null_cfg.get("num_bins", 20),
+                confidence=null_cfg.get("confidence", 0.95),
+                random_seed=null_cfg.get("random_seed", 0),
+            )
+        alpha_df["model_id"] = model["model_id"]
+        alpha_df["seed"] = model["gen_seed"]
+        alpha_dfs.append(alpha_df)
+
+        final = alpha_df.iloc[-1]
+        label = "Empirical alpha" if bettor == "network" else "Proportion of triggered proxy tests"
+        logger.info(
+            f"{label} of {model['model_id']}_{model['gen_seed']} after {final['Samples']} samples: "
+            f"{final['Power']:.4f} ({final['Alpha Lower']:.4f}, {final['Alpha Upper']:.4f})."
+        )
+        if bettor == "network" and final["Alpha Lower"] > train_cfg.alpha:
+            logger.warning(
+                f"The type-I error of {model['model_id']}_{model['gen_seed']} exceeds alpha = {train_cfg.alpha}."
+            )
+
+    result_df = pd.concat(alpha_dfs, ignore_index=True)
+
+    cont_string = "_continuations" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+    out_dir = ROOT_DIR / cfg["dir_prefix"] / "test_outputs"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    bettor_string = "_proxy" if bettor == "proxy" else ""
+    schedule_string = get_schedule_suffix(train_cfg) if bettor == "network" else ""
+    result_df.to_csv(
+        out_dir / f"null_calibration{bettor_string}{cont_string}_{fold_size}{noise_string}{schedule_string}.csv",
+        index=False,
+    )
+
+    if null_cfg.get("plot", False):
+        from src.analysis.plot import plot_alpha_over_sequences
+
+        plot_alpha_over_sequences(
+            [model["model_id"] for model in models],
+            [model["gen_seed"] for model in models],
+            None,
+            fold_size=fold_size,
+            epsilon=cfg.get("epsilon", 0),
+            only_continuations=only_continuations,
+            dir_prefix=cfg["dir_prefix"],
+            metric=metric,
+            noise=noise,
+            result_df=result_df,
+        )
+
+    return result_df
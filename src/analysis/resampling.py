@@ -0,0 +1,108 @@
+import logging
+import numpy as np
+import sys
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union, List, Tuple
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RunSplit:
+    """
+    Test and train indices of a single run. The train indices are drawn for the largest training set size; the
+    training set of size k is the first k of them, so that all training set sizes of a run are nested.
+    """
+
+    run: int
+    test_indices: np.ndarray
+    train_indices: np.ndarray
+
+    def get_train_indices(self, num_train_samples: int) -> np.ndarray:
+        """ """
+        return self.train_indices[:num_train_samples]
+
+
+class ResamplingPlan:
+    """
+    Draws the random train/test splits of all runs up front as integer index arrays.
+
+    The draws of run r only depend on random_seed + r, so a run can be reproduced on its own. The test set is drawn
+    first, then the training set from the remaining indices.
+    """
+
+    def __init__(
+        self,
+        num_scores: int,
+        num_test_samples: int,
+        num_train_samples: Union[int, List[int]],
+        num_runs: int = 1,
+        random_seed: int = 0,
+    ):
+        """
+        Args:
+            num_scores: number of (paired) scores to split
+            num_test_samples: size of the test set of each run
+            num_train_samples: training set size(s); the train indices are drawn for the largest one
+            num_runs: number of runs
+            random_seed: run r uses np.random.default_rng(random_seed + r)
+        """
+        if num_test_samples > num_scores:
+            raise ValueError(f"Cannot draw {num_test_samples} test samples from {num_scores} scores.")
+
+        if not isinstance(num_train_samples, list):
+            num_train_samples = [num_train_samples]
+
+        self.num_scores = num_scores
+        self.num_test_samples = num_test_samples
+        self.num_runs = num_runs
+        self.random_seed = random_seed
+
+        self.max_num_train_samples = max(num_train_samples)
+        if self.max_num_train_samples > num_scores - num_test_samples:
+            logger.warning(
+                f"Number of train samples {self.max_num_train_samples} is greater than the number of available samples {num_scores - num_test_samples}. We are training on all available samples."
+            )
+            self.max_num_train_samples = num_scores - num_test_samples
+
+        self.splits = [self.draw_split(run) for run in range(num_runs)]
+
+    def draw_split(self, run: int) -> RunSplit:
+        """ """
+        rng = np.random.default_rng(self.random_seed + run)
+        test_indices = rng.choice(self.num_scores, self.num_test_samples, replace=False)
+
+        train_mask = np.ones(self.num_scores, dtype=bool)
+        train_mask[test_indices] = False
+        train_pool = np.flatnonzero(train_mask)
+
+        train_indices = train_pool[rng.choice(len(train_pool), self.max_num_train_samples, replace=False)]
+
+        return RunSplit(run=run, test_indices=test_indices, train_indices=train_indices)
+
+    def get_num_train_samples(self, num_train_samples: int) -> int:
+        """Caps the training set size at the number of scores that are not in the test set."""
+        return min(num_train_samples, self.max_num_train_samples)
+
+    def gather(self, scores1: np.ndarray, scores2: np.ndarray, run: int) -> Tuple[np.ndarray, ...]:
+        """
+        Gathers the train and test scores of a run with one indexing operation per array. Training sets of smaller
+        size can be taken as prefix views of the returned train scores without copying.
+
+        Returns:
+            train_scores1, train_scores2, test_scores1, test_scores2
+        """
+        split = self.splits[run]
+        return (
+            scores1[split.train_indices],
+            scores2[split.train_indices],
+            scores1[split.test_indices],
+            scores2[split.test_indices],
+        )
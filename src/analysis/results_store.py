@@ -0,0 +1,432 @@
+import logging
+import numpy as np
+import os
+import pandas as pd
+import re
+import sqlite3
+import sys
+
+from contextlib import closing
+from dataclasses import fields
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Dict, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# columns that identify a test run
+RUN_KEY = [
+    "metric",
+    "model_name1",
+    "seed1",
+    "model_name2",
+    "seed2",
+    "fold_size",
+    "epsilon",
+    "noise",
+    "only_continuations",
+    "schedule",
+]
+RUN_KEY_CONDITION = " AND ".join(f"{col} = ?" for col in RUN_KEY)
+
+RUNS_TABLE = """
+CREATE TABLE IF NOT EXISTS {name} (
+    run_id INTEGER PRIMARY KEY,
+    metric TEXT NOT NULL,
+    model_name1 TEXT NOT NULL,
+    seed1 TEXT NOT NULL,
+    model_name2 TEXT NOT NULL,
+    seed2 TEXT NOT NULL,
+    fold_size INTEGER NOT NULL,
+    epsilon REAL NOT NULL,
+    noise REAL NOT NULL,
+    only_continuations INTEGER NOT NULL,
+    schedule TEXT NOT NULL DEFAULT '',
+    batch_size INTEGER NOT NULL,
+    source_file TEXT,
+    source_mtime REAL,
+    updated TEXT,
+    UNIQUE (metric, model_name1, seed1, model_name2, seed2, fold_size, epsilon, noise, only_continuations, schedule)
+);
+"""
+SCHEMA = (
+    RUNS_TABLE.format(name="runs")
+    + """
+CREATE TABLE IF NOT EXISTS folds (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    fold_number INTEGER NOT NULL,
+    last_sequence INTEGER NOT NULL,
+    stop_sequence INTEGER,
+    final_wealth REAL,
+    test_positive INTEGER NOT NULL,
+    futility_stop INTEGER NOT NULL DEFAULT 0,
+    scored_samples INTEGER,
+    PRIMARY KEY (run_id, fold_number)
+);
+"""
+)
+
+# short names of the TrainCfg fields that change the test run, see get_schedule_suffix
+SCHEDULE_SUFFIXES = {
+    "batch_schedule": "schedule",
+    "min_batch_size": "minbs",
+    "max_batch_size": "maxbs",
+    "futility_patience": "futility",
+}
+
+# e.g. kfold_test_results_continuations_2000_epsilon_0.05_noise_0.1_schedule_adaptive.csv
+RESULTS_FILE_PATTERN = re.compile(
+    r"kfold_test_results(?P<continuations>_continuations)?(?:_(?P<fold_size>\d+))?_epsilon_(?P<epsilon>[^_]+?)"
+    r"(?:_noise_(?P<noise>[^_]+))?(?P<schedule>(?:_(?:" + "|".join(SCHEDULE_SUFFIXES.values()) + r")_[^_]+)*)\.csv"
+)
+# e.g. Meta-Llama-3-8B-Instruct_seed1000_Llama-3-8B-ckpt1_seed2000
+RUN_DIR_PATTERN = re.compile(r"(?P<model_name1>.+)_(?P<seed1>seed\d+)_(?P<model_name2>.+)_(?P<seed2>seed\d+)")
+
+
+def get_schedule_suffix(train_cfg) -> str:
+    """
+    Suffix of the result files and store key of a test run for the fields of SCHEDULE_SUFFIXES that differ from their
+    defaults, e.g. "_schedule_adaptive_maxbs_200"; empty if all of them have their default, so that the results of
+    earlier runs keep their names.
+    """
+    return "".join(
+        f"_{SCHEDULE_SUFFIXES[field.name]}_{getattr(train_cfg, field.name)}"
+        for field in fields(train_cfg)
+        if field.name in SCHEDULE_SUFFIXES and getattr(train_cfg, field.name) != field.default
+    )
+
+
+def is_adaptive_schedule(schedule: str) -> bool:
+    """Whether the suffix of get_schedule_suffix belongs to a run with the adaptive batch schedule."""
+    return f"_{SCHEDULE_SUFFIXES['batch_schedule']}_adaptive" in schedule
+
+
+def summarize_folds(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduces the per-epoch rows of kfold_davtt to one row per fold: the last sequence of the fold, the sequence at
+    which the test stopped (nan if it did not), the final wealth, whether the test was positive and whether the fold
+    stopped for futility, and, for results that record it, the number of scored samples the fold tested.
+    """
+    filtered_df = data.drop_duplicates(subset=["sequence", "fold_number"]).dropna(subset=["fold_number"])
+    filtered_df = filtered_df.sort_values(["fold_number", "sequence"], kind="stable")
+
+    stopped = filtered_df[filtered_df["sequences_until_end_of_experiment"] == filtered_df["sequence"]]
+    grouped = filtered_df.groupby("fold_number")
+
+    summary = pd.DataFrame(
+        {
+            "last_sequence": grouped["sequence"].max(),
+            "stop_sequence": stopped.groupby("fold_number")["sequence"].min(),
+            "final_wealth": grouped["wealth"].last(),
+            "test_positive": grouped["test_positive"].max(),
+            "futility_stop": grouped["futility_stop"].max() if "futility_stop" in filtered_df.columns else 0,
+        }
+    )
+    if "scored_samples" in filtered_df.columns:
+        summary["scored_samples"] = grouped["scored_samples"].max()
+    summary.index = summary.index.astype(int)
+    return summary.rename_axis("fold_number").reset_index()
+
+
+def power_curve_from_folds(
+    folds: pd.DataFrame, fold_size: int, batch_size: int, keep_all_data: bool = False, adaptive: bool = False
+) -> pd.DataFrame:
+    """
+    Power over sequences from the per-fold summary, with the same output as get_power_over_sequences_from_whole_ds.
+
+    A fold is still running at every sequence up to its last one, except at the sequence where it stopped. The
+    number of running folds is a cumulative sum over the fold starts and ends. Folds that stopped for futility did
+    not reject, so they count as running until the end. For the adaptive schedule, see adaptive_power_curve.
+    """
+    if adaptive:
+        return adaptive_power_curve(folds, fold_size, batch_size, keep_all_data=keep_all_data)
+
+    max_sequences = (fold_size + batch_size - 1) // batch_size
+    num_folds = len(folds)
+
+    last_sequence = folds["last_sequence"].to_numpy().astype(int)
+    if "futility_stop" in folds.columns:
+        last_sequence = np.where(folds["futility_stop"].to_numpy() == 1, max_sequences - 1, last_sequence)
+    stop_sequence = folds["stop_sequence"].to_numpy(dtype=float)
+
+    # +1 at sequence 0 and -1 after the last sequence of every fold
+    ends = np.bincount(np.clip(last_sequence + 1, 0, max_sequences), minlength=max_sequences + 1)
+    running = num_folds - np.cumsum(ends)[:max_sequences]
+
+    has_stopped = ~np.isnan(stop_sequence)
+    stops = stop_sequence[has_stopped].astype(int)
+    stopped = np.bincount(stops[(stops >= 0) & (stops < max_sequences)], minlength=max_sequences)
+    running = running - stopped
+
+    result_df = pd.DataFrame(
+        {
+            "Sequence": np.arange(max_sequences),
+            "Count": num_folds - running,
+        }
+    )
+    result_df["Power"] = result_df["Count"] / num_folds
+    result_df["Samples per Test"] = fold_size
+    result_df["Samples"] = result_df["Sequence"] * batch_size
+
+    if keep_all_data:
+        result_df["Stopped"] = stopped
+        result_df["Num Folds"] = num_folds
+
+    return result_df
+
+
+def adaptive_power_curve(
+    folds: pd.DataFrame, fold_size: int, batch_size: int, keep_all_data: bool = False
+) -> pd.DataFrame:
+    """
+    Power over the number of scored samples for runs with the adaptive batch schedule, whose sequences test different
+    numbers of samples and may outnumber the fixed batches of a fold. "Sequence" only indexes the points of the sample
+    axis, which are batch_size apart and cover the whole fold. A fold that rejected after s scored samples counts from
+    the point ceil(s / batch_size) - 1, the same convention as power_curve_from_folds, where a fold that rejected in
+    sequence k (after (k + 1) * batch_size scored samples) counts from Samples = k * batch_size; runs whose adaptive
+    batches all had batch_size samples get the same curve as fixed runs.
+    """
+    num_folds = len(folds)
+    if "scored_samples" not in folds.columns or folds["scored_samples"].isna().all():
+        raise ValueError("Power curves of the adaptive schedule need the scored_samples of every fold.")
+
+    scored_samples = folds["scored_samples"].to_numpy(dtype=float)
+    rejected = ~np.isnan(folds["stop_sequence"].to_numpy(dtype=float)) & ~np.isnan(scored_samples)
+    num_points = int(np.ceil(max(fold_size, np.nanmax(scored_samples)) / batch_size))
+
+    stop_points = np.maximum(np.ceil(scored_samples[rejected] / batch_size).astype(int) - 1, 0)
+    stopped = np.bincount(stop_points, minlength=num_points)
+
+    result_df = pd.DataFrame(
+        {
+            "Sequence": np.arange(num_points),
+            "Count": np.cumsum(stopped),
+        }
+    )
+    result_df["Power"] = result_df["Count"] / num_folds
+    result_df["Samples per Test"] = fold_size
+    result_df["Samples"] = result_df["Sequence"] * batch_size
+
+    if keep_all_data:
+        result_df["Stopped"] = stopped
+        result_df["Num Folds"] = num_folds
+
+    return result_df
+
+
+class ResultsStore:
+    """
+    SQLite store of the results of kfold_davtt, one database per metric directory. For every run (model pair, seeds,
+    fold size, epsilon, noise, batch schedule) it records the per-fold stopping sequence and final wealth, which is all
+    the power curves need, so analysis and plotting do not have to re-read the per-epoch csv files.
+    """
+
+    def __init__(self, db_path: Union[str, Path]):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+            # stores created before the schedule was part of the run key need the new unique constraint
+            if "schedule" not in [row[1] for row in conn.execute("PRAGMA table_info(runs)")]:
+                self.add_schedule_to_runs(conn)
+            # stores created before futility stopping and the adaptive schedule lack the columns
+            fold_columns = [row[1] for row in conn.execute("PRAGMA table_info(folds)")]
+            if "futility_stop" not in fold_columns:
+                conn.execute("ALTER TABLE folds ADD COLUMN futility_stop INTEGER NOT NULL DEFAULT 0")
+            if "scored_samples" not in fold_columns:
+                conn.execute("ALTER TABLE folds ADD COLUMN scored_samples INTEGER")
+            conn.commit()
+
+    @staticmethod
+    def add_schedule_to_runs(conn: sqlite3.Connection):
+        """Rebuilds the runs table with the schedule column; the folds keep pointing to the same run ids."""
+        columns = ["run_id", *RUN_KEY[:-1], "batch_size", "source_file", "source_mtime", "updated"]
+        conn.execute("PRAGMA foreign_keys = OFF")
+        conn.executescript(
+            "BEGIN;"
+            + RUNS_TABLE.format(name="runs_new")
+            + f"INSERT INTO runs_new ({', '.join(columns)}) SELECT {', '.join(columns)} FROM runs;"
+            "DROP TABLE runs;"
+            "ALTER TABLE runs_new RENAME TO runs;"
+            "COMMIT;"
+        )
+        conn.execute("PRAGMA foreign_keys = ON")
+
+    def connect(self) -> sqlite3.Connection:
+        """ """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    @staticmethod
+    def make_key(
+        metric: str,
+        model_name1: str,
+        seed1: str,
+        model_name2: str,
+        seed2: str,
+        fold_size: int,
+        epsilon: float = 0,
+        noise: float = 0,
+        only_continuations: bool = True,
+        schedule: str = "",
+    ) -> Dict:
+        """schedule is the suffix of get_schedule_suffix."""
+        return {
+            "metric": metric,
+            "model_name1": model_name1,
+            "seed1": str(seed1),
+            "model_name2": model_name2,
+            "seed2": str(seed2),
+            "fold_size": int(fold_size),
+            "epsilon": float(epsilon),
+            "noise": float(noise),
+            "only_continuations": int(only_continuations),
+            "schedule": schedule,
+        }
+
+    def add_run(self, key: Dict, data: pd.DataFrame, source_file: Optional[Union[str, Path]] = None):
+        """Records the results of a run, replacing earlier results of the same run."""
+        folds = summarize_folds(data)
+        if "scored_samples" not in folds.columns:
+            folds["scored_samples"] = np.nan
+        source_mtime = os.stat(source_file).st_mtime if source_file and Path(source_file).exists() else None
+
+        with closing(self.connect()) as conn, conn:
+            conn.execute(f"DELETE FROM runs WHERE {RUN_KEY_CONDITION}", [key[col] for col in RUN_KEY])
+            cursor = conn.execute(
+                f"INSERT INTO runs ({', '.join(RUN_KEY)}, batch_size, source_file, source_mtime, updated) "
+                f"VALUES ({', '.join('?' * (len(RUN_KEY) + 4))})",
+                [
+                    *[key[col] for col in RUN_KEY],
+                    int(data.loc[0, "samples"]),
+                    str(source_file) if source_file else None,
+                    source_mtime,
+                    datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+                ],
+            )
+            conn.executemany(
+                "INSERT INTO folds "
+                "(run_id, fold_number, last_sequence, stop_sequence, final_wealth, test_positive, futility_stop, "
+                "scored_samples) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        cursor.lastrowid,
+                        int(row.fold_number),
+                        int(row.last_sequence),
+                        None if pd.isna(row.stop_sequence) else int(row.stop_sequence),
+                        None if pd.isna(row.final_wealth) else float(row.final_wealth),
+                        int(row.test_positive),
+                        int(row.futility_stop),
+                        None if pd.isna(row.scored_samples) else int(row.scored_samples),
+                    )
+                    for row in folds.itertuples(index=False)
+                ],
+            )
+
+        logger.info(
+            f"Recorded {len(folds)} folds of {key['model_name1']}_{key['seed1']}_{key['model_name2']}_{key['seed2']}."
+        )
+
+    def get_run(self, key: Dict) -> Optional[Dict]:
+        """Returns the run row (including batch_size and source file) or None if the run is not in the store."""
+        with closing(self.connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                f"SELECT * FROM runs WHERE {RUN_KEY_CONDITION}", [key[col] for col in RUN_KEY]
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_folds(self, key: Dict) -> Optional[pd.DataFrame]:
+        """Per-fold results of a run, or None if the run is not in the store."""
+        run = self.get_run(key)
+        if run is None:
+            return None
+        with closing(self.connect()) as conn:
+            return pd.read_sql_query(
+                "SELECT fold_number, last_sequence, stop_sequence, final_wealth, test_positive, futility_stop, "
+                "scored_samples FROM folds WHERE run_id = ? ORDER BY fold_number",
+                conn,
+                params=(run["run_id"],),
+            )
+
+    def get_power_curve(self, key: Dict, keep_all_data: bool = False) -> Optional[pd.DataFrame]:
+        """
+        Power over sequences of a run, or None if the run is not in the store. Runs with the adaptive schedule get
+        their power over scored samples, see adaptive_power_curve.
+        """
+        run = self.get_run(key)
+        if run is None:
+            return None
+        return power_curve_from_folds(
+            self.get_folds(key),
+            run["fold_size"],
+            run["batch_size"],
+            keep_all_data=keep_all_data,
+            adaptive=is_adaptive_schedule(run["schedule"]),
+        )
+
+    def get_runs(self, **filters) -> pd.DataFrame:
+        """
+        All runs matching the filters (columns of RUN_KEY), with their number of folds, positive rate and rate of
+        folds that stopped for futility.
+        """
+        conditions = " AND ".join(f"r.{col} = ?" for col in filters) or "1"
+        with closing(self.connect()) as conn:
+            return pd.read_sql_query(
+                "SELECT r.*, COUNT(f.fold_number) AS num_folds, AVG(f.test_positive) AS positive_rate, "
+                "AVG(f.futility_stop) AS futility_rate "
+                f"FROM runs r LEFT JOIN folds f ON r.run_id = f.run_id WHERE {conditions} GROUP BY r.run_id",
+                conn,
+                params=list(filters.values()),
+            )
+
+    def import_results(self, test_dir: Union[str, Path], metric: str, overwrite: bool = False) -> int:
+        """
+        Adds the kfold_test_results csv files under test_dir that are not in the store yet (or changed since they
+        were recorded), e.g. results computed before the store existed.
+
+        Returns:
+            Number of imported runs
+        """
+        num_imported = 0
+        for file_path in sorted(Path(test_dir).glob("*/kfold_test_results*.csv")):
+            file_match = RESULTS_FILE_PATTERN.fullmatch(file_path.name)
+            dir_match = RUN_DIR_PATTERN.fullmatch(file_path.parent.name)
+            if not file_match or not dir_match:
+                continue
+
+            key = self.make_key(
+                metric,
+                fold_size=int(file_match["fold_size"] or 4000),
+                epsilon=float(file_match["epsilon"]),
+                noise=float(file_match["noise"] or 0),
+                only_continuations=bool(file_match["continuations"]),
+                schedule=file_match["schedule"],
+                **dir_match.groupdict(),
+            )
+            run = self.get_run(key)
+            if not overwrite and run is not None and run["source_mtime"] == os.stat(file_path).st_mtime:
+                continue
+
+            self.add_run(key, pd.read_csv(file_path), source_file=file_path)
+            num_imported += 1
+
+        logger.info(f"Imported {num_imported} runs from {test_dir} into {self.db_path}.")
+        return num_imported
+
+
+def get_results_store(
+    dir_prefix: Optional[str] = None, test_dir: str = "test_outputs", metric: str = "perspective"
+) -> ResultsStore:
+    """The results store of a metric lives next to the test outputs, in {dir_prefix}/{test_dir}/results.sqlite."""
+    if dir_prefix is None:
+        dir_prefix = metric
+    return ResultsStore(ROOT_DIR / dir_prefix / test_dir / "results.sqlite")
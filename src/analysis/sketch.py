@@ -0,0 +1,264 @@
+import json
+import logging
+import numpy as np
+import os
+import sys
+
+from pathlib import Path
+from typing import Optional, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+
+class TDigest:
+    """
+    Mergeable quantile sketch (merging t-digest) of a score distribution.
+
+    Scores are summarized by at most about compression / 2 weighted centroids, which are small in the tails and large
+    in the middle of the distribution, so extreme quantiles are accurate. Count, mean, std, min and max are tracked
+    exactly. Sketches of different shards or checkpoints can be merged and the result is again a sketch of the union.
+    """
+
+    def __init__(self, compression: int = 200, buffer_size: int = 10000):
+        """
+        Args:
+            compression: controls the number of centroids and thereby the accuracy of the sketch
+            buffer_size: number of scores collected before they are merged into the centroids
+        """
+        self.compression = compression
+        self.buffer_size = buffer_size
+
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.num_buffered = 0
+
+        self.count = 0
+        self.num_nan = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """Adds scores to the sketch; nan scores are counted but otherwise ignored."""
+        values = np.asarray(values, dtype=float).ravel()
+        nan_mask = np.isnan(values)
+        self.num_nan += int(nan_mask.sum())
+        values = values[~nan_mask]
+
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.total += values.sum()
+        self.total_squares += np.square(values).sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        self.buffer.append(values)
+        self.num_buffered += len(values)
+        if self.num_buffered >= self.buffer_size:
+            self.compress()
+
+    def compress(self):
+        """Merges the buffered scores into the centroids."""
+        if not self.buffer:
+            return
+
+        buffered = np.concatenate(self.buffer)
+        self.buffer = []
+        self.num_buffered = 0
+
+        self.merge_centroids(
+            np.concatenate([self.means, buffered]), np.concatenate([self.weights, np.ones(len(buffered))])
+        )
+
+    def merge_centroids(self, means: np.ndarray, weights: np.ndarray):
+        """
+        Replaces the centroids by a compression of the given weighted points. The points are sorted and grouped by
+        the integer part of the scale function k(q) = compression / (2 pi) * arcsin(2q - 1) at their quantile q, so
+        that no centroid spans more than one unit of k.
+        """
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+
+        quantiles = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * quantiles - 1)
+        groups = np.floor(k).astype(int)
+
+        starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+        group_weights = np.add.reduceat(weights, starts)
+        group_means = np.add.reduceat(means * weights, starts) / group_weights
+
+        self.means, self.weights = group_means, group_weights
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        """Returns a new sketch of the union of the scores of both sketches."""
+        merged = TDigest(compression=max(self.compression, other.compression), buffer_size=self.buffer_size)
+        self.compress()
+        other.compress()
+
+        merged.count = self.count + other.count
+        merged.num_nan = self.num_nan + other.num_nan
+        merged.total = self.total + other.total
+        merged.total_squares = self.total_squares + other.total_squares
+        merged.min = min(self.min, other.min)
+        merged.max = max(self.max, other.max)
+
+        if merged.count > 0:
+            merged.merge_centroids(
+                np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights])
+            )
+
+        return merged
+
+    def get_support(self):
+        """Points (quantile level, value) between which the quantile function and the CDF are interpolated."""
+        self.compress()
+        positions = (np.cumsum(self.weights) - self.weights / 2) / self.count
+        return (
+            np.concatenate([[0.0], positions, [1.0]]),
+            np.concatenate([[self.min], self.means, [self.max]]),
+        )
+
+    def quantile(self, q):
+        """Approximate quantile function (inverse CDF) at q."""
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+        positions, values = self.get_support()
+        return np.interp(q, positions, values)
+
+    def cdf(self, x):
+        """Approximate CDF at x."""
+        if self.count == 0:
+            return np.full(np.shape(x), np.nan)
+        positions, values = self.get_support()
+        return np.interp(x, values, positions, left=0.0, right=1.0)
+
+    def mean(self) -> float:
+        """ """
+        return self.total / self.count if self.count else np.nan
+
+    def std(self) -> float:
+        """Population std, like np.std."""
+        if not self.count:
+            return np.nan
+        return np.sqrt(max(self.total_squares / self.count - self.mean() ** 2, 0.0))
+
+    def median(self) -> float:
+        """ """
+        return float(self.quantile(0.5))
+
+    def to_dict(self) -> dict:
+        """ """
+        self.compress()
+        return {
+            "compression": self.compression,
+            "count": self.count,
+            "num_nan": self.num_nan,
+            "total": self.total,
+            "total_squares": self.total_squares,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TDigest":
+        """ """
+        sketch = cls(compression=data["compression"])
+        sketch.count = data["count"]
+        sketch.num_nan = data["num_nan"]
+        sketch.total = data["total"]
+        sketch.total_squares = data["total_squares"]
+        sketch.min = data["min"] if data["min"] is not None else np.inf
+        sketch.max = data["max"] if data["max"] is not None else -np.inf
+        sketch.means = np.asarray(data["means"], dtype=float)
+        sketch.weights = np.asarray(data["weights"], dtype=float)
+        return sketch
+
+    def save(self, path: Union[str, Path], source: Optional[dict] = None):
+        """source identifies the file the sketch was built from, see get_file_signature."""
+        data = self.to_dict()
+        if source is not None:
+            data["source"] = source
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "TDigest":
+        """ """
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+
+def get_sketch_path(score_path: Union[str, Path]) -> Path:
+    """
+    The sketch of a score file is stored next to it, e.g. scores.json -> scores.sketch.json. The name does not match
+    the scores_*.json pattern of intermediate score files, so it survives their cleanup.
+    """
+    score_path = Path(score_path)
+    return score_path.with_name(f"{score_path.stem}.sketch.json")
+
+
+def get_file_signature(path: Union[str, Path]) -> dict:
+    """Size and modification time of a file, which change whenever the file is rewritten."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_score_sketch(sketch: TDigest, score_path: Union[str, Path]):
+    """Saves the sketch of a score file next to it, together with the signature of the score file."""
+    sketch.save(get_sketch_path(score_path), source=get_file_signature(score_path))
+
+
+def load_score_sketch(
+    score_path: Union[str, Path], metric: str = "perspective", compression: int = 200, save: bool = True
+) -> Optional[TDigest]:
+    """
+    Loads the sketch stored next to a score file. If there is none yet (e.g. for scores computed before sketches were
+    introduced), or the score file changed since the sketch was built, it is built from the score file and saved if
+    save. A sketch whose score file was removed is still returned.
+    """
+    sketch_path = get_sketch_path(score_path)
+    score_exists = Path(score_path).exists()
+    if sketch_path.exists():
+        with open(sketch_path, "r") as f:
+            data = json.load(f)
+        if not score_exists or data.get("source") == get_file_signature(score_path):
+            return TDigest.from_dict(data)
+        logger.info(f"Score file {score_path} changed since its sketch was built, rebuilding the sketch.")
+
+    elif not score_exists:
+        logger.error(f"Neither sketch nor score file found at {score_path}.")
+        return None
+
+    with open(score_path, "r") as f:
+        scores = json.load(f)[f"{metric}_scores"]
+
+    sketch = TDigest(compression=compression)
+    sketch.update(scores)
+    if save:
+        save_score_sketch(sketch, score_path)
+        logger.info(f"Saved score sketch to {sketch_path}.")
+
+    return sketch
+
+
+def sketch_wasserstein_distance(sketch1: TDigest, sketch2: TDigest, num_quantiles: int = 1000) -> float:
+    """Approximate W1 distance, i.e. the integral of the absolute difference of the quantile functions."""
+    quantiles = (np.arange(num_quantiles) + 0.5) / num_quantiles
+    return float(np.mean(np.abs(sketch1.quantile(quantiles) - sketch2.quantile(quantiles))))
+
+
+def sketch_ks_distance(sketch1: TDigest, sketch2: TDigest) -> float:
+    """Approximate Kolmogorov-Smirnov distance, evaluated at the centroids of both sketches."""
+    points = np.concatenate([sketch1.get_support()[1], sketch2.get_support()[1]])
+    return float(np.max(np.abs(sketch1.cdf(points) - sketch2.cdf(points))))
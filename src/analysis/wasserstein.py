@@ -0,0 +1,108 @@
+import logging
+import numpy as np
+import sys
+
+from pathlib import Path
+from typing import Optional, Tuple
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+
+def get_quantile_positions(num_samples: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Returns the quantile level of each sorted sample, i.e. the points the empirical quantile function interpolates
+    between.
+
+    Without weights, the k-th sorted sample sits at k / (n - 1), as in empirical_quantile_function. With weights, the
+    k-th sample sits at the midpoint of its cumulative weight, rescaled to [0, 1]; for equal weights this is again
+    k / (n - 1).
+
+    Args:
+        num_samples: number of samples
+        weights: weights of the sorted samples
+    """
+    if num_samples == 1:
+        return np.zeros(1)
+
+    if weights is None:
+        return np.arange(num_samples) / (num_samples - 1)
+
+    midpoints = np.cumsum(weights) - weights / 2
+    return (midpoints - midpoints[0]) / (midpoints[-1] - midpoints[0])
+
+
+def sort_samples(samples, weights=None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Sorts the samples (and their weights) once; samples with zero weight are dropped."""
+    samples = np.asarray(samples, dtype=float)
+
+    if weights is None:
+        return np.sort(samples), None
+
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape != samples.shape:
+        raise ValueError(f"Got {len(weights)} weights for {len(samples)} samples.")
+    if np.any(weights < 0) or not np.any(weights > 0):
+        raise ValueError("Weights must be non-negative and not all zero.")
+
+    keep = weights > 0
+    samples, weights = samples[keep], weights[keep]
+    order = np.argsort(samples, kind="stable")
+    return samples[order], weights[order]
+
+
+def quantile_function(samples, quantiles, weights=None, assume_sorted: bool = False) -> np.ndarray:
+    """
+    Evaluates the empirical quantile function (inverse CDF) of the samples at all quantiles at once, interpolating
+    linearly between the sorted samples. Matches empirical_quantile_function, but sorts only once.
+
+    Args:
+        samples: samples of the distribution
+        quantiles: quantile levels in [0, 1]
+        weights: optional non-negative weights of the samples
+        assume_sorted: whether samples (and weights) are already sorted, e.g. by sort_samples
+    """
+    if not assume_sorted:
+        samples, weights = sort_samples(samples, weights)
+
+    positions = get_quantile_positions(len(samples), weights)
+    return np.interp(quantiles, positions, samples)
+
+
+def wasserstein_p(
+    samples1,
+    samples2,
+    p: float = 2,
+    weights1=None,
+    weights2=None,
+    num_quantiles: Optional[int] = None,
+) -> float:
+    """
+    Vectorized empirical p-Wasserstein distance between two (possibly weighted) samples of possibly different sizes,
+    computed by comparing the quantile functions on an equispaced grid of quantile levels.
+
+    Args:
+        samples1: samples of distribution 1
+        samples2: samples of distribution 2
+        p: order of the distance
+        weights1: optional weights of samples1
+        weights2: optional weights of samples2
+        num_quantiles: size of the quantile grid, defaults to max(n, m)
+    """
+    assert p >= 1, "The order of the Wasserstein distance must be greater than or equal to 1."
+
+    sorted1, weights1 = sort_samples(samples1, weights1)
+    sorted2, weights2 = sort_samples(samples2, weights2)
+
+    if num_quantiles is None:
+        num_quantiles = max(len(sorted1), len(sorted2))
+    quantiles = np.linspace(0, 1, num_quantiles, endpoint=True)
+
+    q1 = quantile_function(sorted1, quantiles, weights1, assume_sorted=True)
+    q2 = quantile_function(sorted2, quantiles, weights2, assume_sorted=True)
+
+    return np.mean(np.abs(q1 - q2) ** p) ** (1 / p)
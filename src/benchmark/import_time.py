@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+from typing import Optional, Dict, List
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# entry points whose startup cost we care about; a test run goes through main -> experiments -> test
+DEFAULT_MODULES = ["main", "src.test.experiments", "src.test.test", "src.evaluation.generate"]
+
+# modules that should not be imported by a test run over precomputed scores
+HEAVY_MODULES = [
+    "transformers",
+    "peft",
+    "datasets",
+    "wandb",
+    "huggingface_hub",
+    "evaluate",
+    "googleapiclient",
+    "matplotlib",
+    "seaborn",
+    "aiohttp",
+]
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """
+    Parses the output of python -X importtime.
+
+    Returns:
+        List of {"module", "self_us", "cumulative_us"} for the top level imports
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        # nested imports are indented, only keep the top level ones
+        if name.startswith("  "):
+            continue
+        imports.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return imports
+
+
+def time_import(module: str, repeats: int = 5) -> Dict:
+    """
+    Imports module in a fresh interpreter repeats times and records the wall time, the slowest top level imports and
+    which heavy modules ended up in sys.modules.
+    """
+    code = (
+        "import json, sys\n"
+        f"import {module}\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+
+    wall_times = []
+    heavy_loaded = []
+    top_imports = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+        )
+        wall_times.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error"
+            logger.error(f"Importing {module} failed: {error}")
+            return {"module": module, "error": error}
+
+        if i == 0:
+            heavy_loaded = json.loads(result.stdout.strip().splitlines()[-1])
+            top_imports = sorted(parse_importtime(result.stderr), key=lambda x: x["cumulative_us"], reverse=True)
+
+    return {
+        "module": module,
+        "median_s": round(statistics.median(wall_times), 3),
+        "min_s": round(min(wall_times), 3),
+        "heavy_modules": heavy_loaded,
+        "top_imports": top_imports[:10],
+    }
+
+
+def run_benchmark(modules: Optional[List[str]] = None, repeats: int = 5, output: Optional[str] = None) -> List[Dict]:
+    """
+    Measures the startup cost of the entry points.
+
+    Args:
+        modules: modules to import; defaults to DEFAULT_MODULES
+        repeats: number of fresh interpreters per module
+        output: optional path of a json file to save the results to
+    """
+    modules = modules if modules else DEFAULT_MODULES
+    results = [time_import(module, repeats=repeats) for module in modules]
+
+    for res in results:
+        if "error" in res:
+            continue
+        logger.info(
+            f"{res['module']}: median {res['median_s']}s, min {res['min_s']}s, "
+            f"heavy modules: {', '.join(res['heavy_modules']) if res['heavy_modules'] else 'none'}"
+        )
+        for imp in res["top_imports"][:5]:
+            logger.info(f"    {imp['module']}: {round(imp['cumulative_us'] / 1e6, 3)}s")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+        logger.info(f"Import time results saved to {output}.")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time of the entry points.")
+    parser.add_argument("modules", nargs="*", help="modules to import, defaults to the main entry points")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    run_benchmark(args.modules, repeats=args.repeats, output=args.output)
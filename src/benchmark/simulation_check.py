@@ -0,0 +1,188 @@
+import argparse
+import dataclasses
+import logging
+import numpy as np
+import pandas as pd
+import sys
+import tempfile
+
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Dict, List, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from arguments import TrainCfg
+from src.benchmark.suite import get_environment, load_base_config
+from src.benchmark.synthetic import create_synthetic_pair
+from src.utils.utils import create_run_string
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+DEFAULT_CHECK_CFG = {
+    "pilot_size": 4000,  # observed score pairs per model that the simulation is given
+    "beta_params1": (2.0, 8.0),  # scores of model 1 ~ Beta(a, b) ...
+    "beta_params2": [(2.0, 8.0), (2.2, 8.0), (2.5, 8.0)],  # ... and of model 2; (2, 8) is a null pair
+    "fold_sizes": [1000, 2000, 4000],
+    "num_folds": 100,  # folds of the network test per pair and fold size
+    "num_replicates": 2000,  # simulated folds per pair and fold size
+    "random_seed": 0,
+    "train_cfg": {},  # overrides of TrainCfg, e.g. {"epochs": 20}
+}
+
+
+def check_pair(cfg: Dict, train_cfg, dir_prefix: Path, params2, check_cfg: Dict) -> List[Dict]:
+    """
+    Predicts the power of one synthetic pair with the simulation, from a pilot sample of the pair, and measures the
+    power of the test with the betting network on fresh folds of the same pair.
+    """
+    from src.analysis.power_simulation import ScoreModel, clopper_pearson, load_pair_scores, simulate_power
+    from src.test.batched_trainer import BatchedOfflineTrainer
+
+    metric = cfg["metric"]["metric"]
+    fold_sizes = check_cfg["fold_sizes"]
+    num_folds = check_cfg["num_folds"]
+    random_seed = check_cfg["random_seed"]
+
+    def get_scores(name: str, num_samples: int, seed: int):
+        pair = create_synthetic_pair(
+            dir_prefix / name,
+            num_samples,
+            params1=tuple(check_cfg["beta_params1"]),
+            params2=tuple(params2),
+            metric=metric,
+            random_seed=seed,
+        )
+        scores = load_pair_scores(
+            *[pair[key] for key in ["model_name1", "seed1", "model_name2", "seed2"]],
+            metric=metric,
+            score_dir=dir_prefix / name / "model_scores",
+        )
+        return pair, np.asarray(scores[0]), np.asarray(scores[1])
+
+    pair, pilot1, pilot2 = get_scores("pilot", check_cfg["pilot_size"], random_seed)
+    # the network is tested on new samples of the pair, like a test run after the pilot
+    _, test1, test2 = get_scores("test", num_folds * max(fold_sizes), random_seed + 2)
+
+    simulated = {}
+    for kind in ["empirical", "beta"]:
+        _, summary_df = simulate_power(
+            ScoreModel(pilot1, pilot2, kind=kind),
+            fold_sizes,
+            [train_cfg.batch_size],
+            num_replicates=check_cfg["num_replicates"],
+            seqs=train_cfg.seqs,
+            alpha=train_cfg.alpha,
+            T=train_cfg.T,
+            random_seed=random_seed,
+        )
+        simulated[kind] = summary_df.set_index("fold_size")
+
+    records = []
+    for fold_size in fold_sizes:
+        num_samples = num_folds * fold_size
+        folds = BatchedOfflineTrainer(
+            train_cfg,
+            cfg["net"],
+            test1[:num_samples].reshape(num_folds, fold_size),
+            test2[:num_samples].reshape(num_folds, fold_size),
+        ).train()
+        num_positive = int(folds["test_positive"].sum())
+        lower, upper = clopper_pearson(num_positive, num_folds)
+
+        records.append(
+            {
+                "beta_params2": tuple(params2),
+                "w1_distance": pair["w1_distance"],
+                "fold_size": fold_size,
+                "network_power": num_positive / num_folds,
+                "network_lower": float(lower),
+                "network_upper": float(upper),
+                "simulated_power": float(simulated["empirical"].loc[fold_size, "power"]),
+                "simulated_null_power": float(simulated["empirical"].loc[fold_size, "null_power"]),
+                "beta_simulated_power": float(simulated["beta"].loc[fold_size, "power"]),
+                "beta_simulated_null_power": float(simulated["beta"].loc[fold_size, "null_power"]),
+            }
+        )
+        logger.info(f"Beta{tuple(params2)}, fold size {fold_size}: {records[-1]}")
+
+    return records
+
+
+def run_simulation_check(
+    check_cfg: Optional[Dict] = None,
+    cfg: Optional[Dict] = None,
+    train_cfg: Optional[TrainCfg] = None,
+    output: Optional[Union[str, Path]] = None,
+) -> pd.DataFrame:
+    """
+    Compares the power predicted by the power simulation (see src/analysis/power_simulation.py) with the power of
+    the test with the fixed batch schedule on synthetic pairs of Beta distributed scores. The simulation gets a
+    pilot sample of pilot_size pairs, the test num_folds folds of new samples per fold size, which are tested at
+    once by BatchedOfflineTrainer. Runs on cpu without network access or wandb.
+
+    Args:
+        check_cfg: overrides of DEFAULT_CHECK_CFG
+        cfg: experiment config with the net and metric settings; defaults to configs/config.yaml
+        train_cfg: defaults to TrainCfg(), with the overrides in check_cfg["train_cfg"]
+        output: results file; defaults to benchmark_results/simulation_check_{commit}_{run}.csv
+
+    Returns:
+        Dataframe with one row per pair and fold size
+    """
+    check_cfg = {**DEFAULT_CHECK_CFG, **(check_cfg or {})}
+    cfg = deepcopy(cfg) if cfg is not None else load_base_config()
+    train_cfg = dataclasses.replace(train_cfg or TrainCfg(), **check_cfg["train_cfg"])
+
+    records = []
+    with tempfile.TemporaryDirectory(prefix="audit_simulation_check_") as tmp_dir:
+        for params2 in check_cfg["beta_params2"]:
+            records.extend(check_pair(cfg, train_cfg, Path(tmp_dir), params2, check_cfg))
+
+    results_df = pd.DataFrame(records)
+    logger.info(f"Simulated vs network power:\n{results_df.round(3).to_string(index=False)}")
+
+    if output is None:
+        commit = (get_environment()["commit"] or "unknown")[:8]
+        output = ROOT_DIR / "benchmark_results" / f"simulation_check_{commit}_{create_run_string()}.csv"
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    results_df.to_csv(output, index=False)
+    logger.info(f"Simulation check saved to {output}.")
+
+    return results_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the power simulation with the test on synthetic scores.")
+    parser.add_argument("--pilot-size", type=int, default=DEFAULT_CHECK_CFG["pilot_size"])
+    parser.add_argument(
+        "--beta-a2",
+        type=float,
+        nargs="+",
+        default=[params[0] for params in DEFAULT_CHECK_CFG["beta_params2"]],
+        help="first parameter of the Beta distribution of model 2, for every pair",
+    )
+    parser.add_argument("--fold-sizes", type=int, nargs="+", default=DEFAULT_CHECK_CFG["fold_sizes"])
+    parser.add_argument("--num-folds", type=int, default=DEFAULT_CHECK_CFG["num_folds"])
+    parser.add_argument("--num-replicates", type=int, default=DEFAULT_CHECK_CFG["num_replicates"])
+    parser.add_argument("--epochs", type=int, default=None, help="overrides TrainCfg.epochs")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    run_simulation_check(
+        {
+            "pilot_size": args.pilot_size,
+            "beta_params2": [(a2, DEFAULT_CHECK_CFG["beta_params1"][1]) for a2 in args.beta_a2],
+            "fold_sizes": args.fold_sizes,
+            "num_folds": args.num_folds,
+            "num_replicates": args.num_replicates,
+            "train_cfg": {"epochs": args.epochs} if args.epochs else {},
+        },
+        output=args.output,
+    )
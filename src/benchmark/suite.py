@@ -0,0 +1,363 @@
+import argparse
+import dataclasses
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Callable, Dict, List, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from arguments import TrainCfg
+from src.benchmark.synthetic import create_synthetic_pair
+from src.utils.utils import create_run_string
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# columns that identify a benchmark case when comparing results files
+CASE_COLUMNS = ["benchmark", "dataset_size", "num_folds", "fold_size"]
+
+DEFAULT_BENCHMARK_CFG = {
+    "dataset_sizes": [4000, 16000],  # number of synthetic score pairs
+    "num_folds": [2, 8],  # every dataset size is split into each number of folds
+    "beta_params1": (2.0, 8.0),  # scores of model 1 ~ Beta(a, b) ...
+    "beta_params2": (2.5, 8.0),  # ... and of model 2
+    "random_seed": 0,
+    "repeats": 3,  # repeats of the fast benchmarks (fold preparation, power curves)
+    "test_repeats": 1,  # repeats of the slow benchmarks (test, calibration sweep, distance)
+    "epsilons": [0.0, 0.01, 0.02],  # epsilons of the calibration sweep; empty to skip it
+    "distance_num_runs": 2,  # runs of the distance benchmark; 0 to skip it
+    "train_cfg": {},  # overrides of TrainCfg, e.g. {"epochs": 20}
+}
+
+
+def time_repeats(func: Callable[[], None], repeats: int = 1, setup: Optional[Callable[[], None]] = None) -> Dict:
+    """Runs func repeats times (after the untimed setup) and returns min, median, mean and max duration in seconds."""
+    durations = []
+    for _ in range(max(1, repeats)):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "repeats": len(durations),
+        "min_s": float(np.min(durations)),
+        "median_s": float(np.median(durations)),
+        "mean_s": float(np.mean(durations)),
+        "max_s": float(np.max(durations)),
+    }
+
+
+def get_environment() -> Dict:
+    """Commit and software/hardware versions, stored with the results so that runs can be matched up."""
+    import torch
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=ROOT_DIR,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.is_available(),
+    }
+
+
+def benchmark_case(
+    cfg: Dict, train_cfg, dir_prefix: Path, pair: Dict, dataset_size: int, num_folds: int, bench_cfg: Dict
+) -> List[Dict]:
+    """
+    Times fold preparation, the test of all folds, the power-curve analysis of its results, the calibration sweep
+    over bench_cfg["epsilons"] and the distance runs for one dataset size and number of folds.
+    """
+    from src.analysis.analyze import get_distance_scores, get_power_over_sequences_from_whole_ds
+    from src.analysis.results_store import power_curve_from_folds, summarize_folds
+    from src.test.preprocessing import create_folds_from_evaluations
+    from src.test.test import AuditingTest, get_num_train_samples
+
+    metric = cfg["metric"]["metric"]
+    fold_size = dataset_size // num_folds
+    repeats = bench_cfg["repeats"]
+    test_repeats = bench_cfg["test_repeats"]
+    case = {"dataset_size": dataset_size, "num_folds": num_folds, "fold_size": fold_size}
+    pair_names = {key: pair[key] for key in ["model_name1", "seed1", "model_name2", "seed2"]}
+
+    job_cfg = deepcopy(cfg)
+    job_cfg["test_params"]["fold_size"] = fold_size
+    job_cfg["epsilon"] = 0
+
+    def get_test(epsilon: float = 0) -> AuditingTest:
+        job_cfg["epsilon"] = epsilon
+        return AuditingTest(job_cfg, train_cfg, str(dir_prefix), overwrite=True, use_wandb=False)
+
+    def prepare_folds():
+        create_folds_from_evaluations(
+            **pair_names,
+            metric=metric,
+            fold_size=fold_size,
+            overwrite=True,
+            score_dir=dir_prefix / "model_scores",
+            test_dir=dir_prefix / "test_outputs",
+        )
+
+    records = []
+
+    def add_record(benchmark: str, timing: Dict, **extra):
+        records.append({"benchmark": benchmark, **case, **timing, **extra})
+        logger.info(f"{benchmark} ({dataset_size} samples, {num_folds} folds): {round(timing['median_s'], 3)} s")
+
+    add_record("fold_preparation", time_repeats(prepare_folds, repeats))
+
+    test = get_test()
+    powers = []
+    test_timing = time_repeats(
+        lambda: powers.append(
+            test.run(**pair_names, fold_size=fold_size, analyze_distance=False, create_folds=False)
+        ),
+        test_repeats,
+        setup=prepare_folds,
+    )
+    add_record("test", test_timing, per_fold_s=test_timing["median_s"] / num_folds, power=powers[-1])
+
+    results_files = sorted(Path(test.directory).glob(f"kfold_test_results*_{fold_size}_epsilon_0*.csv"))
+    data = pd.read_csv(results_files[0])
+    add_record(
+        "power_curve_from_results",
+        time_repeats(lambda: get_power_over_sequences_from_whole_ds(data, fold_size), repeats),
+    )
+    add_record(
+        "power_curve_from_folds",
+        time_repeats(
+            lambda: power_curve_from_folds(summarize_folds(data), fold_size, int(data.loc[0, "samples"])), repeats
+        ),
+    )
+
+    epsilons = bench_cfg["epsilons"]
+    if epsilons:
+
+        def calibration_sweep():
+            for epsilon in epsilons:
+                get_test(epsilon).run(**pair_names, fold_size=fold_size, analyze_distance=False)
+
+        add_record(
+            "calibration_sweep", time_repeats(calibration_sweep, test_repeats), num_epsilons=len(epsilons)
+        )
+
+    num_runs = bench_cfg["distance_num_runs"]
+    if num_runs:
+        num_train_samples = get_num_train_samples(cfg, train_cfg, fold_size)
+        add_record(
+            "distance",
+            time_repeats(
+                lambda: get_distance_scores(
+                    pair["model_name1"],
+                    pair["seed1"],
+                    pair["seed2"],
+                    model_name2=pair["model_name2"],
+                    metric=metric,
+                    num_runs=num_runs,
+                    net_cfg=cfg["net"],
+                    train_cfg=train_cfg,
+                    num_samples=[train_cfg.batch_size, num_train_samples],
+                    num_test_samples=train_cfg.batch_size,
+                    dir_prefix=str(dir_prefix),
+                    use_cache=False,
+                ),
+                test_repeats,
+            ),
+            num_runs=num_runs,
+            w1_distance=pair["w1_distance"],
+        )
+
+    return records
+
+
+def load_base_config() -> Dict:
+    """The default config (configs/config.yaml), which provides the net, analysis and metric settings."""
+    from omegaconf import OmegaConf
+
+    cfg = OmegaConf.to_container(OmegaConf.load(ROOT_DIR / "configs" / "config.yaml"), resolve=True)
+    cfg.setdefault("test_params", {"only_continuations": True, "fold_size": 2000, "noise": 0})
+    cfg["logging"]["use_wandb"] = False
+    return cfg
+
+
+def run_benchmarks(
+    bench_cfg: Optional[Dict] = None,
+    cfg: Optional[Dict] = None,
+    train_cfg: Optional[TrainCfg] = None,
+    output: Optional[Union[str, Path]] = None,
+    compare_to: Optional[Union[str, Path]] = None,
+    threshold: float = 0.1,
+) -> pd.DataFrame:
+    """
+    Runs the benchmark suite on synthetic Beta distributed scores with a known W1 distance, written to a temporary
+    dir_prefix tree, for every size in dataset_sizes and every number of folds in num_folds. Runs on cpu without
+    network access or wandb.
+
+    Args:
+        bench_cfg: overrides of DEFAULT_BENCHMARK_CFG
+        cfg: experiment config with the net, analysis and metric settings; defaults to configs/config.yaml
+        train_cfg: defaults to TrainCfg(), with the overrides in bench_cfg["train_cfg"]
+        output: results file; defaults to benchmark_results/benchmark_{commit}_{run}.json
+        compare_to: results file of an earlier run to compare against, see compare_benchmarks
+        threshold: relative change that counts as a regression or improvement
+
+    Returns:
+        Dataframe with one row per benchmark and case
+    """
+    bench_cfg = {**DEFAULT_BENCHMARK_CFG, **(bench_cfg or {})}
+    cfg = deepcopy(cfg) if cfg is not None else load_base_config()
+    cfg["logging"]["use_wandb"] = False
+    train_cfg = dataclasses.replace(train_cfg or TrainCfg(), **bench_cfg["train_cfg"])
+
+    records = []
+    with tempfile.TemporaryDirectory(prefix="audit_benchmark_") as tmp_dir:
+        dir_prefix = Path(tmp_dir)
+        for dataset_size in bench_cfg["dataset_sizes"]:
+            pair = create_synthetic_pair(
+                dir_prefix,
+                dataset_size,
+                params1=tuple(bench_cfg["beta_params1"]),
+                params2=tuple(bench_cfg["beta_params2"]),
+                metric=cfg["metric"]["metric"],
+                random_seed=bench_cfg["random_seed"],
+            )
+            for num_folds in bench_cfg["num_folds"]:
+                records.extend(benchmark_case(cfg, train_cfg, dir_prefix, pair, dataset_size, num_folds, bench_cfg))
+
+    results_df = pd.DataFrame(records)
+    logger.info(f"Benchmark results:\n{results_df[CASE_COLUMNS + ['median_s']].to_string(index=False)}")
+
+    environment = get_environment()
+    if output is None:
+        commit = (environment["commit"] or "unknown")[:8]
+        output = ROOT_DIR / "benchmark_results" / f"benchmark_{commit}_{create_run_string()}.json"
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    save_results(results_df, output, environment, bench_cfg, train_cfg)
+    logger.info(f"Benchmark results saved to {output}.")
+
+    if compare_to:
+        compare_benchmarks(compare_to, output, threshold=threshold)
+
+    return results_df
+
+
+def save_results(
+    results_df: pd.DataFrame, output_path: Union[str, Path], environment: Dict, bench_cfg: Dict, train_cfg
+):
+    """ """
+    from src.analysis.distance_cache import to_serializable
+
+    with open(output_path, "w") as f:
+        json.dump(
+            {
+                "environment": environment,
+                "config": to_serializable({"benchmark": bench_cfg, "train_cfg": train_cfg}),
+                # benchmarks have different extra columns, which are left out where they do not apply
+                "results": [
+                    {key: value for key, value in record.items() if not pd.isna(value)}
+                    for record in results_df.to_dict(orient="records")
+                ],
+            },
+            f,
+            indent=4,
+        )
+
+
+def load_results(results_path: Union[str, Path]) -> pd.DataFrame:
+    """ """
+    with open(results_path, "r") as f:
+        return pd.DataFrame(json.load(f)["results"])
+
+
+def compare_benchmarks(
+    baseline_path: Union[str, Path], current_path: Union[str, Path], threshold: float = 0.1
+) -> pd.DataFrame:
+    """
+    Compares the median durations of two results files case by case. A case is a regression if it got slower by more
+    than threshold (relative), and an improvement if it got faster by more than threshold.
+
+    Returns:
+        Dataframe with the case columns, baseline_s, current_s, ratio (current / baseline) and change
+    """
+    baseline_df = load_results(baseline_path)[CASE_COLUMNS + ["median_s"]]
+    current_df = load_results(current_path)[CASE_COLUMNS + ["median_s"]]
+
+    comparison_df = baseline_df.merge(current_df, on=CASE_COLUMNS, suffixes=("_baseline", "_current"))
+    comparison_df = comparison_df.rename(columns={"median_s_baseline": "baseline_s", "median_s_current": "current_s"})
+    comparison_df["ratio"] = comparison_df["current_s"] / comparison_df["baseline_s"]
+    comparison_df["change"] = np.select(
+        [comparison_df["ratio"] > 1 + threshold, comparison_df["ratio"] < 1 - threshold],
+        ["regression", "improvement"],
+        default="",
+    )
+
+    logger.info(f"Comparison with {baseline_path}:\n{comparison_df.round(3).to_string(index=False)}")
+    return comparison_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the test engine and the analysis on synthetic scores.")
+    parser.add_argument("--dataset-sizes", type=int, nargs="+", default=DEFAULT_BENCHMARK_CFG["dataset_sizes"])
+    parser.add_argument("--num-folds", type=int, nargs="+", default=DEFAULT_BENCHMARK_CFG["num_folds"])
+    parser.add_argument("--repeats", type=int, default=DEFAULT_BENCHMARK_CFG["repeats"])
+    parser.add_argument("--test-repeats", type=int, default=DEFAULT_BENCHMARK_CFG["test_repeats"])
+    parser.add_argument("--epsilons", type=float, nargs="*", default=DEFAULT_BENCHMARK_CFG["epsilons"])
+    parser.add_argument("--distance-runs", type=int, default=DEFAULT_BENCHMARK_CFG["distance_num_runs"])
+    parser.add_argument("--epochs", type=int, default=None, help="overrides TrainCfg.epochs")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare-to", type=str, default=None, help="results file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    run_benchmarks(
+        {
+            "dataset_sizes": args.dataset_sizes,
+            "num_folds": args.num_folds,
+            "repeats": args.repeats,
+            "test_repeats": args.test_repeats,
+            "epsilons": args.epsilons,
+            "distance_num_runs": args.distance_runs,
+            "train_cfg": {"epochs": args.epochs} if args.epochs else {},
+        },
+        output=args.output,
+        compare_to=args.compare_to,
+        threshold=args.threshold,
+    )
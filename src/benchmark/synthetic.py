@@ -0,0 +1,81 @@
+import json
+import numpy as np
+import sys
+
+from pathlib import Path
+from scipy.integrate import trapezoid
+from scipy.stats import beta
+from typing import Dict, Tuple, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+
+def beta_w1_distance(params1: Tuple[float, float], params2: Tuple[float, float], num_points: int = 100001) -> float:
+    """Wasserstein-1 distance between two Beta distributions, the integral of |F1 - F2| over [0, 1]."""
+    x = np.linspace(0, 1, num_points)
+    return float(trapezoid(np.abs(beta.cdf(x, *params1) - beta.cdf(x, *params2)), x))
+
+
+def write_synthetic_scores(
+    dir_prefix: Union[str, Path],
+    model_name: str,
+    seed: str,
+    params: Tuple[float, float],
+    num_samples: int,
+    metric: str = "perspective",
+    random_seed: int = 0,
+    only_continuations: bool = True,
+) -> Path:
+    """
+    Writes num_samples Beta(a, b) distributed scores in the format of evaluate_single_model, to
+    {dir_prefix}/model_scores/{model_name}_{seed}/.
+
+    Returns:
+        Path of the score file
+    """
+    rng = np.random.default_rng(random_seed)
+    scores = rng.beta(*params, size=num_samples)
+
+    cont_string = "continuation_" if only_continuations else ""
+    score_path = Path(dir_prefix) / "model_scores" / f"{model_name}_{seed}" / f"{cont_string}scores.json"
+    score_path.parent.mkdir(parents=True, exist_ok=True)
+
+    metadata = {"model_id": model_name, "gen_seed": seed, "metric": metric, "synthetic": {"beta_params": params}}
+    with open(score_path, "w") as f:
+        json.dump({"metadata": metadata, f"{metric}_scores": scores.tolist()}, f)
+
+    return score_path
+
+
+def create_synthetic_pair(
+    dir_prefix: Union[str, Path],
+    num_samples: int,
+    params1: Tuple[float, float] = (2.0, 8.0),
+    params2: Tuple[float, float] = (2.5, 8.0),
+    metric: str = "perspective",
+    random_seed: int = 0,
+) -> Dict:
+    """
+    Writes the scores of a synthetic model pair whose score distributions are shifted by a known amount.
+
+    Returns:
+        Dict with the model names and seeds of the pair (as used by AuditingTest.run) and its W1 distance
+    """
+    pair = {
+        "model_name1": f"synthetic-beta-{params1[0]}-{params1[1]}",
+        "seed1": "seed1000",
+        "model_name2": f"synthetic-beta-{params2[0]}-{params2[1]}",
+        "seed2": "seed2000",
+    }
+    write_synthetic_scores(
+        dir_prefix, pair["model_name1"], pair["seed1"], params1, num_samples, metric, random_seed=random_seed
+    )
+    write_synthetic_scores(
+        dir_prefix, pair["model_name2"], pair["seed2"], params2, num_samples, metric, random_seed=random_seed + 1
+    )
+    pair["w1_distance"] = beta_w1_distance(params1, params2)
+
+    return pair
@@ -0,0 +1,429 @@
+import aiohttp
+import asyncio
+import json
+import logging
+import os
+import secrets
+
+from abc import ABC, abstractmethod
+from multiprocessing.connection import Client
+from os import getenv
+from pathlib import Path
+from typing import Optional, Dict, List, Iterator, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = getenv("OPENAI_API_KEY", None)
+
+# the model server unpickles the jobs it receives, so only clients of the same user may connect: the socket lives in
+# a private directory and clients authenticate with MODEL_SERVER_AUTHKEY or a random key the server writes next to it
+MODEL_SERVER_AUTHKEY_ENV = "MODEL_SERVER_AUTHKEY"
+MODEL_SERVER_KEY_FILE = "model_server.key"
+
+# status codes after which a request is retried
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def get_default_model_server_address() -> str:
+    """Socket in $XDG_RUNTIME_DIR/auditing_test, or in ~/.cache/auditing_test if XDG_RUNTIME_DIR is not set."""
+    runtime_dir = getenv("XDG_RUNTIME_DIR")
+    base_dir = Path(runtime_dir) if runtime_dir else Path.home() / ".cache"
+    return str(base_dir / "auditing_test" / "model_server.sock")
+
+
+def ensure_private_dir(path: Union[str, Path]) -> Path:
+    """Creates the directory with mode 0700 and refuses existing directories that other users can access."""
+    path = Path(path)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    stat = path.stat()
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise PermissionError(
+            f"{path} must be owned by the current user and not be accessible to other users (chmod 700 {path})."
+        )
+    return path
+
+
+def create_model_server_authkey(address: str) -> bytes:
+    """
+    Key of the model server: MODEL_SERVER_AUTHKEY if it is set, otherwise a new random key, which is written to a file
+    with mode 0600 next to the socket for the clients to read.
+    """
+    env_key = getenv(MODEL_SERVER_AUTHKEY_ENV)
+    if env_key:
+        return env_key.encode()
+
+    key_path = Path(address).parent / MODEL_SERVER_KEY_FILE
+    key_path.unlink(missing_ok=True)
+    key = secrets.token_hex(32)
+    with os.fdopen(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+        f.write(key)
+    return key.encode()
+
+
+def load_model_server_authkey(address: str) -> bytes:
+    """Key to authenticate with the model server at address, see create_model_server_authkey."""
+    env_key = getenv(MODEL_SERVER_AUTHKEY_ENV)
+    if env_key:
+        return env_key.encode()
+
+    key_path = Path(address).parent / MODEL_SERVER_KEY_FILE
+    if not key_path.exists():
+        raise RuntimeError(
+            f"No model server key at {key_path}. Start the model server first or set {MODEL_SERVER_AUTHKEY_ENV}."
+        )
+    return key_path.read_text().strip().encode()
+
+
+class GenerationRequestError(RuntimeError):
+    """Raised when a remote backend could not produce a continuation, so that no incomplete generations are saved."""
+
+
+class GenerationBackend(ABC):
+    """
+    Interface for everything that can produce continuations for a list of prompts.
+
+    Prompts are either chat conversations (lists of {"role": ..., "content": ...} dicts) or strings to which the
+    chat template has already been applied.
+    """
+
+    # whether prompts should be formatted with a local tokenizer (chat template) before being passed to the backend
+    uses_local_tokenizer = False
+
+    @abstractmethod
+    def generate(
+        self,
+        prompts: Sequence[Union[str, List[Dict]]],
+        gen_kwargs: Dict,
+        batch_size: int = 8,
+        seed: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Generate one continuation per prompt, in order.
+
+        Args:
+            prompts: chat conversations or formatted prompt strings
+            gen_kwargs: generation kwargs in transformers convention (max_new_tokens, temperature, ...)
+            batch_size: batch size for generation
+            seed: seed for generation
+
+        Returns:
+            Iterator over the generated continuations
+        """
+        pass
+
+    def close(self):
+        """Release resources held by the backend."""
+        pass
+
+
+class PipelineBackend(GenerationBackend):
+    """Local generation with a transformers text-generation pipeline."""
+
+    uses_local_tokenizer = True
+
+    def __init__(self, generator, terminators: Optional[List[int]] = None):
+        self.generator = generator
+        self.terminators = terminators
+
+    def generate(
+        self,
+        prompts: Sequence[Union[str, List[Dict]]],
+        gen_kwargs: Dict,
+        batch_size: int = 8,
+        seed: Optional[int] = None,
+    ) -> Iterator[str]:
+        """The global torch seed is set by the caller, so seed is not used here."""
+        if len(prompts) > 0 and not isinstance(prompts[0], str):
+            # chat conversations are fed individually, batching them takes too long
+            for prompt in prompts:
+                out = self.generator([prompt], eos_token_id=self.terminators, return_full_text=False, **gen_kwargs)
+                yield out[0][0]["generated_text"]
+
+        else:
+            for out in self.generator(
+                prompts,
+                batch_size=batch_size,
+                eos_token_id=self.terminators,
+                return_full_text=False,
+                **gen_kwargs,
+            ):
+                yield out[0]["generated_text"]
+
+
+class OpenAICompatibleBackend(GenerationBackend):
+    """
+    Asynchronous client for any server implementing the OpenAI completions or chat completions API
+    (e.g. vLLM, TGI or a production endpoint).
+
+    Requests are sent with bounded concurrency over a pool of keep-alive connections and retried with exponential
+    backoff. If a seed is given, request i is sent with seed + i, so that every prompt gets its own reproducible seed.
+    A request that still fails raises GenerationRequestError instead of producing an empty continuation.
+    """
+
+    def __init__(
+        self,
+        api_base: str,
+        model_name: str,
+        endpoint: str = "chat",
+        api_key: Optional[str] = None,
+        max_concurrency: int = 32,
+        max_retries: int = 5,
+        request_timeout: float = 120,
+        keepalive_timeout: float = 60,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        """
+        Args:
+            api_base: base url of the server, e.g. http://localhost:8000/v1
+            model_name: name under which the model is served
+            endpoint: "chat" for /chat/completions or "completions" for /completions
+            api_key: api key; defaults to the OPENAI_API_KEY environment variable
+            max_concurrency: maximum number of requests in flight (and size of the connection pool)
+            max_retries: number of attempts per request
+            request_timeout: timeout per request in seconds
+            keepalive_timeout: how long idle connections are kept open in seconds
+            backoff: initial waiting time between retries in seconds; doubled after every attempt
+            max_backoff: maximum waiting time between retries in seconds
+        """
+        if endpoint not in ["chat", "completions"]:
+            raise ValueError(f"Invalid endpoint: {endpoint}. Expected 'chat' or 'completions'.")
+
+        self.api_base = api_base.rstrip("/")
+        self.model_name = model_name
+        self.endpoint = endpoint
+        self.url = f"{self.api_base}/chat/completions" if endpoint == "chat" else f"{self.api_base}/completions"
+        self.api_key = api_key if api_key is not None else OPENAI_API_KEY
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+
+    @classmethod
+    def from_config(cls, backend_cfg: Dict, model_name: str):
+        """Creates the backend from the eval section of the config."""
+        backend = backend_cfg.get("backend", "openai_chat")
+        return cls(
+            backend_cfg["api_base"],
+            backend_cfg.get("api_model_name", None) or model_name,
+            endpoint="completions" if backend == "openai_completions" else "chat",
+            max_concurrency=backend_cfg.get("max_concurrency", 32),
+            max_retries=backend_cfg.get("max_retries", 5),
+            request_timeout=backend_cfg.get("request_timeout", 120),
+        )
+
+    def translate_gen_kwargs(self, gen_kwargs: Dict) -> Dict:
+        """Translates transformers generation kwargs into OpenAI request parameters."""
+        params = {}
+        if "max_new_tokens" in gen_kwargs:
+            params["max_tokens"] = gen_kwargs["max_new_tokens"]
+        if "temperature" in gen_kwargs:
+            params["temperature"] = gen_kwargs["temperature"]
+        if "top_p" in gen_kwargs and gen_kwargs["top_p"]:
+            params["top_p"] = gen_kwargs["top_p"]
+        if not gen_kwargs.get("do_sample", True):
+            # greedy decoding
+            params["temperature"] = 0
+        return params
+
+    def build_payload(self, prompt: Union[str, List[Dict]], params: Dict, seed: Optional[int] = None) -> Dict:
+        """ """
+        payload = {"model": self.model_name, **params}
+
+        if self.endpoint == "chat":
+            payload["messages"] = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+        else:
+            payload["prompt"] = (
+                prompt if isinstance(prompt, str) else "\n\n".join(m["content"] for m in prompt if m["content"])
+            )
+
+        if seed is not None:
+            payload["seed"] = seed
+
+        return payload
+
+    def parse_response(self, resp_json: Dict) -> str:
+        """ """
+        choice = resp_json["choices"][0]
+        if self.endpoint == "chat":
+            return choice["message"]["content"]
+        return choice["text"]
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=self.keepalive_timeout)
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def _close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch_completion(self, payload: Dict) -> str:
+        """
+        Sends a single request, retrying on rate limits, server errors and timeouts.
+
+        Raises:
+            GenerationRequestError: if the server answers with a status that is not retried, or all attempts failed
+        """
+        async with self._semaphore:
+            for attempt in range(self.max_retries):
+                try:
+                    async with self._session.post(self.url, data=json.dumps(payload)) as response:
+                        if response.status == 200:
+                            return self.parse_response(await response.json())
+
+                        logger.warning(f"Attempt {attempt + 1}: Received status code {response.status}")
+                        logger.warning(f"Response content: {await response.text()}")
+                        if response.status not in RETRY_STATUS_CODES:
+                            raise GenerationRequestError(f"Request failed with status code {response.status}.")
+                except aiohttp.ClientError as e:
+                    logger.error(f"Attempt {attempt + 1}: ClientError - {e}")
+                except asyncio.TimeoutError:
+                    logger.error(f"Attempt {attempt + 1}: Request timed out")
+
+                if attempt + 1 < self.max_retries:
+                    await asyncio.sleep(min(self.backoff * 2**attempt, self.max_backoff))
+
+        raise GenerationRequestError(f"Request failed after {self.max_retries} attempts.")
+
+    async def _generate_chunk(self, prompts: Sequence, params: Dict, offset: int, seed: Optional[int] = None):
+        tasks = [
+            asyncio.ensure_future(
+                self.fetch_completion(self.build_payload(prompt, params, None if seed is None else seed + offset + i))
+            )
+            for i, prompt in enumerate(prompts)
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except Exception:
+            # do not leave the remaining requests of the chunk running after the first failure
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def generate(
+        self,
+        prompts: Sequence[Union[str, List[Dict]]],
+        gen_kwargs: Dict,
+        batch_size: int = 8,
+        seed: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Prompts are sent in chunks of several times max_concurrency requests so that results can be streamed back
+        in order. The session (and with it the connection pool) is kept open across chunks.
+        """
+        params = self.translate_gen_kwargs(gen_kwargs)
+        chunk_size = max(batch_size, 4 * self.max_concurrency)
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._open())
+
+        for start in range(0, len(prompts), chunk_size):
+            chunk = [prompts[i] for i in range(start, min(start + chunk_size, len(prompts)))]
+            for continuation in self._loop.run_until_complete(self._generate_chunk(chunk, params, start, seed)):
+                yield continuation
+
+    def close(self):
+        """ """
+        if self._loop is not None:
+            self._loop.run_until_complete(self._close())
+            self._loop.close()
+            self._loop = None
+
+
+class ModelServerBackend(GenerationBackend):
+    """
+    Client for the resident generation service in src/evaluation/model_server.py. Jobs are submitted over a local
+    socket and continuations are streamed back while the server is generating, so that the model (and, for LoRA
+    checkpoints, the shared base model) stays loaded between runs.
+    """
+
+    def __init__(
+        self,
+        address: Optional[str],
+        model_id: str,
+        use_peft: bool = False,
+        model_kwargs: Optional[Dict] = None,
+        authkey: Optional[bytes] = None,
+        apply_chat_template: bool = True,
+    ):
+        """
+        Args:
+            address: path of the unix socket the server listens on; None uses get_default_model_server_address
+            model_id: full huggingface id of the model to generate with
+            use_peft: whether model_id is a LoRA adapter
+            model_kwargs: kwargs for loading the model on the server
+            authkey: key to authenticate with the server; defaults to MODEL_SERVER_AUTHKEY or the key file of the
+                server, see load_model_server_authkey
+            apply_chat_template: whether the server formats chat conversations with the chat template of the model,
+                so that they can be generated in batches; otherwise they are passed to the pipeline one by one
+        """
+        self.address = address or get_default_model_server_address()
+        self.model_id = model_id
+        self.use_peft = use_peft
+        self.model_kwargs = model_kwargs if model_kwargs else {}
+        self.authkey = authkey
+        self.apply_chat_template = apply_chat_template
+
+    @classmethod
+    def from_config(cls, backend_cfg: Dict, model_id: str, use_peft: bool = False, model_kwargs: Optional[Dict] = None):
+        """Creates the backend from the eval section of the config."""
+        return cls(
+            backend_cfg.get("model_server_address"),
+            model_id,
+            use_peft=use_peft,
+            model_kwargs=model_kwargs,
+            apply_chat_template=backend_cfg.get("model_server_apply_chat_template", True),
+        )
+
+    def generate(
+        self,
+        prompts: Sequence[Union[str, List[Dict]]],
+        gen_kwargs: Dict,
+        batch_size: int = 8,
+        seed: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Chat conversations are formatted with the chat template on the server if apply_chat_template is set, and
+        batched with batch_size.
+        """
+        job = {
+            "type": "generate",
+            "model_id": self.model_id,
+            "use_peft": self.use_peft,
+            "model_kwargs": self.model_kwargs,
+            "prompts": [prompts[i] for i in range(len(prompts))],
+            "gen_kwargs": gen_kwargs,
+            "batch_size": batch_size,
+            "seed": seed,
+            "apply_chat_template": self.apply_chat_template,
+        }
+
+        authkey = self.authkey if self.authkey is not None else load_model_server_authkey(self.address)
+        with Client(self.address, family="AF_UNIX", authkey=authkey) as conn:
+            conn.send(job)
+            while True:
+                message = conn.recv()
+                if message["type"] == "continuations":
+                    for continuation in message["continuations"]:
+                        yield continuation
+                elif message["type"] == "done":
+                    break
+                elif message["type"] == "error":
+                    raise RuntimeError(f"Model server failed to generate: {message['message']}")
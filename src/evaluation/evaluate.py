@@ -20,9 +20,11 @@ from src.utils.utils import (
     load_entire_json,
     cleanup_files,
 )
-from src.utils.wandb_utils import download_file_from_wandb
 from src.evaluation.score import eval_on_metric
+from src.analysis.sketch import TDigest, save_score_sketch
 from src.utils.legacy_utils import remove_zero_key_and_flatten
+from src.utils import metrics
+from src.utils.tracing import get_tracer
 from logging_config import setup_logging
 
 # setup_logging()
@@ -305,6 +307,8 @@ def evaluate_single_model(
             logger.info(f"Number of empty continuations: {count_empty}")
 
         scores = []
+        # quantile sketch of the scores, built alongside them and stored next to the score file
+        sketch = TDigest()
         num_samples = len(generations)
         logger.info(f"Evaluating {num_samples} samples.")
 
@@ -321,15 +325,22 @@ def evaluate_single_model(
             else:
                 batch_ground_truths = None
 
-            new_scores = eval_on_metric(
-                metric,
-                batch_generations,
-                ground_truths=batch_ground_truths,
-                asynchronously=asynchronously,
-                batch_size=model_batch_size,
-            )
+            with get_tracer().span("score_batch", "scoring", metric=metric, batch_size=len(batch_generations)):
+                new_scores = eval_on_metric(
+                    metric,
+                    batch_generations,
+                    ground_truths=batch_ground_truths,
+                    asynchronously=asynchronously,
+                    batch_size=model_batch_size,
+                )
 
             scores.extend(new_scores)
+            sketch.update(new_scores)
+
+            metrics.inc("scoring_requests", len(batch_generations), metric=metric)
+            metrics.inc("scoring_nan_scores", int(np.isnan(np.asarray(new_scores, dtype=float)).sum()), metric=metric)
+            metrics.observe("scoring_batch_seconds", time.time() - start, metric=metric)
+            metrics.set_gauge("scoring_samples_remaining", num_samples - i - len(batch_generations), metric=metric)
 
             if i > 0 and i % 10000 == 0 and save_intermittently:
                 _save_intermittently(
@@ -357,6 +368,8 @@ def evaluate_single_model(
             pattern = f"{cont_string}scores{short_string}{noise_string}_*.json"
             cleanup_files(model_score_dir, pattern)
 
+        save_score_sketch(sketch, model_score_path)
+
     if noise == 0:
         if overwrite or not model_score_path.exists():
             evaluate_and_save_scores(
@@ -428,6 +441,10 @@ def evaluate_single_model(
                 pattern = f"{cont_string}scores{short_string}{noise_string}_*.json"
                 cleanup_files(model_score_dir, pattern)
 
+            sketch = TDigest()
+            sketch.update(scores)
+            save_score_sketch(sketch, model_score_path)
+
 
 def evaluate_all_models(
     metric: str = "perspective",
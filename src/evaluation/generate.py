@@ -13,14 +13,20 @@ from tqdm import tqdm
 from torch.utils.data import Subset
 from transformers import pipeline, AutoTokenizer, BitsAndBytesConfig
 from transformers.utils import is_flash_attn_2_available
-from typing import Optional, Dict, List
-from peft import AutoPeftModelForCausalLM
+from typing import Optional, Dict, List, Callable, Union
 
 # Add paths to sys.path if not already present
 project_root = Path(__file__).resolve().parents[2]
 if str(project_root) not in sys.path:
     sys.path.append(str(project_root))
 
+from src.evaluation.backends import (
+    GenerationBackend,
+    PipelineBackend,
+    OpenAICompatibleBackend,
+    ModelServerBackend,
+)
+from src.utils import metrics
 from src.utils.utils import (
     translate_model_kwargs,
     NestedKeyDataset,
@@ -29,6 +35,7 @@ from src.utils.utils import (
     check_seed,
     create_conversation,
     create_run_string,
+    time_block,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -36,8 +43,314 @@ logger = logging.getLogger(__name__)
 
 SCRIPT_DIR = Path(__file__).resolve().parents[2]
 
-hf_token = getenv("HF_TOKEN")
-login(hf_token, add_to_git_credential=False)
+
+def hf_login():
+    """Logs into the huggingface hub. Only called when models are actually loaded, not at import time."""
+    hf_token = getenv("HF_TOKEN")
+    login(hf_token, add_to_git_credential=False)
+
+
+def setup_tokenizer(model_id: str, chat_style: str = "default"):
+    """
+    Loads the tokenizer for a model and determines the chat format function and the terminators.
+
+    Args:
+        model_id: Full huggingface id of the model, i.e. including the prefix.
+        chat_style: Chat style used to format the prompts (default, no_safeguards, translation).
+
+    Returns:
+        tokenizer, terminators and format function
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_id, padding_side="left")
+
+    terminators = [tokenizer.eos_token_id]
+    model_family = get_model_family(model_id)
+    if model_family:
+        terminators.append(tokenizer.convert_tokens_to_ids(terminator[model_family]))
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    return tokenizer, terminators, get_format_func(model_id, chat_style=chat_style)
+
+
+def get_model_family(model_id: str) -> Optional[str]:
+    """ """
+    if "llama-3" in model_id.lower():
+        return "llama3"
+    elif "mistral" in model_id.lower():
+        return "mistral"
+    elif "gemma" in model_id.lower():
+        return "gemma"
+    return None
+
+
+def get_format_func(model_id: str, chat_style: str = "default") -> Optional[Callable]:
+    """Returns the function that turns a prompt into a chat conversation for the given model."""
+    model_family = get_model_family(model_id)
+    return format_funcs[model_family](mode=chat_style) if model_family else None
+
+
+def format_remote_prompts(dataset, format_func: Optional[Callable]) -> List[Union[str, List[Dict]]]:
+    """
+    Prompts for remote backends, which apply the chat template themselves: chat conversations for the model families
+    of format_funcs, and the raw prompt text for all other models (chat endpoints send it as a single user message).
+    """
+    texts = [dataset[i]["prompt"]["text"] for i in range(len(dataset))]
+    return [format_func(text) for text in texts] if format_func else texts
+
+
+def load_generator(model_id: str, model_cfg: Dict, model_kwargs: Dict, tokenizer):
+    """
+    Loads the model into a text-generation pipeline. Models finetuned with LoRA are loaded via peft, all other
+    models are quantized to 4 bit.
+    """
+    if model_cfg["use_peft"]:
+        from peft import AutoPeftModelForCausalLM
+
+        model = AutoPeftModelForCausalLM.from_pretrained(model_id, **model_kwargs)
+        generator = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            model_kwargs=model_kwargs,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+
+    else:
+        # TODO: put this in the config file instead
+        model_kwargs.update({"quantization_config": get_quantization_config()})
+        generator = pipeline(
+            "text-generation",
+            model=model_id,
+            model_kwargs=model_kwargs,
+            tokenizer=tokenizer,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+
+    return generator
+
+
+def get_quantization_config():
+    """4 bit quantization config used for all models that are not finetuned with LoRA."""
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16,
+        bnb_4bit_use_double_quant=True,
+    )
+
+
+def load_backend(model_id: str, model_cfg: Dict, model_kwargs: Dict, backend_cfg: Optional[Dict] = None):
+    """
+    Sets up the generation backend specified in backend_cfg["backend"]:
+        - "pipeline" (default): local transformers text-generation pipeline; with backend_cfg["reuse_prefix_cache"],
+          the KV cache of the prompt prefix shared by all prompts is computed once and reused for every batch
+        - "openai_chat" / "openai_completions": OpenAI-compatible server at backend_cfg["api_base"]
+        - "model_server": resident local model server at backend_cfg["model_server_address"]
+
+    Returns:
+        backend, format function and tokenizer (None for remote backends)
+    """
+    backend_cfg = backend_cfg if backend_cfg else {}
+    backend_name = backend_cfg.get("backend", "pipeline")
+
+    if backend_name == "pipeline":
+        tokenizer, terminators, format_func = setup_tokenizer(model_id, chat_style=model_cfg["chat_style"])
+        generator = load_generator(model_id, model_cfg, model_kwargs, tokenizer)
+        if backend_cfg.get("reuse_prefix_cache", False):
+            from src.evaluation.prefix_cache import PrefixCacheBackend
+
+            # compute the KV cache of the shared system prompt and instruction once and reuse it for all batches
+            backend = PrefixCacheBackend(generator.model, tokenizer, terminators, format_func)
+        else:
+            backend = PipelineBackend(generator, terminators)
+
+    elif backend_name in ["openai_chat", "openai_completions"]:
+        tokenizer = None
+        format_func = get_format_func(model_id, chat_style=model_cfg["chat_style"])
+        backend = OpenAICompatibleBackend.from_config(backend_cfg, model_name=model_id)
+        logger.info(f"Generating with {backend_name} backend at {backend.url}.")
+
+    elif backend_name == "model_server":
+        tokenizer = None
+        format_func = get_format_func(model_id, chat_style=model_cfg["chat_style"])
+        backend = ModelServerBackend.from_config(
+            backend_cfg, model_id, use_peft=bool(model_cfg["use_peft"]), model_kwargs=model_kwargs
+        )
+        logger.info(f"Submitting generation jobs to model server at {backend.address}.")
+
+    else:
+        raise ValueError(
+            f"Invalid generation backend: {backend_name}. "
+            "Expected 'pipeline', 'openai_chat', 'openai_completions' or 'model_server'."
+        )
+
+    return backend, format_func, tokenizer
+
+
+def load_prompt_dataset(ds_name: str, model_id: str, few_shot_string: str = "", split: str = "train"):
+    """
+    Loads the prompt dataset, either from a local file (task datasets, e.g. translation) or from huggingface.
+
+    Returns:
+        dataset, ground truths (None for huggingface datasets) and whether the dataset is local
+    """
+    data_path = SCRIPT_DIR / ds_name
+    local_data_path = data_path.parent / f"{data_path.stem}{few_shot_string}{data_path.suffix}"
+
+    # translation dataset (or more generally, task dataset)
+    local_dataset = local_data_path.exists()
+    ground_truths = None
+
+    if local_dataset:
+        logger.info(f"Loading dataset from {local_data_path}.")
+        data_files = {split: str(local_data_path.name)}
+        prompt_dataset = load_dataset(local_data_path.parent.as_posix(), data_files=data_files)[split]
+        ground_truths = [prompt_dataset[i]["output"] for i in range(len(prompt_dataset))]
+        formatted_dataset = prompt_dataset.map(
+            lambda x: create_conversation(x, model_id),
+            remove_columns=prompt_dataset.features,
+            batched=False,
+            desc="Generating conversations for evaluation",
+        )
+        dataset = [formatted_dataset[i]["messages"] for i in range(len(formatted_dataset))]
+    else:
+        logger.info(f"Loading dataset {ds_name} from huggingface.")
+        dataset = load_dataset(ds_name, split=split)
+
+    return dataset, ground_truths, local_dataset
+
+
+def subset_dataset(
+    dataset,
+    num_samples: int = -1,
+    sample_randomly: bool = False,
+    lower_index: Optional[int] = None,
+    upper_index: Optional[int] = None,
+):
+    """ """
+    if num_samples < len(dataset) and num_samples != -1:
+        if sample_randomly:
+            subset_indices = torch.randperm(len(dataset))[:num_samples]
+            dataset = Subset(dataset, subset_indices.tolist())
+        else:
+            dataset = Subset(dataset, range(num_samples))
+    elif lower_index and upper_index:
+        dataset = Subset(dataset, range(lower_index, min(upper_index, len(dataset))))
+
+    return dataset
+
+
+def get_output_file_name(
+    num_samples: int = -1,
+    lower_index: Optional[int] = None,
+    upper_index: Optional[int] = None,
+):
+    """ """
+    file_name = "continuations"
+    if num_samples == -1:
+        file_name += ".json"
+    elif upper_index and lower_index:
+        file_name += f"_{lower_index}_{upper_index}.json"
+    else:
+        file_name += f"_{num_samples}.json"
+
+    return file_name
+
+
+def encode_prompts(dataset, format_func: Callable, tokenizer) -> List[str]:
+    """
+    Applies the chat template to all prompts of the dataset once, so that the encoded prompts can be reused for
+    several generation runs on the same model.
+    """
+    encoded_dataset = NestedKeyDataset(dataset, "prompt", "text", None, format_func, tokenizer)
+    return [encoded_dataset[i] for i in tqdm(range(len(encoded_dataset)), desc="Encoding prompts")]
+
+
+def record_generation_metrics(continuation: str, tokenizer=None, model_id: Optional[str] = None):
+    """
+    Counts a generated prompt and its tokens (words for remote backends, which do not load a tokenizer), from which
+    the metrics flush derives prompts/s and tokens/s.
+    """
+    registry = metrics.get_registry()
+    if not registry.enabled:
+        return
+    if tokenizer is not None:
+        num_tokens = len(tokenizer.encode(continuation, add_special_tokens=False))
+    else:
+        num_tokens = len(continuation.split())
+    registry.inc("generation_prompts", model=model_id)
+    registry.inc("generation_tokens", num_tokens, model=model_id)
+
+
+def run_generation(
+    backend: GenerationBackend,
+    dataset,
+    gen_kwargs: Dict,
+    batch_size: int = 8,
+    local_dataset: bool = False,
+    ground_truths: Optional[List] = None,
+    encoded_prompts: Optional[List[str]] = None,
+    format_func: Optional[Callable] = None,
+    tokenizer=None,
+    model_id: Optional[str] = None,
+    seed: Optional[int] = None,
+):
+    """
+    Generates continuations for all prompts in the dataset.
+
+    Args:
+        backend: generation backend
+        dataset: prompt dataset
+        gen_kwargs: kwargs for generation
+        batch_size: batch size for generation
+        local_dataset: whether this is a task dataset with ground truths (e.g. translation)
+        ground_truths: ground truths for task datasets
+        encoded_prompts: prompts with applied chat template; if None, the chat template is applied on the fly
+        format_func, tokenizer, model_id: needed to apply the chat template on the fly
+        seed: generation seed passed on to the backend
+
+    Returns:
+        Dict with lists of continuations and prompts (or ground truths)
+    """
+    logs = defaultdict(list)
+
+    if local_dataset:
+        # for translation case, we have ground truths and continuations
+        # bit hacky, but for some reason with translation dataset, we need to feed prompts individually or else it takes too long
+        for i, continuation in enumerate(
+            tqdm(backend.generate(dataset, gen_kwargs, batch_size=1, seed=seed), total=len(dataset))
+        ):
+            logs["continuations"].append(continuation)
+            logs["ground_truths"].append(ground_truths[i])
+            record_generation_metrics(continuation, tokenizer, model_id)
+
+    else:
+        if encoded_prompts is not None:
+            prompts = encoded_prompts
+        elif backend.uses_local_tokenizer:
+            prompts = NestedKeyDataset(
+                dataset,
+                "prompt",
+                "text",
+                model_id,
+                format_func,
+                tokenizer,
+            )
+        else:
+            prompts = format_remote_prompts(dataset, format_func)
+
+        # in toxicity case, we have continuations and prompts
+        for i, continuation in tqdm(
+            enumerate(backend.generate(prompts, gen_kwargs, batch_size=batch_size, seed=seed)),
+            total=len(dataset),
+        ):
+            logs["prompts"].append(dataset[i]["prompt"]["text"])
+            logs["continuations"].append(continuation)
+            record_generation_metrics(continuation, tokenizer, model_id)
+
+    return logs
 
 
 def generate_on_dataset(
@@ -54,6 +367,7 @@ def generate_on_dataset(
     dir_prefix: Optional[str] = None,
     lower_index: Optional[int] = None,
     upper_index: Optional[int] = None,
+    backend_cfg: Optional[Dict] = None,
 ):
     """
     Evaluates a model on a dataset and saves the results to a json file.
@@ -71,6 +385,7 @@ def generate_on_dataset(
         split: Split of the dataset to use (usually just train)
         meta_data: metadata to include in the output file
         dir_prefix: Prefix for the output directory
+        backend_cfg: Dict specifying the generation backend (see load_backend); defaults to a local pipeline
     """
     seed = check_seed(model_cfg["gen_seed"])
     torch.manual_seed(seed)
@@ -96,32 +411,9 @@ def generate_on_dataset(
 
     model_id = f"{model_cfg['hf_prefix']}/{model_cfg['model_id']}"
 
-    tokenizer = AutoTokenizer.from_pretrained(model_id, padding_side="left")
-
-    terminators = [tokenizer.eos_token_id]
-
-    if "llama-3" in model_id.lower():
-        terminators.append(tokenizer.convert_tokens_to_ids(terminator["llama3"]))
-        format_func = format_funcs["llama3"](mode=model_cfg["chat_style"])
-    elif "mistral" in model_id.lower():
-        terminators.append(tokenizer.convert_tokens_to_ids(terminator["mistral"]))
-        format_func = format_funcs["mistral"](mode=model_cfg["chat_style"])
-    elif "gemma" in model_id.lower():
-        terminators.append(tokenizer.convert_tokens_to_ids(terminator["gemma"]))
-        format_func = format_funcs["gemma"](mode=model_cfg["chat_style"])
-
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id
-
     # for output
     output_dir = SCRIPT_DIR / dir_prefix / output_dir
-    file_name = "continuations"
-    if num_samples == -1:
-        file_name += ".json"
-    elif upper_index and lower_index:
-        file_name += f"_{lower_index}_{upper_index}.json"
-    else:
-        file_name += f"_{num_samples}.json"
+    file_name = get_output_file_name(num_samples, lower_index=lower_index, upper_index=upper_index)
     folder_path = output_dir / f"{model_id.split('/')[-1]}{few_shot_string}{high_temp_string}_seed{seed}"
     Path(folder_path).mkdir(parents=True, exist_ok=True)
     file_path = folder_path / file_name
@@ -130,65 +422,19 @@ def generate_on_dataset(
         logger.info(f"File {file_path} already exists. Skipping.")
         return
 
-    # for dataset
-    data_path = SCRIPT_DIR / ds_name
-    local_data_path = data_path.parent / f"{data_path.stem}{few_shot_string}{data_path.suffix}"
-
-    # translation dataset (or more generally, task dataset)
-    local_dataset = local_data_path.exists()
-
-    if local_dataset:
-        logger.info(f"Loading dataset from {local_data_path}.")
-        data_files = {split: str(local_data_path.name)}
-        prompt_dataset = load_dataset(local_data_path.parent.as_posix(), data_files=data_files)[split]
-        ground_truths = [prompt_dataset[i]["output"] for i in range(len(prompt_dataset))]
-        formatted_dataset = prompt_dataset.map(
-            lambda x: create_conversation(x, model_id),
-            remove_columns=prompt_dataset.features,
-            batched=False,
-            desc="Generating conversations for evaluation",
-        )
-        dataset = [formatted_dataset[i]["messages"] for i in range(len(formatted_dataset))]
-    else:
-        logger.info(f"Loading dataset {ds_name} from huggingface.")
-        dataset = load_dataset(ds_name, split=split)
-
-    if model_cfg["use_peft"]:
-        model = AutoPeftModelForCausalLM.from_pretrained(model_id, **model_kwargs)
-        generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            model_kwargs=model_kwargs,
-            pad_token_id=tokenizer.pad_token_id,
-        )
-
-    else:
-        quant_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-            bnb_4bit_use_double_quant=True,
-        )
+    dataset, ground_truths, local_dataset = load_prompt_dataset(
+        ds_name, model_id, few_shot_string=few_shot_string, split=split
+    )
 
-        # TODO: put this in the config file instead
-        model_kwargs.update({"quantization_config": quant_config})
-        generator = pipeline(
-            "text-generation",
-            model=model_id,
-            model_kwargs=model_kwargs,
-            tokenizer=tokenizer,
-            pad_token_id=tokenizer.pad_token_id,
-        )
+    backend, format_func, tokenizer = load_backend(model_id, model_cfg, model_kwargs, backend_cfg=backend_cfg)
 
-    if num_samples < len(dataset) and num_samples != -1:
-        if sample_randomly:
-            subset_indices = torch.randperm(len(dataset))[:num_samples]
-            dataset = Subset(dataset, subset_indices.tolist())
-        else:
-            dataset = Subset(dataset, range(num_samples))
-    elif lower_index and upper_index:
-        dataset = Subset(dataset, range(lower_index, min(upper_index, len(dataset))))
+    dataset = subset_dataset(
+        dataset,
+        num_samples=num_samples,
+        sample_randomly=sample_randomly,
+        lower_index=lower_index,
+        upper_index=upper_index,
+    )
 
     logs = defaultdict(list)
     logs["metadata"] = {
@@ -206,38 +452,30 @@ def generate_on_dataset(
         "high_temp": high_temp,
     }
 
-    # bit hacky, but for some reason with translation dataset, we need to feed prompts individually or else it takes too long
-    if local_dataset:
-        # for translation case, we have ground truths and continuations
-        for i, input in enumerate(tqdm(dataset)):
-            out = generator([input], eos_token_id=terminators, return_full_text=False, **gen_kwargs)
-            logs["continuations"].append(out[0][0]["generated_text"])
-
-            logs["ground_truths"].append(ground_truths[i])
-
-    else:
-        # in toxicity case, we have continuations and prompts
-        for i, out in tqdm(
-            enumerate(
-                generator(
-                    NestedKeyDataset(
-                        dataset,
-                        "prompt",
-                        "text",
-                        model_id,
-                        format_func,
-                        tokenizer,
-                    ),
-                    batch_size=batch_size,
-                    eos_token_id=terminators,
-                    return_full_text=False,
-                    **gen_kwargs,
-                )
-            ),
-            total=len(dataset),
-        ):
-            logs["prompts"].append(dataset[i]["prompt"]["text"])
-            logs["continuations"].append(out[0]["generated_text"])
+    with time_block(
+        f"Generating {len(dataset)} continuations with {model_id}",
+        span="generate",
+        category="generation",
+        model=model_id,
+        seed=seed,
+        num_prompts=len(dataset),
+        batch_size=batch_size,
+    ):
+        logs.update(
+            run_generation(
+                backend,
+                dataset,
+                gen_kwargs,
+                batch_size=batch_size,
+                local_dataset=local_dataset,
+                ground_truths=ground_truths,
+                format_func=format_func,
+                tokenizer=tokenizer,
+                model_id=model_id,
+                seed=seed,
+            )
+        )
+    backend.close()
 
     with open(file_path, "w") as file:
         json.dump(logs, file, ensure_ascii=False, indent=4)
@@ -246,6 +484,151 @@ def generate_on_dataset(
         wandb.save(file_path)
 
 
+def generate_variants_on_dataset(
+    model_cfg: Dict,
+    metric_cfg: Dict,
+    variants: List[Dict],
+    num_samples: int = -1,
+    batch_size: int = 8,
+    use_wandb: bool = True,
+    output_dir: str = "model_outputs",
+    sample_randomly: bool = False,
+    overwrite: bool = False,
+    split: str = "train",
+    meta_data: Optional[bool] = None,
+    dir_prefix: Optional[str] = None,
+    lower_index: Optional[int] = None,
+    upper_index: Optional[int] = None,
+    backend_cfg: Optional[Dict] = None,
+):
+    """
+    Generates continuations for several (gen_seed, gen_kwargs) variants of the same model. The model is loaded and
+    the prompts are encoded only once; each variant is written to its own folder, e.g. {model}_seed{seed} or
+    {model}_hightemp_seed{seed}, with the same layout as generate_on_dataset.
+
+    Args:
+        model_cfg: Dict containing model name, kwargs for loading and for generating output as well as batch size.
+        metric_cfg: Dict containing metric name, behavior, dataset_name and whether to use few-shot prompts
+        variants: List of dicts with keys "gen_seed" and optionally "high_temp" and "gen_kwargs". If "gen_kwargs"
+            is not given, the gen_kwargs (or high_temp_gen_kwargs if "high_temp" is set) from model_cfg are used.
+        All other args are the same as for generate_on_dataset. If sample_randomly is set, the subset of prompts
+        is drawn with the seed of the first variant and shared by all variants.
+    """
+    if not variants:
+        raise ValueError("At least one generation variant must be provided.")
+
+    few_shot = metric_cfg.get("few_shot", None)
+    few_shot_string = "_fewshot" if few_shot else ""
+
+    ds_name = str(metric_cfg["dataset_name"])
+
+    if dir_prefix is None:
+        dir_prefix = metric_cfg["metric"]
+
+    model_kwargs = model_cfg["model_kwargs"]
+    if is_flash_attn_2_available():
+        model_kwargs.update({"attn_implementation": "flash_attention_2"})
+
+    model_id = f"{model_cfg['hf_prefix']}/{model_cfg['model_id']}"
+
+    output_dir = SCRIPT_DIR / dir_prefix / output_dir
+    file_name = get_output_file_name(num_samples, lower_index=lower_index, upper_index=upper_index)
+
+    # determine which variants still need to be generated before loading anything
+    pending_variants = []
+    for variant in variants:
+        seed = check_seed(variant["gen_seed"])
+        high_temp = variant.get("high_temp", None)
+        high_temp_string = "_hightemp" if high_temp else ""
+        gen_kwargs = variant.get("gen_kwargs", None)
+        if gen_kwargs is None:
+            gen_kwargs = model_cfg["high_temp_gen_kwargs"] if high_temp else model_cfg["gen_kwargs"]
+
+        folder_path = output_dir / f"{model_id.split('/')[-1]}{few_shot_string}{high_temp_string}_seed{seed}"
+        file_path = folder_path / file_name
+
+        if file_path.exists() and not overwrite:
+            logger.info(f"File {file_path} already exists. Skipping variant with seed {seed}.")
+            continue
+
+        pending_variants.append(
+            {"seed": seed, "high_temp": high_temp, "gen_kwargs": gen_kwargs, "file_path": file_path}
+        )
+
+    if not pending_variants:
+        return
+
+    dataset, ground_truths, local_dataset = load_prompt_dataset(
+        ds_name, model_id, few_shot_string=few_shot_string, split=split
+    )
+
+    backend, format_func, tokenizer = load_backend(model_id, model_cfg, model_kwargs, backend_cfg=backend_cfg)
+
+    torch.manual_seed(pending_variants[0]["seed"])
+    dataset = subset_dataset(
+        dataset,
+        num_samples=num_samples,
+        sample_randomly=sample_randomly,
+        lower_index=lower_index,
+        upper_index=upper_index,
+    )
+
+    # the chat template only needs to be applied once for all variants
+    if local_dataset:
+        encoded_prompts = None
+    elif backend.uses_local_tokenizer:
+        encoded_prompts = encode_prompts(dataset, format_func, tokenizer)
+    else:
+        encoded_prompts = format_remote_prompts(dataset, format_func)
+
+    for variant in pending_variants:
+        seed = variant["seed"]
+        gen_kwargs = variant["gen_kwargs"]
+        logger.info(f"Generating variant with seed {seed} and gen_kwargs {gen_kwargs}.")
+        torch.manual_seed(seed)
+
+        logs = defaultdict(list)
+        logs["metadata"] = {
+            "dataset_name": ds_name,
+            "model_id": model_id,
+            "gen_kwargs": {k: str(v) for k, v in gen_kwargs.items()},
+            "num_samples": num_samples,
+            "batch_size": batch_size,
+            "seed": seed,
+            "use_wandb": use_wandb,
+            "behavior": str(metric_cfg["behavior"]),
+            "metric": str(metric_cfg["metric"]),
+            "meta_data": meta_data,
+            "few_shot": few_shot,
+            "high_temp": variant["high_temp"],
+        }
+
+        logs.update(
+            run_generation(
+                backend,
+                dataset,
+                gen_kwargs,
+                batch_size=batch_size,
+                local_dataset=local_dataset,
+                ground_truths=ground_truths,
+                encoded_prompts=encoded_prompts,
+                tokenizer=tokenizer,
+                model_id=model_id,
+                seed=seed,
+            )
+        )
+
+        file_path = variant["file_path"]
+        Path(file_path.parent).mkdir(parents=True, exist_ok=True)
+        with open(file_path, "w") as file:
+            json.dump(logs, file, ensure_ascii=False, indent=4)
+
+        if use_wandb:
+            wandb.save(file_path)
+
+    backend.close()
+
+
 def generate(
     cfg: Dict,
     model_id: Optional[str] = None,
@@ -268,6 +651,10 @@ def generate(
         use_wandb: Optional; overrides the use_wandb flag from cfg.logging if provided.
     """
 
+    # remote backends and the model server load no models from the hub in this process
+    if cfg["eval"].get("backend", "pipeline") == "pipeline":
+        hf_login()
+
     # Apply overrides to cfg_updated
     if model_id is not None:
         cfg["tau1"]["model_id"] = model_id
@@ -309,18 +696,38 @@ def generate(
         peft_prefixes = cfg["peft_models"]["prefixes"]
         cfg["tau1"]["use_peft"] = cfg["tau1"]["hf_prefix"] in peft_prefixes
 
-    # Pass the updated tau1 configuration to generate_on_dataset
-    generate_on_dataset(
-        cfg["tau1"],
-        cfg["metric"],
-        num_samples=num_samples,
-        batch_size=cfg["eval"]["batch_size"],
-        use_wandb=cfg["logging"]["use_wandb"],
-        overwrite=cfg["eval"]["overwrite"],
-        dir_prefix=cfg["dir_prefix"],
-        lower_index=lower_index,
-        upper_index=upper_index,
-    )
+    gen_variants = cfg["tau1"].get("gen_variants", None)
+
+    if gen_variants:
+        # load the model once and generate all (gen_seed, gen_kwargs) variants
+        generate_variants_on_dataset(
+            cfg["tau1"],
+            cfg["metric"],
+            gen_variants,
+            num_samples=num_samples,
+            batch_size=cfg["eval"]["batch_size"],
+            use_wandb=cfg["logging"]["use_wandb"],
+            overwrite=cfg["eval"]["overwrite"],
+            dir_prefix=cfg["dir_prefix"],
+            lower_index=lower_index,
+            upper_index=upper_index,
+            backend_cfg=cfg["eval"],
+        )
+
+    else:
+        # Pass the updated tau1 configuration to generate_on_dataset
+        generate_on_dataset(
+            cfg["tau1"],
+            cfg["metric"],
+            num_samples=num_samples,
+            batch_size=cfg["eval"]["batch_size"],
+            use_wandb=cfg["logging"]["use_wandb"],
+            overwrite=cfg["eval"]["overwrite"],
+            dir_prefix=cfg["dir_prefix"],
+            lower_index=lower_index,
+            upper_index=upper_index,
+            backend_cfg=cfg["eval"],
+        )
 
     if cfg["logging"]["use_wandb"]:
         wandb.finish()
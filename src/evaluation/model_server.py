@@ -0,0 +1,274 @@
+import gc
+import logging
+import os
+import sys
+import torch
+
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from pathlib import Path
+from peft import PeftConfig, PeftModel
+from transformers import pipeline, AutoModelForCausalLM
+from transformers.utils import is_flash_attn_2_available
+from typing import Optional, Dict, List
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.evaluation.backends import (
+    MODEL_SERVER_KEY_FILE,
+    PipelineBackend,
+    create_model_server_authkey,
+    ensure_private_dir,
+    get_default_model_server_address,
+)
+from src.evaluation.generate import setup_tokenizer, get_quantization_config, hf_login
+
+logger = logging.getLogger(__name__)
+
+
+def get_adapter_name(model_id: str) -> str:
+    """Adapter names are used as module names in peft and must not contain dots."""
+    return model_id.replace("/", "__").replace(".", "_")
+
+
+class ModelCache:
+    """
+    Keeps recently used models loaded under LRU eviction.
+
+    Models finetuned with LoRA (e.g. the LLMAccountability checkpoints) share one base model per base model id.
+    Their adapters are loaded into the shared base model and swapped with set_adapter instead of reloading the
+    full weights for every checkpoint. All other models are loaded in 4 bit, as in generate_on_dataset.
+    """
+
+    def __init__(self, max_models: int = 2, max_adapters: int = 10):
+        """
+        Args:
+            max_models: maximum number of (base) models kept in memory
+            max_adapters: maximum number of LoRA adapters kept loaded per base model
+        """
+        self.max_models = max_models
+        self.max_adapters = max_adapters
+
+        # key -> {"model": model, "adapters": OrderedDict of adapter names}
+        self.models = OrderedDict()
+        # model_id -> (tokenizer, terminators)
+        self.tokenizers = {}
+
+    def get_tokenizer(self, model_id: str):
+        """ """
+        if model_id not in self.tokenizers:
+            tokenizer, terminators, _ = setup_tokenizer(model_id)
+            self.tokenizers[model_id] = (tokenizer, terminators)
+        return self.tokenizers[model_id]
+
+    def _evict(self):
+        while len(self.models) > self.max_models:
+            key, entry = self.models.popitem(last=False)
+            logger.info(f"Evicting model {key} from cache.")
+            del entry
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _get_entry(self, key, load_fn):
+        if key in self.models:
+            self.models.move_to_end(key)
+        else:
+            logger.info(f"Loading model {key}.")
+            self.models[key] = {"model": load_fn(), "adapters": OrderedDict()}
+            self._evict()
+        return self.models[key]
+
+    def get_model(self, model_id: str, use_peft: bool = False, model_kwargs: Optional[Dict] = None):
+        """
+        Returns the model for model_id, loading it (or only its adapter) if necessary.
+        """
+        model_kwargs = dict(model_kwargs) if model_kwargs else {}
+        if is_flash_attn_2_available():
+            model_kwargs.update({"attn_implementation": "flash_attention_2"})
+
+        if not use_peft:
+            model_kwargs.update({"quantization_config": get_quantization_config()})
+            entry = self._get_entry(
+                ("full", model_id), lambda: AutoModelForCausalLM.from_pretrained(model_id, **model_kwargs)
+            )
+            return entry["model"]
+
+        base_model_id = PeftConfig.from_pretrained(model_id).base_model_name_or_path
+        adapter_name = get_adapter_name(model_id)
+
+        entry = self._get_entry(
+            ("peft", base_model_id),
+            lambda: PeftModel.from_pretrained(
+                AutoModelForCausalLM.from_pretrained(base_model_id, **model_kwargs),
+                model_id,
+                adapter_name=adapter_name,
+            ),
+        )
+        model = entry["model"]
+        adapters = entry["adapters"]
+
+        if adapter_name in adapters:
+            adapters.move_to_end(adapter_name)
+        else:
+            if adapter_name not in model.peft_config:
+                logger.info(f"Loading adapter {model_id} into base model {base_model_id}.")
+                model.load_adapter(model_id, adapter_name=adapter_name)
+            adapters[adapter_name] = model_id
+
+            while len(adapters) > self.max_adapters:
+                old_adapter_name, old_model_id = adapters.popitem(last=False)
+                logger.info(f"Evicting adapter {old_model_id} from base model {base_model_id}.")
+                model.delete_adapter(old_adapter_name)
+
+        model.set_adapter(adapter_name)
+
+        return model
+
+    def status(self) -> List[Dict]:
+        """ """
+        return [
+            {"model": str(key), "adapters": list(entry["adapters"].values())} for key, entry in self.models.items()
+        ]
+
+
+class ModelServer:
+    """
+    Resident generation service. Listens on a local unix socket, handles one generation job at a time and streams
+    the continuations back to the client in chunks.
+
+    Jobs are unpickled, so the socket is created in a directory that only the current user can access, and clients
+    have to authenticate with the key of the server (MODEL_SERVER_AUTHKEY, or a random key in a 0600 file next to the
+    socket, see create_model_server_authkey).
+    """
+
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        max_models: int = 2,
+        max_adapters: int = 10,
+        stream_chunk_size: int = 64,
+        authkey: Optional[bytes] = None,
+    ):
+        self.address = address or get_default_model_server_address()
+        self.cache = ModelCache(max_models=max_models, max_adapters=max_adapters)
+        self.stream_chunk_size = stream_chunk_size
+        self.authkey = authkey
+
+    def handle_generate(self, conn, job: Dict):
+        """ """
+        model_id = job["model_id"]
+        model = self.cache.get_model(model_id, use_peft=job["use_peft"], model_kwargs=job["model_kwargs"])
+        tokenizer, terminators = self.cache.get_tokenizer(model_id)
+
+        generator = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        backend = PipelineBackend(generator, terminators)
+
+        prompts = job["prompts"]
+        if job["apply_chat_template"] and prompts and not isinstance(prompts[0], str):
+            prompts = [tokenizer.apply_chat_template(p, tokenize=False, add_generation_prompt=True) for p in prompts]
+
+        if job["seed"] is not None:
+            torch.manual_seed(job["seed"])
+
+        chunk = []
+        for continuation in backend.generate(prompts, job["gen_kwargs"], batch_size=job["batch_size"]):
+            chunk.append(continuation)
+            if len(chunk) == self.stream_chunk_size:
+                conn.send({"type": "continuations", "continuations": chunk})
+                chunk = []
+
+        if chunk:
+            conn.send({"type": "continuations", "continuations": chunk})
+        conn.send({"type": "done"})
+
+    def handle_connection(self, conn) -> bool:
+        """
+        Handles the job of one client.
+
+        Returns:
+            False if the server was asked to shut down
+        """
+        job = conn.recv()
+
+        if job["type"] == "shutdown":
+            logger.info("Shutting down model server.")
+            conn.send({"type": "done"})
+            return False
+
+        elif job["type"] == "status":
+            conn.send({"type": "status", "models": self.cache.status()})
+
+        elif job["type"] == "generate":
+            logger.info(f"Received generation job for {job['model_id']} on {len(job['prompts'])} prompts.")
+            try:
+                self.handle_generate(conn, job)
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                logger.warning("Client disconnected during generation.")
+            except Exception as e:
+                logger.exception(f"Generation job for {job['model_id']} failed.")
+                try:
+                    conn.send({"type": "error", "message": repr(e)})
+                except OSError:
+                    logger.warning("Could not send the error to the client, which has disconnected.")
+
+        else:
+            conn.send({"type": "error", "message": f"Unknown job type: {job['type']}"})
+
+        return True
+
+    def serve_forever(self):
+        """ """
+        ensure_private_dir(Path(self.address).parent)
+        authkey = self.authkey if self.authkey is not None else create_model_server_authkey(self.address)
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        with Listener(self.address, family="AF_UNIX", authkey=authkey) as listener:
+            os.chmod(self.address, 0o600)
+            logger.info(f"Model server listening on {self.address}.")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    logger.warning(f"Rejected connection: {e!r}")
+                    continue
+
+                with conn:
+                    try:
+                        if not self.handle_connection(conn):
+                            break
+                    except (EOFError, OSError) as e:
+                        # a client that disconnects must not take down the server for all other clients
+                        logger.warning(f"Lost connection to client: {e!r}")
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        if self.authkey is None:
+            (Path(self.address).parent / MODEL_SERVER_KEY_FILE).unlink(missing_ok=True)
+
+
+def serve(cfg: Dict):
+    """
+    Starts the model server with the settings from the model_server section of the config.
+    """
+    hf_login()
+
+    server_cfg = cfg.get("model_server", {}) or {}
+    server = ModelServer(
+        address=server_cfg.get("address"),
+        max_models=server_cfg.get("max_models", 2),
+        max_adapters=server_cfg.get("max_adapters", 10),
+        stream_chunk_size=server_cfg.get("stream_chunk_size", 64),
+    )
+    server.serve_forever()
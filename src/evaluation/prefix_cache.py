@@ -0,0 +1,164 @@
+import copy
+import logging
+import sys
+import torch
+
+from pathlib import Path
+from transformers import DynamicCache
+from typing import Optional, Dict, List, Iterator, Sequence, Union, Callable
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.evaluation.backends import GenerationBackend
+
+logger = logging.getLogger(__name__)
+
+# two inputs that differ in their first character, used to find the part of the chat template shared by all prompts
+PROBE_INPUTS = ("A", "Z")
+
+
+def find_shared_prefix_ids(tokenizer, format_func: Callable) -> List[int]:
+    """
+    Finds the token ids of the chat-template prefix that is shared by all prompts of a format function, i.e. the
+    special tokens, the system message and the fixed instruction in front of the incomplete sentence.
+
+    The last common token is dropped, as it might be merged with the first token of the prompt by the tokenizer.
+    """
+    ids = [
+        tokenizer(
+            tokenizer.apply_chat_template(format_func(probe), tokenize=False, add_generation_prompt=True),
+            add_special_tokens=False,
+        )["input_ids"]
+        for probe in PROBE_INPUTS
+    ]
+
+    prefix_len = 0
+    for id1, id2 in zip(ids[0], ids[1]):
+        if id1 != id2:
+            break
+        prefix_len += 1
+
+    return ids[0][: max(prefix_len - 1, 0)]
+
+
+class PrefixCacheBackend(GenerationBackend):
+    """
+    Local generation that computes the KV cache of the shared chat-template prefix once and reuses it for every
+    batch, so that the system prompt and instruction are not prefilled again for each of the prompts.
+
+    Batches are laid out as [prefix][left padding][prompt suffix], with the padding masked out in the attention mask.
+    Position ids are derived from the attention mask in generate, so the suffix continues right after the prefix
+    regardless of the amount of padding. Prompts that do not start with the prefix are generated without the cache.
+    """
+
+    uses_local_tokenizer = True
+
+    def __init__(self, model, tokenizer, terminators: Optional[List[int]] = None, format_func: Callable = None):
+        """
+        Args:
+            model: causal language model (e.g. the model of the text-generation pipeline)
+            tokenizer: tokenizer of the model
+            terminators: token ids at which generation stops
+            format_func: function that turns a prompt into a chat conversation
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.terminators = terminators
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        self.prefix_ids = find_shared_prefix_ids(tokenizer, format_func) if format_func else []
+        self.prefix_cache = self.compute_prefix_cache() if self.prefix_ids else None
+        logger.info(f"Reusing KV cache for a shared prompt prefix of {len(self.prefix_ids)} tokens.")
+
+    @torch.no_grad()
+    def compute_prefix_cache(self):
+        """
+        Runs the shared prefix through the model once and returns its KV cache. The cache is passed in explicitly, as
+        the model would otherwise return the legacy tuple format, which cannot be repeated for a batch.
+        """
+        input_ids = torch.tensor([self.prefix_ids], device=self.model.device)
+        out = self.model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True)
+        past_key_values = out.past_key_values
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        return past_key_values
+
+    def split_prefix(self, prompt_ids: List[int]) -> Optional[List[int]]:
+        """Returns the part of the prompt after the shared prefix, or None if the prompt does not start with it."""
+        num_prefix = len(self.prefix_ids)
+        if self.prefix_cache is None or prompt_ids[:num_prefix] != self.prefix_ids or len(prompt_ids) == num_prefix:
+            return None
+        return prompt_ids[num_prefix:]
+
+    @torch.no_grad()
+    def generate_batch(self, batch_ids: List[List[int]], gen_kwargs: Dict, use_prefix: bool) -> List[str]:
+        """
+        Generates continuations for a batch of tokenized prompts. If use_prefix, the prompts are the suffixes after
+        the shared prefix and the cached prefix is prepended.
+        """
+        batch_size = len(batch_ids)
+        max_len = max(len(ids) for ids in batch_ids)
+        num_prefix = len(self.prefix_ids) if use_prefix else 0
+
+        input_ids = torch.full((batch_size, num_prefix + max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, num_prefix + max_len), dtype=torch.long)
+
+        if use_prefix:
+            input_ids[:, :num_prefix] = torch.tensor(self.prefix_ids)
+            attention_mask[:, :num_prefix] = 1
+
+        for i, ids in enumerate(batch_ids):
+            # left padding between the prefix and the suffix
+            input_ids[i, num_prefix + max_len - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, num_prefix + max_len - len(ids) :] = 1
+
+        kwargs = {}
+        if use_prefix:
+            past_key_values = copy.deepcopy(self.prefix_cache)
+            if batch_size > 1:
+                past_key_values.batch_repeat_interleave(batch_size)
+            kwargs["past_key_values"] = past_key_values
+
+        output_ids = self.model.generate(
+            input_ids=input_ids.to(self.model.device),
+            attention_mask=attention_mask.to(self.model.device),
+            eos_token_id=self.terminators,
+            pad_token_id=self.pad_token_id,
+            **kwargs,
+            **gen_kwargs,
+        )
+
+        return self.tokenizer.batch_decode(output_ids[:, input_ids.shape[1] :], skip_special_tokens=True)
+
+    def generate(
+        self,
+        prompts: Sequence[Union[str, List[Dict]]],
+        gen_kwargs: Dict,
+        batch_size: int = 8,
+        seed: Optional[int] = None,
+    ) -> Iterator[str]:
+        """The global torch seed is set by the caller, so seed is not used here."""
+        for start in range(0, len(prompts), batch_size):
+            batch = [prompts[i] for i in range(start, min(start + batch_size, len(prompts)))]
+            batch = [
+                (
+                    p
+                    if isinstance(p, str)
+                    else self.tokenizer.apply_chat_template(p, tokenize=False, add_generation_prompt=True)
+                )
+                for p in batch
+            ]
+            batch_ids = self.tokenizer(batch, add_special_tokens=False)["input_ids"]
+            suffixes = [self.split_prefix(ids) for ids in batch_ids]
+
+            if all(suffix is not None for suffix in suffixes):
+                continuations = self.generate_batch(suffixes, gen_kwargs, use_prefix=True)
+            else:
+                logger.debug("Prompt without the shared prefix in batch, generating without the prefix cache.")
+                continuations = self.generate_batch(batch_ids, gen_kwargs, use_prefix=False)
+
+            for continuation in continuations:
+                yield continuation
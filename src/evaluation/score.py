@@ -1,17 +1,20 @@
 import aiohttp
 import asyncio
-import evaluate
 import json
 import logging
 import numpy as np
 import sys
 
-from googleapiclient import discovery
 from os import getenv
 from pathlib import Path
-from transformers import pipeline
 from typing import Optional, Dict, List
 
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.utils import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -49,6 +52,8 @@ def eval_on_metric(
         else:
             scores = call_perspective_synchronously(continuations)
     elif metric == "toxicity":
+        from transformers import pipeline
+
         model_name = "facebook/roberta-hate-speech-dynabench-r4-target"
         toxic_classifier = pipeline(
             "text-classification",
@@ -77,6 +82,8 @@ def eval_on_metric(
             logger.error("Ground truths must be provided for translation evaluation.")
             sys.exit(1)
 
+        import evaluate
+
         scores = []
         # Load the metric
         score_function = evaluate.load_metric(metric)
@@ -95,6 +102,8 @@ def eval_on_metric(
                 scores.append(score["rougleLsum"])
 
     elif metric == "sentiment":
+        from transformers import pipeline
+
         sentiment_classifier = pipeline("sentiment-analysis", device_map="auto")
         scores = [sentiment_classifier(cont)[0]["score"] for cont in continuations]
 
@@ -111,6 +120,7 @@ def eval_on_metric(
 def call_perspective_synchronously(continuations):
     """ """
     # from utils.keys import PERSPECTIVE_API_KEY
+    from googleapiclient import discovery
 
     client = discovery.build(
         "commentanalyzer",
@@ -165,12 +175,16 @@ async def fetch_toxicity(session, text, retries=10):
                 else:
                     logger.warning(f"Attempt {attempt + 1}: Received status code {response.status}")
                     logger.warning(f"Response content: {await response.text()}")
+                    metrics.inc("perspective_retries", reason=f"status_{response.status}")
         except aiohttp.ClientError as e:
             logger.error(f"Attempt {attempt + 1}: ClientError - {e}")
+            metrics.inc("perspective_retries", reason="client_error")
         except asyncio.TimeoutError:
             logger.error(f"Attempt {attempt + 1}: Request timed out")
+            metrics.inc("perspective_retries", reason="timeout")
         await asyncio.sleep(240)  # Wait a bit before retrying
 
+    metrics.inc("perspective_failures")
     return np.nan
 
 
@@ -0,0 +1,342 @@
+import hashlib
+import json
+import logging
+import pandas as pd
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Optional, Callable, Dict, List, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.analysis.distance_cache import canonical_json, hash_file, to_serializable
+from src.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    """
+    A node of the pipeline: a function that produces output files from the outputs of its upstream stages.
+
+    Args:
+        name: unique name, e.g. score/Meta-Llama-3-8B-Instruct_seed1000
+        func: called without arguments to produce the outputs; has to be picklable (a module-level function or a
+            functools.partial of one) for pipelines that run stages in parallel
+        outputs: output files; a path containing * matches all files of the pattern (e.g. the folds)
+        inputs: names of the upstream stages
+        params: everything besides the inputs that the outputs depend on
+        after: stages that have to finish first without being inputs, e.g. because they use the same files
+    """
+
+    name: str
+    func: Callable[[], None]
+    outputs: List[Union[str, Path]]
+    inputs: List[str] = field(default_factory=list)
+    params: Dict = field(default_factory=dict)
+    after: List[str] = field(default_factory=list)
+
+    def get_output_files(self) -> List[Path]:
+        """Existing output files, with the patterns expanded."""
+        files = []
+        for output in self.outputs:
+            output = Path(output)
+            if "*" in output.name:
+                files.extend(sorted(output.parent.glob(output.name)))
+            elif output.exists():
+                files.append(output)
+        return files
+
+    def outputs_exist(self) -> bool:
+        """ """
+        for output in self.outputs:
+            output = Path(output)
+            if "*" in output.name:
+                if not any(output.parent.glob(output.name)):
+                    return False
+            elif not output.exists():
+                return False
+        return True
+
+    def get_params_hash(self) -> str:
+        """ """
+        return hashlib.sha256(canonical_json(self.params).encode()).hexdigest()
+
+
+def run_stage(stage: Stage) -> float:
+    """Runs a stage, possibly in a worker process, checks that it produced its outputs and returns its duration."""
+    start = time.time()
+    with span(stage.name.split("/")[0], "pipeline", stage=stage.name):
+        stage.func()
+    if not stage.outputs_exist():
+        raise RuntimeError(f"Stage {stage.name} did not produce all of its outputs {stage.outputs}.")
+    return time.time() - start
+
+
+class Pipeline:
+    """
+    DAG of stages with incremental recomputation. Every stage that runs writes a manifest with the hash of its
+    params, the content hashes of its inputs and the content hashes of its outputs. A stage is stale, and recomputed,
+    if it has no manifest, its params or input hashes differ from the manifest, or an upstream stage is recomputed.
+
+    A stage whose outputs were deleted (e.g. the folds, which the test removes) but whose manifest is up to date is
+    only recomputed if a stage that needs it runs; its dependents compare against the output hashes in its manifest.
+    Outputs that exist without a manifest (computed before the pipeline was used) are adopted as they are, unless
+    adopt_existing is False.
+
+    Independent stages run in parallel threads, and a stage whose upstream stages were recomputed but produced the
+    same outputs as before is not recomputed.
+    """
+
+    def __init__(self, manifest_dir: Union[str, Path], adopt_existing: bool = True):
+        self.manifest_dir = Path(manifest_dir)
+        self.adopt_existing = adopt_existing
+        self.stages: Dict[str, Stage] = {}
+
+    def add(self, stage: Stage) -> Stage:
+        """Adds a stage; stages with the same name are only added once."""
+        if stage.name in self.stages:
+            return self.stages[stage.name]
+
+        for name in stage.inputs:
+            if name not in self.stages:
+                raise ValueError(f"Upstream stage {name} of {stage.name} has to be added first.")
+
+        # patterns may overlap, e.g. the folds of different fold sizes; those stages have to be ordered with after
+        outputs = {str(output) for output in stage.outputs if "*" not in Path(output).name}
+        for other in self.stages.values():
+            if outputs & {str(output) for output in other.outputs}:
+                raise ValueError(f"Stages {other.name} and {stage.name} write the same outputs.")
+
+        self.stages[stage.name] = stage
+        return stage
+
+    def get_dependents(self, name: str) -> List[str]:
+        """ """
+        return [other.name for other in self.stages.values() if name in other.inputs]
+
+    def get_manifest_path(self, name: str) -> Path:
+        """ """
+        return self.manifest_dir / f"{name}.json"
+
+    def load_manifest(self, name: str) -> Optional[Dict]:
+        """ """
+        manifest_path = self.get_manifest_path(name)
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def write_manifest(self, stage: Stage, adopted: bool = False):
+        """ """
+        manifest = {
+            "stage": stage.name,
+            "params_hash": stage.get_params_hash(),
+            "params": to_serializable(stage.params),
+            "inputs": {name: self.get_output_hashes(name) for name in stage.inputs},
+            "outputs": {str(path): hash_file(path) for path in stage.get_output_files()},
+            "adopted": adopted,
+            "updated": datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+        }
+        manifest_path = self.get_manifest_path(stage.name)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    def get_output_hashes(self, name: str) -> Optional[Dict[str, str]]:
+        """
+        Content hashes of the outputs of a stage: of the files if they exist, otherwise the hashes recorded in its
+        manifest. None if neither is available.
+        """
+        stage = self.stages[name]
+        if stage.outputs_exist():
+            return {str(path): hash_file(path) for path in stage.get_output_files()}
+
+        manifest = self.load_manifest(name)
+        return manifest["outputs"] if manifest else None
+
+    def get_stale_reason(self, stage: Stage, running: Optional[set] = None) -> Optional[str]:
+        """
+        Why the stage has to run, or None if it is up to date. running contains the stages that will run before it.
+        Outputs that are missing without any other reason to run (e.g. deleted generations) are reported as
+        "outputs missing".
+        """
+        running = running or set()
+
+        upstream = [name for name in stage.inputs if name in running]
+        if upstream:
+            return f"upstream {upstream[0]} runs"
+
+        manifest = self.load_manifest(stage.name)
+        if manifest is None:
+            if not stage.outputs_exist():
+                return "outputs missing"
+            return None if self.adopt_existing else "no manifest"
+
+        if manifest["params_hash"] != stage.get_params_hash():
+            return "params changed"
+
+        for name in stage.inputs:
+            if manifest["inputs"].get(name) != self.get_output_hashes(name):
+                return f"input {name} changed"
+
+        if not stage.outputs_exist():
+            return "outputs missing"
+
+        return None
+
+    def plan(self, targets: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Which stages would run and why, without running anything.
+
+        Args:
+            targets: stages to bring up to date (together with their upstream stages); all stages if None
+
+        Returns:
+            Dataframe with the columns stage, action (run, fresh, adopt) and reason
+        """
+        names = self.get_required_stages(targets)
+        running, reasons = set(), {}
+
+        for name in names:
+            reason = self.get_stale_reason(self.stages[name], running)
+            if reason is None:
+                continue
+            # missing outputs are only recreated for the targets; other stages are recreated when a dependent runs
+            if targets:
+                is_target = name in targets
+            else:
+                is_target = not any(dependent in names for dependent in self.get_dependents(name))
+            if reason == "outputs missing" and not is_target:
+                reasons[name] = None
+                continue
+            running.add(name)
+            reasons[name] = reason
+
+        # recreate the missing outputs of the stages whose dependents run
+        for name in reversed(names):
+            if name in running:
+                for upstream in self.stages[name].inputs:
+                    if upstream in reasons and reasons[upstream] is None:
+                        running.add(upstream)
+                        reasons[upstream] = f"needed by {name}"
+
+        records = []
+        for name in names:
+            if name in running:
+                records.append({"stage": name, "action": "run", "reason": reasons[name]})
+            elif name in reasons:
+                records.append({"stage": name, "action": "fresh", "reason": "outputs missing, not needed"})
+            elif self.load_manifest(name) is None:
+                records.append({"stage": name, "action": "adopt", "reason": "outputs exist"})
+            else:
+                records.append({"stage": name, "action": "fresh", "reason": None})
+
+        return pd.DataFrame(records, columns=["stage", "action", "reason"])
+
+    def get_required_stages(self, targets: Optional[List[str]] = None) -> List[str]:
+        """Names of the targets and all their upstream stages, in topological (insertion) order."""
+        if targets is None:
+            return list(self.stages)
+
+        required = set()
+        to_visit = list(targets)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in required:
+                required.add(name)
+                to_visit.extend(self.stages[name].inputs)
+
+        return [name for name in self.stages if name in required]
+
+    def run(self, targets: Optional[List[str]] = None, dry_run: bool = False, num_workers: int = 1) -> pd.DataFrame:
+        """
+        Brings the targets up to date, running the stale stages (see plan) with up to num_workers stages in
+        parallel. A stage that fails blocks its dependents, but independent branches continue.
+
+        Returns:
+            Dataframe with the columns stage, status (completed, fresh, adopted, failed, blocked or, for a dry run,
+            run), reason, duration_s and error
+        """
+        plan_df = self.plan(targets)
+        if dry_run:
+            logger.info(f"Pipeline plan:\n{plan_df.to_string(index=False)}")
+            return plan_df.rename(columns={"action": "status"})
+
+        records = {}
+        for row in plan_df.itertuples(index=False):
+            if row.action == "adopt":
+                self.write_manifest(self.stages[row.stage], adopted=True)
+            status = {"run": "pending", "adopt": "adopted", "fresh": "fresh"}[row.action]
+            records[row.stage] = {
+                "stage": row.stage,
+                "status": status,
+                "reason": row.reason,
+                "duration_s": None,
+                "error": None,
+            }
+
+        # stages reseed the global random number generators (e.g. create_folds and OfflineTrainer.train), so parallel
+        # stages run in separate processes to stay reproducible, as in run_sweep
+        if num_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+
+        with executor:
+            running = {}
+            while True:
+                for name, record in records.items():
+                    if record["status"] != "pending":
+                        continue
+                    upstream_statuses = [records[upstream]["status"] for upstream in self.stages[name].inputs]
+                    if any(status in ["failed", "blocked"] for status in upstream_statuses):
+                        record["status"] = "blocked"
+                    elif all(status in ["completed", "fresh", "adopted"] for status in upstream_statuses) and not any(
+                        records[other]["status"] in ["pending", "running"]
+                        for other in self.stages[name].after
+                        if other in records
+                    ):
+                        # upstream stages that were recomputed may have produced the same outputs as before
+                        if self.get_stale_reason(self.stages[name]) is None:
+                            record["status"] = "fresh"
+                            continue
+                        record["status"] = "running"
+                        logger.info(f"Running stage {name} ({record['reason']}).")
+                        try:
+                            running[executor.submit(run_stage, self.stages[name])] = name
+                        except Exception:
+                            # e.g. a broken process pool after a worker died
+                            record["status"] = "failed"
+                            record["error"] = traceback.format_exc()
+                            logger.error(f"Stage {name} could not be started:\n{record['error']}")
+
+                # records are in topological order, so without running stages nothing is left to unlock
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        records[name]["duration_s"] = round(future.result(), 1)
+                        self.write_manifest(self.stages[name])
+                        records[name]["status"] = "completed"
+                    except Exception:
+                        records[name]["status"] = "failed"
+                        records[name]["error"] = traceback.format_exc()
+                        logger.error(f"Stage {name} failed:\n{records[name]['error']}")
+
+        summary_df = pd.DataFrame(records.values())
+        logger.info(f"Pipeline summary:\n{summary_df.drop(columns=['error']).to_string(index=False)}")
+        return summary_df
@@ -0,0 +1,357 @@
+import logging
+import pandas as pd
+import re
+import sys
+
+from copy import deepcopy
+from functools import partial
+from pathlib import Path
+from typing import Dict
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.pipeline.dag import Pipeline, Stage
+from src.test.sweep import SweepJob, expand_sweep
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# stages of a test in the order of the pipeline; pipeline.until selects the last one to build
+STAGE_KINDS = ["generate", "score", "pair", "fold", "test", "distance", "plot"]
+
+
+def get_jobs(cfg: Dict) -> list:
+    """The tests of the pipeline: the jobs of the sweep section if there is one, otherwise the pair tau1, tau2."""
+    if cfg.get("sweep"):
+        return expand_sweep(cfg)
+
+    return [
+        SweepJob(
+            model_name1=cfg["tau1"]["model_id"],
+            seed1=cfg["tau1"]["gen_seed"],
+            model_name2=cfg["tau2"]["model_id"],
+            seed2=cfg["tau2"]["gen_seed"],
+            fold_size=cfg["test_params"]["fold_size"],
+            noise=cfg["test_params"].get("noise", 0),
+        )
+    ]
+
+
+# Stage functions are module-level and bound with functools.partial, so that the stages can be pickled and run in
+# worker processes (see Pipeline.run).
+
+
+def generate_model(model_cfg: Dict, metric_cfg: Dict, batch_size: int, dir_prefix: str, eval_cfg: Dict):
+    """ """
+    from src.evaluation.generate import generate_on_dataset
+
+    # scoring reads the generations of the whole dataset
+    generate_on_dataset(
+        deepcopy(model_cfg),
+        metric_cfg,
+        num_samples=-1,
+        batch_size=batch_size,
+        use_wandb=False,
+        overwrite=True,
+        dir_prefix=dir_prefix,
+        backend_cfg=eval_cfg,
+    )
+
+
+def score_model(
+    model_name: str, seed: str, metric: str, only_continuations: bool, gen_dir: Path, score_dir: Path, noise: float
+):
+    """ """
+    from src.evaluation.evaluate import evaluate_single_model
+
+    evaluate_single_model(
+        model_name=model_name,
+        seed=seed,
+        metric=metric,
+        overwrite=True,
+        only_continuation=only_continuations,
+        gen_dir=gen_dir,
+        score_dir=score_dir,
+        noise=noise,
+    )
+
+
+def pair_scores(job: SweepJob, metric: str, score_dir: Path, test_dir: Path, only_continuations: bool):
+    """ """
+    from src.test.preprocessing import create_common_json
+
+    create_common_json(
+        job.model_name1,
+        job.seed1,
+        job.model_name2,
+        job.seed2,
+        metric,
+        overwrite=True,
+        score_dir=score_dir,
+        test_dir=test_dir,
+        only_continuations=only_continuations,
+        noise=job.noise,
+    )
+
+
+def fold_scores(job: SweepJob, metric: str, test_dir: Path, only_continuations: bool):
+    """ """
+    from src.test.preprocessing import create_folds
+
+    create_folds(
+        job.model_name1,
+        job.seed1,
+        job.model_name2,
+        job.seed2,
+        metric,
+        fold_size=job.fold_size,
+        overwrite=True,
+        test_dir=test_dir,
+        only_continuations=only_continuations,
+        noise=job.noise,
+    )
+
+
+def get_test(job_cfg: Dict, train_cfg, job: SweepJob):
+    """ """
+    from src.test.test import AuditingTest
+
+    # the pipeline only runs a stage if it is stale, so the test always overwrites
+    return AuditingTest(
+        job_cfg,
+        train_cfg,
+        job_cfg["dir_prefix"],
+        overwrite=True,
+        use_wandb=job_cfg["logging"]["use_wandb"],
+        only_continuations=job_cfg["test_params"]["only_continuations"],
+        noise=job.noise,
+    )
+
+
+def run_test(job_cfg: Dict, train_cfg, job: SweepJob):
+    """ """
+    get_test(job_cfg, train_cfg, job).run(
+        model_name1=job.model_name1,
+        seed1=job.seed1,
+        model_name2=job.model_name2,
+        seed2=job.seed2,
+        fold_size=job.fold_size,
+        analyze_distance=False,
+        create_folds=False,
+    )
+
+
+def run_distance(job_cfg: Dict, train_cfg, job: SweepJob):
+    """ """
+    get_test(job_cfg, train_cfg, job).run(
+        model_name1=job.model_name1,
+        seed1=job.seed1,
+        model_name2=job.model_name2,
+        seed2=job.seed2,
+        fold_size=job.fold_size,
+        run_davtt=False,
+        analyze_distance=True,
+        plot_distance=False,
+    )
+
+
+def plot_distance(dist_path: Path, job: SweepJob, metric: str, dir_prefix: str):
+    """ """
+    from src.analysis.plot import distance_box_plot
+
+    distance_box_plot(
+        pd.read_csv(dist_path),
+        job.model_name1,
+        job.seed1,
+        job.seed2,
+        job.model_name2,
+        metric=metric,
+        dir_prefix=dir_prefix,
+        overwrite=True,
+        noise=job.noise,
+    )
+
+
+def add_model_stages(pipeline: Pipeline, cfg: Dict, tau: str, model_name: str, seed: str, noise: float, kinds) -> str:
+    """
+    Adds the generate and score stages of a model, using the model config of tau (tau1 or tau2).
+
+    Returns:
+        Name of the last stage added
+    """
+    dir_prefix = cfg["dir_prefix"]
+    metric = cfg["metric"]["metric"]
+    only_continuations = cfg["test_params"]["only_continuations"]
+
+    gen_dir = ROOT_DIR / dir_prefix / "model_outputs"
+    score_dir = ROOT_DIR / dir_prefix / "model_scores"
+
+    model_cfg = deepcopy(cfg[tau])
+    model_cfg["model_id"] = model_name
+    model_cfg["gen_seed"] = seed
+
+    generate_stage = pipeline.add(
+        Stage(
+            name=f"generate/{model_name}_{seed}",
+            func=partial(generate_model, model_cfg, cfg["metric"], cfg["eval"]["batch_size"], dir_prefix, cfg["eval"]),
+            outputs=[gen_dir / f"{model_name}_{seed}" / "continuations.json"],
+            params={"model_cfg": model_cfg, "dataset_name": cfg["metric"]["dataset_name"]},
+        )
+    )
+    if "score" not in kinds:
+        return generate_stage.name
+
+    cont_string = "continuation_" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+
+    score_stage = pipeline.add(
+        Stage(
+            name=f"score/{model_name}_{seed}{noise_string}",
+            func=partial(score_model, model_name, seed, metric, only_continuations, gen_dir, score_dir, noise),
+            outputs=[score_dir / f"{model_name}_{seed}" / f"{cont_string}scores{noise_string}.json"],
+            inputs=[generate_stage.name],
+            params={"metric": metric, "only_continuations": only_continuations, "noise": noise},
+        )
+    )
+    return score_stage.name
+
+
+def add_test_stages(pipeline: Pipeline, cfg: Dict, train_cfg, job: SweepJob, kinds, plot: bool = True):
+    """Adds the stages from the scores of both models of a job to its test, distance and plot."""
+    from src.test.test import get_num_train_samples
+
+    dir_prefix = cfg["dir_prefix"]
+    metric = cfg["metric"]["metric"]
+    only_continuations = cfg["test_params"]["only_continuations"]
+    noise = job.noise
+
+    score_dir = ROOT_DIR / dir_prefix / "model_scores"
+    test_dir = ROOT_DIR / dir_prefix / "test_outputs"
+    pair_name = f"{job.model_name1}_{job.seed1}_{job.model_name2}_{job.seed2}"
+    pair_dir = test_dir / pair_name
+
+    cont_string = "continuation_" if only_continuations else ""
+    results_cont_string = "_continuations" if only_continuations else ""
+    noise_string = f"_noise_{noise}" if noise > 0 else ""
+
+    score_stages = [
+        add_model_stages(pipeline, cfg, "tau1", job.model_name1, job.seed1, noise, kinds),
+        add_model_stages(pipeline, cfg, "tau2", job.model_name2, job.seed2, noise, kinds),
+    ]
+    if "pair" not in kinds:
+        return
+
+    job_cfg = deepcopy(cfg)
+    job_cfg["test_params"]["fold_size"] = job.fold_size
+    job_cfg["test_params"]["noise"] = noise
+
+    pair_stage = pipeline.add(
+        Stage(
+            name=f"pair/{pair_name}{noise_string}",
+            func=partial(pair_scores, job, metric, score_dir, test_dir, only_continuations),
+            outputs=[pair_dir / f"{cont_string}scores{noise_string}.json"],
+            inputs=score_stages,
+            params={"metric": metric, "only_continuations": only_continuations, "noise": noise},
+        )
+    )
+
+    if "fold" in kinds:
+        # the folds of all fold sizes have the same file names, so the folds of a fold size are only created after
+        # the tests of the previous fold sizes have used (and removed) theirs
+        test_pattern = re.compile(rf"test/{re.escape(pair_name + noise_string)}_\d+")
+        previous_tests = [name for name in pipeline.stages if test_pattern.fullmatch(name)]
+        fold_stage = pipeline.add(
+            Stage(
+                name=f"fold/{pair_name}{noise_string}_{job.fold_size}",
+                func=partial(fold_scores, job, metric, test_dir, only_continuations),
+                outputs=[pair_dir / f"{cont_string}scores{noise_string}_fold_*.json"],
+                inputs=[pair_stage.name],
+                params={"fold_size": job.fold_size},
+                after=previous_tests,
+            )
+        )
+
+    if "test" in kinds:
+        epsilon = cfg["epsilon"]
+        from src.analysis.results_store import get_schedule_suffix
+
+        run_string = f"{noise_string}{get_schedule_suffix(train_cfg)}"
+        results_file = f"kfold_test_results{results_cont_string}_{job.fold_size}_epsilon_{epsilon}{run_string}.csv"
+        pipeline.add(
+            Stage(
+                name=f"test/{pair_name}{noise_string}_{job.fold_size}",
+                func=partial(run_test, job_cfg, train_cfg, job),
+                outputs=[pair_dir / results_file],
+                inputs=[fold_stage.name],
+                params={"epsilon": epsilon, "net": cfg["net"], "train_cfg": train_cfg},
+            )
+        )
+
+    if "distance" in kinds:
+        from src.analysis.analyze import get_distance_file_name
+
+        num_train_samples = get_num_train_samples(cfg, train_cfg, job.fold_size)
+        num_runs = cfg["analysis"]["num_runs"]
+        dist_path = pair_dir / get_distance_file_name(num_train_samples, num_runs, noise)
+
+        distance_stage = pipeline.add(
+            Stage(
+                name=f"distance/{pair_name}{noise_string}_{num_train_samples}_{num_runs}",
+                func=partial(run_distance, job_cfg, train_cfg, job),
+                outputs=[dist_path],
+                inputs=[pair_stage.name],
+                params={"analysis": cfg["analysis"], "net": cfg["net"], "train_cfg": train_cfg},
+            )
+        )
+
+        # the box plot is named after the model pair only, so it is made from the distances of one fold size
+        if "plot" in kinds and plot:
+            pipeline.add(
+                Stage(
+                    name=f"plot/{pair_name}{noise_string}",
+                    func=partial(plot_distance, dist_path, job, metric, dir_prefix),
+                    outputs=[pair_dir / f"{metric}_distance_box_plot{noise_string}.pdf"],
+                    inputs=[distance_stage.name],
+                )
+            )
+
+
+def build_test_pipeline(cfg: Dict, train_cfg) -> Pipeline:
+    """
+    Pipeline from the generations of all models to the tests, distances and plots of all model pairs (see
+    get_jobs), up to the stage pipeline.until.
+    """
+    pipeline_cfg = cfg.get("pipeline", {})
+    until = pipeline_cfg.get("until", "plot")
+    kinds = STAGE_KINDS[: STAGE_KINDS.index(until) + 1]
+
+    pipeline = Pipeline(
+        ROOT_DIR / cfg["dir_prefix"] / "pipeline_manifests",
+        adopt_existing=pipeline_cfg.get("adopt_existing", True),
+    )
+
+    plotted = set()
+    for job in get_jobs(cfg):
+        plot_key = (job.model_name1, job.seed1, job.model_name2, job.seed2, job.noise)
+        add_test_stages(pipeline, cfg, train_cfg, job, kinds, plot=plot_key not in plotted)
+        plotted.add(plot_key)
+
+    return pipeline
+
+
+def run_pipeline(cfg: Dict, train_cfg) -> pd.DataFrame:
+    """
+    Builds the pipeline of the config and brings it up to date; with pipeline.dry_run, only shows which stages would
+    run and why.
+    """
+    pipeline_cfg = cfg.get("pipeline", {})
+    pipeline = build_test_pipeline(cfg, train_cfg)
+
+    return pipeline.run(
+        dry_run=pipeline_cfg.get("dry_run", False),
+        num_workers=pipeline_cfg.get("num_workers") or 1,
+    )
@@ -0,0 +1,196 @@
+import logging
+import numpy as np
+import pandas as pd
+import sys
+import torch
+
+from pathlib import Path
+from sklearn.model_selection import train_test_split, KFold
+from tqdm import tqdm
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+from src.analysis.nn_distance import StackedCMLP
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedOfflineTrainer:
+    """
+    Runs the test of OfflineTrainer with the fixed batch schedule on many folds of the same size at once, e.g. the
+    null replicates of power_simulation.network_alpha.
+
+    The betting networks of all folds are stacked (see StackedCMLP) and trained in lockstep. Every fold keeps its own
+    network, minibatch shuffle, Adam state, early stopper, wealth and futility counter; folds that have finished
+    training for the current sequence, rejected or stopped for futility are masked out of the updates. Since the
+    folds have the same size, they share the sequence batches and train/val splits of OfflineTrainer.
+    """
+
+    def __init__(self, train_cfg, net_cfg, scores1, scores2, epsilon: float = 0):
+        """
+        Args:
+            train_cfg: TrainCfg of the test
+            net_cfg: config of the betting network, as in AuditingTest.davtt
+            scores1: scores of model 1, shape (num_folds, fold_size)
+            scores2: scores of model 2, shape (num_folds, fold_size)
+            epsilon: tolerance of the test
+        """
+        if train_cfg.batch_schedule != "fixed":
+            raise ValueError("BatchedOfflineTrainer only runs the fixed batch schedule.")
+
+        self.seed = train_cfg.seed
+        self.epochs = train_cfg.epochs
+        self.seqs = train_cfg.seqs
+        self.alpha = train_cfg.alpha
+        self.T = train_cfg.T
+        self.bs = train_cfg.batch_size
+        # OfflineTrainer uses the sequence batch size within the network as well
+        self.net_bs = train_cfg.batch_size
+        self.patience = train_cfg.earlystopping.patience
+        self.delta = train_cfg.earlystopping.delta
+        self.futility_patience = train_cfg.futility_patience
+        self.epsilon = epsilon
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        self.x = torch.as_tensor(np.asarray(scores1), dtype=torch.float32, device=self.device)
+        self.y = torch.as_tensor(np.asarray(scores2), dtype=torch.float32, device=self.device)
+        if self.x.shape != self.y.shape or self.x.dim() != 2:
+            raise ValueError(
+                f"Expected scores of shape (num_folds, fold_size), got {self.x.shape} and {self.y.shape}."
+            )
+        self.num_folds, fold_size = self.x.shape
+
+        # the same sequence batches as OfflineTrainer.get_kfold_sequence_batches, for every fold
+        num_batches = (fold_size + self.bs - 1) // self.bs
+        kf = KFold(n_splits=num_batches, shuffle=True, random_state=self.seed)
+        self.batches = [batch_indices for _, batch_indices in kf.split(np.arange(fold_size))]
+
+        torch.manual_seed(self.seed)
+        self.nets = StackedCMLP(
+            net_cfg,
+            self.num_folds,
+            train_cfg.lr,
+            weight_decay=train_cfg.l2_lambda,
+            l1_lambda=train_cfg.l1_lambda,
+            device=self.device,
+        )
+
+    @torch.no_grad()
+    def evaluate(self, indices: np.ndarray):
+        """Log betting score (with epsilon) and loss (without) of every fold on the samples at indices."""
+        indices = torch.as_tensor(indices, device=self.device)
+        sum_out = torch.zeros(self.num_folds, device=self.device)
+        for start in range(0, len(indices), self.net_bs):
+            batch = indices[start : start + self.net_bs]
+            sum_out += self.nets.forward(self.x[:, batch], self.y[:, batch]).sum(dim=1)
+        return sum_out - self.epsilon * len(indices), -sum_out / len(indices)
+
+    def train_epoch(self, indices: np.ndarray, active: torch.Tensor, generator: torch.Generator):
+        """One epoch of minibatch training on the samples at indices, with an independent shuffle per fold."""
+        indices = torch.as_tensor(indices, device=self.device)
+        keys = torch.rand((self.num_folds, len(indices)), generator=generator).to(self.device)
+        order = indices[torch.argsort(keys, dim=1)]
+
+        for start in range(0, len(indices), self.net_bs):
+            batch = order[:, start : start + self.net_bs]
+            mask = torch.ones(batch.shape, device=self.device)
+            self.nets.train_step(torch.gather(self.x, 1, batch), torch.gather(self.y, 1, batch), mask, active)
+
+    def train(self) -> pd.DataFrame:
+        """
+        Returns:
+            One row per fold with the columns of results_store.summarize_folds, so that the power over sequences
+            follows from results_store.power_curve_from_folds
+        """
+        generator = torch.Generator().manual_seed(self.seed)
+        log_threshold = np.log(1.0 / self.alpha)
+        num_sequences = min(self.seqs, len(self.batches))
+
+        log_scores = torch.zeros((self.num_folds, num_sequences), device=self.device)
+        log_scores[:, 0], _ = self.evaluate(self.batches[0])
+        log_wealth = log_scores[:, 0].clone() if self.T == 0 else torch.zeros(self.num_folds, device=self.device)
+
+        rejected = log_scores[:, 0] > log_threshold
+        stop_sequence = torch.where(rejected, 0.0, torch.full((self.num_folds,), float("nan"), device=self.device))
+        futility_stop = torch.zeros(self.num_folds, dtype=torch.bool, device=self.device)
+        num_futile_sequences = torch.zeros(self.num_folds, dtype=torch.long, device=self.device)
+        last_sequence = torch.zeros(self.num_folds, dtype=torch.long, device=self.device)
+        scored_samples = torch.full((self.num_folds,), len(self.batches[0]), device=self.device)
+
+        # in the first sequence, the first batch is split into train and val set
+        train_positions, val_positions = train_test_split(
+            np.arange(len(self.batches[0])), test_size=0.2, random_state=self.seed
+        )
+        train_indices = self.batches[0][train_positions]
+        val_indices = self.batches[0][val_positions]
+
+        for k in tqdm(range(1, num_sequences)):
+            running = ~(rejected | futility_stop)
+            if not running.any():
+                break
+
+            # vectorized version of the early stopper, reset for every sequence
+            training = running.clone()
+            min_val_loss = torch.full((self.num_folds,), float("inf"), device=self.device)
+            counter = torch.zeros(self.num_folds, dtype=torch.long, device=self.device)
+            stop_val_loss = torch.zeros(self.num_folds, device=self.device)
+
+            for epoch in range(self.epochs):
+                self.train_epoch(train_indices, training, generator)
+                _, val_loss = self.evaluate(val_indices)
+
+                improved = val_loss < min_val_loss
+                worse = ~improved & (val_loss > min_val_loss + self.delta)
+                min_val_loss = torch.where(improved, val_loss, min_val_loss)
+                counter = torch.where(improved, torch.zeros_like(counter), counter + worse.long())
+                stop_now = training & (counter >= self.patience)
+                if (epoch + 1) == self.epochs:
+                    stop_now = training
+
+                stop_val_loss = torch.where(stop_now, val_loss, stop_val_loss)
+                training = training & ~stop_now
+                if not training.any():
+                    break
+
+            # folds that stopped training are frozen, so the test batch can be scored for all of them at once
+            test_indices = self.batches[k]
+            log_score, _ = self.evaluate(test_indices)
+            log_scores[:, k] = torch.where(running, log_score, log_scores[:, k])
+            if k >= self.T:
+                log_wealth = torch.where(running, log_scores[:, self.T : k + 1].sum(dim=1), log_wealth)
+
+            last_sequence = torch.where(running, k, last_sequence)
+            scored_samples = scored_samples + running * len(test_indices)
+
+            reject_now = running & (log_wealth > log_threshold)
+            rejected = rejected | reject_now
+            stop_sequence = torch.where(reject_now, float(k), stop_sequence)
+
+            if self.futility_patience is not None:
+                # see OfflineTrainer.is_futile
+                remaining_samples = sum(len(self.batches[j]) for j in range(k + 1, num_sequences))
+                growth = torch.nan_to_num(-stop_val_loss - self.epsilon, nan=0.0, posinf=0.0, neginf=0.0)
+                futile = growth * remaining_samples < log_threshold - log_wealth
+                num_futile_sequences = torch.where(futile, num_futile_sequences + 1, 0)
+                futility_stop = futility_stop | (
+                    running & ~reject_now & (num_futile_sequences >= self.futility_patience)
+                )
+
+            # former train and val set become the new train set, the current test batch the new val set
+            train_indices = np.concatenate([train_indices, val_indices])
+            val_indices = test_indices
+
+        return pd.DataFrame(
+            {
+                "fold_number": np.arange(self.num_folds),
+                "last_sequence": last_sequence.cpu().numpy(),
+                "stop_sequence": stop_sequence.cpu().numpy(),
+                "final_wealth": torch.exp(log_wealth).cpu().numpy(),
+                "test_positive": rejected.int().cpu().numpy(),
+                "futility_stop": futility_stop.int().cpu().numpy(),
+                "scored_samples": scored_samples.cpu().numpy(),
+            }
+        )
@@ -1,6 +1,5 @@
 import logging
 import numpy as np
-import pandas as pd
 import sys
 
 from abc import ABC, abstractmethod
@@ -12,9 +11,10 @@ project_root = Path(__file__).resolve().parents[2]
 if str(project_root) not in sys.path:
     sys.path.append(str(project_root))
 
-from src.analysis.analyze import get_distance_scores, get_mean_and_std_for_nn_distance
+from src.analysis.analyze import get_distance_file_name, get_mean_and_std_for_nn_distance
+from src.analysis.distance_jobs import DistanceJob, run_distance_jobs
 
-SCRIPT_DIR = Path(__file__).resolve().parent
+ROOT_DIR = Path(__file__).resolve().parents[2]
 
 
 class CalibrationStrategy(ABC):
@@ -29,6 +29,10 @@ class CalibrationStrategy(ABC):
         self.test_dir = test_dir
         self.overwrite = overwrite
 
+        # parallelism of the distance computations; by default, the cpus are split evenly over the distance jobs
+        self.num_workers = calibration_params.get("num_workers", None)
+        self.threads_per_worker = calibration_params.get("threads_per_worker", None)
+
     def attach_logger(self, logger: logging.Logger):
         self.logger = logger
 
@@ -56,44 +60,72 @@ class CalibrationStrategy(ABC):
         """
         Compute the neural net distance and its standard deviation between the base model and the test model.
         """
-        test_result_dir = SCRIPT_DIR / dir_prefix / self.test_dir / f"{model_name1}_{seed1}_{model_name2}_{seed2}"
-        test_result_dir.mkdir(parents=True, exist_ok=True)
-
-        noise_string = f"_noise_{dist_kwargs.get('noise', 0)}" if dist_kwargs.get("noise", 0) > 0 else ""
+        return self.compute_distances(
+            model_name1, seed1, [(model_name2, seed2)], num_train_samples, dir_prefix, dist_kwargs
+        )[0]
 
-        dist_path = test_result_dir / f"distance_scores_{num_train_samples}_{self.num_runs}{noise_string}.csv"
-        if dist_path.exists() and not self.overwrite:
-            self.logger.info(f"Loading existing distance analysis from {dist_path}.")
-            distance_df = pd.read_csv(dist_path)
-        else:
-            self.logger.info(
-                f"Calculating neural net distance between {model_name1}_{seed1} "
-                f"and {model_name2}_{seed2} "
-                f"on {num_train_samples} samples for {self.num_runs} runs."
+    def compute_distances(
+        self,
+        model_name1: str,
+        seed1: str,
+        models: List[Tuple[str, str]],
+        num_train_samples: Union[int, List],
+        dir_prefix: str,
+        dist_kwargs: Dict,
+    ) -> List[Tuple[float, float]]:
+        """
+        Compute the neural net distance and its standard deviation between the base model and each of the given
+        (model_name, seed) pairs. The distances are computed in parallel and existing results are loaded from disk.
+        """
+        jobs = []
+        for model_name2, seed2 in models:
+            test_result_dir = ROOT_DIR / dir_prefix / self.test_dir / f"{model_name1}_{seed1}_{model_name2}_{seed2}"
+            test_result_dir.mkdir(parents=True, exist_ok=True)
+
+            # the csv is only an export, whether the distances are computed is decided by the distance cache
+            dist_path = test_result_dir / get_distance_file_name(
+                num_train_samples, self.num_runs, dist_kwargs.get("noise", 0)
             )
-            distance_df = get_distance_scores(
-                model_name1,
-                seed1,
-                seed2,
-                model_name2=model_name2,
-                num_samples=num_train_samples,
-                overwrite=self.overwrite,
-                num_runs=self.num_runs,
-                dir_prefix=dir_prefix,
-                test_dir=self.test_dir,
-                **dist_kwargs,
-                # **kwargs,
+
+            jobs.append(
+                DistanceJob(
+                    model_name1,
+                    seed1,
+                    model_name2,
+                    seed2,
+                    dist_kwargs={
+                        "num_samples": num_train_samples,
+                        "overwrite": self.overwrite,
+                        "num_runs": self.num_runs,
+                        "dir_prefix": dir_prefix,
+                        "test_dir": self.test_dir,
+                        **dist_kwargs,
+                    },
+                    dist_path=dist_path,
+                )
             )
-            distance_df.to_csv(dist_path, index=False)
-            self.logger.info(f"Distance analysis results saved to {dist_path}.")
 
-        mean_nn_distance, std_nn_distance = get_mean_and_std_for_nn_distance(distance_df)
-        self.logger.info(
-            f"Mean neural net distance between {model_name1}_{seed1} and {model_name2}_{seed2}: "
-            f"{mean_nn_distance}, Std: {std_nn_distance}"
+        distance_dfs = run_distance_jobs(
+            jobs,
+            num_workers=self.num_workers,
+            threads_per_worker=self.threads_per_worker,
+            overwrite=self.overwrite,
         )
 
-        return mean_nn_distance, std_nn_distance
+        results = []
+        for (model_name2, seed2), distance_df in zip(models, distance_dfs):
+            if distance_df is None:
+                raise FileNotFoundError(
+                    f"No scores of {model_name1}_{seed1} and {model_name2}_{seed2} to compute their distance from."
+                )
+            mean_nn_distance, std_nn_distance = get_mean_and_std_for_nn_distance(distance_df)
+            self.logger.info(
+                f"Mean neural net distance between {model_name1}_{seed1} and {model_name2}_{seed2}: "
+                f"{mean_nn_distance}, Std: {std_nn_distance}"
+            )
+            results.append((mean_nn_distance, std_nn_distance))
+
+        return results
 
 
 class DefaultStrategy(CalibrationStrategy):
@@ -203,11 +235,11 @@ class IntervalStrategy(CalibrationStrategy):
         # TODO: add checks that this exists
         # lower epsilon bound
         self.lower_model = calibration_params["lower_model_name"]
-        self.lower_seed = calibration_params["lower_seed"]
+        self.lower_seed = calibration_params.get("lower_seed", calibration_params.get("lower_model_seed"))
 
         # upper epsilon bound
         self.upper_model = calibration_params["upper_model_name"]
-        self.upper_seed = calibration_params["upper_seed"]
+        self.upper_seed = calibration_params.get("upper_seed", calibration_params.get("upper_model_seed"))
 
     def calculate_epsilons(
         self,
@@ -229,11 +261,18 @@ class IntervalStrategy(CalibrationStrategy):
             ("upper", self.upper_model, self.upper_seed),
         ]
 
-        for model_type, model, seed in models:
-            distances[model_type], stds[model_type] = self.compute_distance(
-                base_model, base_seed, model, seed, num_train_samples, dir_prefix, dist_kwargs
-            )
+        # the three distances are independent, so they are computed in parallel
+        results = self.compute_distances(
+            base_model,
+            base_seed,
+            [(model, seed) for _, model, seed in models],
+            num_train_samples,
+            dir_prefix,
+            dist_kwargs,
+        )
+        for (model_type, _, _), (distance, std) in zip(models, results):
+            distances[model_type], stds[model_type] = distance, std
 
-        epsilons = np.linspace(distances["lower"], distances["upper"], self.epsilon_ticks).to_list()
+        epsilons = np.linspace(distances["lower"], distances["upper"], self.epsilon_ticks).tolist()
 
         return epsilons, distances["test"], stds["test"]
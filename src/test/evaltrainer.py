@@ -5,16 +5,11 @@ import pandas as pd
 import random
 import sys
 import torch
-import wandb
 
-from datasets import load_dataset
 from pathlib import Path
-from peft import AutoPeftModelForCausalLM
 from scipy.stats import wasserstein_distance, ks_2samp
 from sklearn.model_selection import train_test_split, KFold
 from torch.utils.data import DataLoader, ConcatDataset, Subset, Dataset
-from transformers import pipeline, AutoTokenizer
-from transformers.utils import is_flash_attn_2_available
 from tqdm import tqdm
 from typing import Optional, Dict, List
 
@@ -27,8 +22,10 @@ if str(project_root) not in sys.path:
 from src.test.dataloader import ScoresDataset, collate_fn, load_into_scores_ds
 
 # from arguments import Cfg
-from src.evaluation.score import eval_on_metric
+from src.utils import metrics
+from src.utils.tracing import get_tracer
 from src.utils.utils import translate_model_kwargs, time_block, NestedKeyDataset, terminator
+from src.utils.wandb_logger import BufferedWandbLogger
 
 orig_models = importlib.import_module("deep-anytime-testing.trainer.trainer", package="deep-anytime-testing")
 Trainer = getattr(orig_models, "Trainer")
@@ -126,11 +123,28 @@ class OfflineTrainer(Trainer):
         self.batches, self.batch_indices = self.get_kfold_sequence_batches()
         logger.info(f"Number of sequence batches created: {len(self.batches)}")
 
+        # the adaptive schedule cuts its test batches from the samples of the fold in the order of the fixed batches,
+        # so that every sample keeps the drift of its fixed batch
+        self.batch_schedule = train_cfg.batch_schedule
+        if self.batch_schedule not in ["fixed", "adaptive"]:
+            raise ValueError(f"Unknown batch schedule {self.batch_schedule}, use 'fixed' or 'adaptive'.")
+        self.min_bs = train_cfg.min_batch_size
+        self.max_bs = train_cfg.max_batch_size
+        self.ordered_samples = ConcatDataset(self.batches)
+        self.next_sample = 0
+
+        # futility stopping, see is_futile
+        self.futility_patience = train_cfg.futility_patience
+        self.num_futile_sequences = 0
+        self.futility_stop = False
+
         # Epsilon for tolerance test
         self.epsilon = epsilon
 
         # for logging/tracking
         self.use_wandb = use_wandb
+        self.wandb_logger = None
+        self.wandb_log_interval = train_cfg.wandb_log_interval
         self.verbose = verbose
         self.current_total_epoch = 0
         self.columns = [
@@ -142,9 +156,12 @@ class OfflineTrainer(Trainer):
             "test_loss",
             "betting_score",
             "wealth",
+            "test_batch_size",
+            "scored_samples",
             "epochs_until_end_of_sequence",
             "sequences_until_end_of_experiment",
             "test_positive",
+            "futility_stop",
         ]
         self.data = pd.DataFrame(columns=self.columns)
 
@@ -179,15 +196,21 @@ class OfflineTrainer(Trainer):
             "test_loss": np.nan,
             "betting_score": np.nan,
             "wealth": np.nan,
+            "test_batch_size": np.nan,
+            "scored_samples": np.nan,
             "epochs_until_end_of_sequence": np.nan,
             "sequences_until_end_of_experiment": np.nan,
             "test_positive": int(0),
+            "futility_stop": int(0),
         }
         new_data = pd.DataFrame([row])
         self.data = new_data.copy() if self.data.empty else pd.concat([self.data, new_data], ignore_index=True)
 
-    def add_sequence_data(self, sequence, test_loss, betting_score, wealth):
-        """Update test_loss and betting score/wealth for the given sequence and epoch"""
+    def add_sequence_data(self, sequence, test_loss, betting_score, wealth, test_batch_size, scored_samples):
+        """
+        Update test_loss and betting score/wealth for the given sequence and epoch, together with the size of its test
+        batch and the number of scored samples tested so far
+        """
         self.data.loc[
             (self.data["sequence"] == sequence),
             "test_loss",
@@ -197,6 +220,8 @@ class OfflineTrainer(Trainer):
             (self.data["sequence"] == sequence),
             "wealth",
         ] = wealth
+        self.data.loc[(self.data["sequence"] == sequence), "test_batch_size"] = test_batch_size
+        self.data.loc[(self.data["sequence"] == sequence), "scored_samples"] = scored_samples
 
     def update_epochs_until_end_of_sequence(self, sequence):
         max_epoch = self.data[(self.data["sequence"] == sequence)]["epoch"].max()
@@ -215,36 +240,28 @@ class OfflineTrainer(Trainer):
 
     def log(self, logs, seq, epoch, total_epoch, new_start_sequence):
         """
-        Log metrics for visualization and monitoring.
+        Log metrics for visualization and monitoring. All metrics of an epoch are sent to wandb as one record by a
+        background thread (see BufferedWandbLogger).
 
         Args:
         - logs (dict): Dictionary containing metrics to be logged.
         """
 
-        for key, value in logs.items():
-            if self.use_wandb:
-                if self.fold_num:
-                    wandb.log(
-                        {
-                            key: value,
-                            "sequence": seq,
-                            "epoch": epoch,
-                            "epoch_total": total_epoch,
-                            "new_start_sequence": new_start_sequence,
-                            "fold_num": self.fold_num,
-                        }
-                    )
-                else:
-                    wandb.log(
-                        {
-                            key: value,
-                            "sequence": seq,
-                            "epoch": epoch,
-                            "epoch_total": total_epoch,
-                            "new_start_sequence": new_start_sequence,
-                        }
-                    )
+        if self.use_wandb:
+            if self.wandb_logger is None:
+                self.wandb_logger = BufferedWandbLogger(epoch_log_interval=self.wandb_log_interval)
+
+            step_fields = {
+                "sequence": seq,
+                "epoch": epoch,
+                "epoch_total": total_epoch,
+                "new_start_sequence": new_start_sequence,
+            }
+            if self.fold_num:
+                step_fields["fold_num"] = self.fold_num
+            self.wandb_logger.log(logs, step_fields)
 
+        for key, value in logs.items():
             if self.fold_num and self.verbose:
                 logger.info(
                     f"Fold_num: {self.fold_num}, Seq: {self.current_seq}, Epoch: {self.current_epoch}, {key}: {value}"
@@ -281,6 +298,69 @@ class OfflineTrainer(Trainer):
 
         return batches, batch_indices_list
 
+    def get_next_batch_size(self, wealth: float, val_loss: float, sequence: int, num_sequences: int) -> int:
+        """
+        Size of the next test batch of the adaptive schedule. The validation loss is the mean negative log betting
+        score per sample of the trained network, so -val_loss - epsilon estimates how much the log-wealth grows per
+        sample. If 1 / alpha is within reach of max_batch_size and the remaining samples of the fold, the batch is
+        sized to just reach it, so that few samples are spent beyond the threshold. Otherwise (no growth, or too
+        little to reach it) the smallest batch is tested, so that unpromising sequences cost few samples.
+
+        Wealth and validation loss only depend on batches that were already tested, so the betting scores remain
+        e-values given the past and the test stays anytime-valid.
+        """
+        growth = self.estimate_growth(val_loss)
+        if growth <= 0:
+            return self.min_bs
+
+        needed_samples = np.ceil(self.get_log_wealth_gap(wealth) / growth)
+        if needed_samples > min(self.max_bs, self.get_remaining_samples(sequence - 1, num_sequences)):
+            return self.min_bs
+        return int(max(needed_samples, self.min_bs))
+
+    def estimate_growth(self, val_loss: float) -> float:
+        """Growth of the log-wealth per tested sample, estimated from the validation loss; 0 if it is not finite."""
+        growth = -val_loss - self.epsilon
+        return growth if np.isfinite(growth) else 0
+
+    def get_log_wealth_gap(self, wealth: float) -> float:
+        """How far the log-wealth is from the rejection threshold log(1 / alpha)."""
+        return np.log(1.0 / self.alpha) - np.log(max(wealth, np.finfo(float).tiny))
+
+    def get_remaining_samples(self, sequence: int, num_sequences: int) -> int:
+        """Number of samples the fold can still test after the given sequence."""
+        if self.batch_schedule == "fixed":
+            return sum(len(self.batches[k]) for k in range(sequence + 1, num_sequences))
+        remaining_sequences = num_sequences - sequence - 1
+        return min(len(self.ordered_samples) - self.next_sample, remaining_sequences * self.max_bs)
+
+    def is_futile(self, wealth: float, val_loss: float, sequence: int, num_sequences: int) -> bool:
+        """
+        Futility rule: a sequence is futile if the log-wealth, growing at the rate estimated from the validation loss,
+        would not reach log(1 / alpha) with the remaining samples of the fold. The fold stops once futility_patience
+        sequences in a row were futile. Stopping early for futility never rejects, so the test stays valid.
+        """
+        if self.futility_patience is None:
+            return False
+
+        remaining_samples = self.get_remaining_samples(sequence, num_sequences)
+        if self.estimate_growth(val_loss) * remaining_samples < self.get_log_wealth_gap(wealth):
+            self.num_futile_sequences += 1
+        else:
+            self.num_futile_sequences = 0
+
+        return self.num_futile_sequences >= self.futility_patience
+
+    def get_test_batch(self, sequence: int, wealth: float, val_loss: float, num_sequences: int) -> Subset:
+        """The test batch of a sequence: a fixed batch, or the next samples of the fold for the adaptive schedule."""
+        if self.batch_schedule == "fixed":
+            return self.batches[sequence]
+
+        batch_size = self.get_next_batch_size(wealth, val_loss, sequence, num_sequences)
+        indices = range(self.next_sample, min(self.next_sample + batch_size, len(self.ordered_samples)))
+        self.next_sample += len(indices)
+        return Subset(self.ordered_samples, indices)
+
     def train(self):
         """ """
         torch.manual_seed(self.seed)
@@ -292,6 +372,7 @@ class OfflineTrainer(Trainer):
 
         # In the first sequence, we don't train our model, directly evaluate
         test_ds = self.batches[0]
+        self.next_sample = len(test_ds)
 
         self.num_samples = len(test_ds)
         test_loader = DataLoader(test_ds, batch_size=self.net_bs, shuffle=True, collate_fn=collate_fn)
@@ -313,9 +394,12 @@ class OfflineTrainer(Trainer):
             "test_loss": test_loss.detach().cpu().item(),
             "betting_score": betting_score.cpu().item(),
             "wealth": betting_score.cpu().item(),  # wealth is the same as betting score in the first sequence
+            "test_batch_size": len(test_ds),
+            "scored_samples": self.num_samples,
             "epochs_until_end_of_sequence": np.nan,
             "sequences_until_end_of_experiment": np.nan,
             "test_positive": int(0),
+            "futility_stop": int(0),
         }
         new_data = pd.DataFrame([row])
         self.data = new_data.copy() if self.data.empty else pd.concat([self.data, new_data], ignore_index=True)
@@ -339,17 +423,31 @@ class OfflineTrainer(Trainer):
             train_loader = DataLoader(train_ds, batch_size=self.net_bs, shuffle=True, collate_fn=collate_fn)
             val_loader = DataLoader(val_ds, batch_size=self.net_bs, shuffle=True, collate_fn=collate_fn)
 
+            # the adaptive schedule runs until the samples of the fold are used up
+            num_sequences = min(self.seqs, self.num_batches) if self.batch_schedule == "fixed" else self.seqs
+            wealth = betting_score.item() if self.T == 0 else 1
+
             # Iterate over sequences
-            for k in tqdm(range(1, min(self.seqs, self.num_batches))):
+            for k in tqdm(range(1, num_sequences)):
+                if self.next_sample >= len(self.ordered_samples) and self.batch_schedule == "adaptive":
+                    break
+
                 self.current_seq = k
                 self.current_epoch = 0
 
-                with time_block(f"Sequence {k}/{self.num_batches}"):
+                with time_block(
+                    f"Sequence {k}/{self.num_batches}",
+                    span="sequence",
+                    category="training",
+                    fold=self.fold_num,
+                    sequence=k,
+                ):
                     for i in range(self.epochs):
                         self.current_epoch = i
                         self.current_total_epoch += 1
                         loss_train, _ = self.train_evaluate_epoch(train_loader)
                         loss_val, _ = self.train_evaluate_epoch(val_loader, mode="val")
+                        metrics.inc("test_epochs")
                         self.add_epoch_data(
                             self.current_seq,
                             self.current_epoch,
@@ -362,7 +460,9 @@ class OfflineTrainer(Trainer):
                             # Now define new test data from current batch
 
                             self.update_epochs_until_end_of_sequence(self.current_seq)
-                            test_ds = self.batches[k]
+                            test_ds = self.get_test_batch(
+                                k, wealth, loss_val.detach().cpu().item(), num_sequences
+                            )
                             self.num_samples += len(test_ds)
                             test_loader = DataLoader(
                                 test_ds,
@@ -375,6 +475,10 @@ class OfflineTrainer(Trainer):
                             test_loss, betting_score = self.train_evaluate_epoch(test_loader, mode="test")
                             betting_scores.append(betting_score.item())
                             wealth = np.prod(np.array(betting_scores[self.T :])) if k >= self.T else 1
+                            metrics.inc("test_sequences")
+                            metrics.inc("test_scored_samples", len(test_ds))
+                            metrics.set_gauge("test_wealth", wealth)
+                            metrics.set_gauge("test_sequence", self.current_seq)
                             self.log(
                                 {"wealth": wealth},
                                 self.current_seq,
@@ -388,6 +492,8 @@ class OfflineTrainer(Trainer):
                                 test_loss.detach().cpu().item(),
                                 betting_scores[-1],
                                 wealth,
+                                len(test_ds),
+                                self.num_samples,
                             )
 
                             # former train_ds and val_ds become the new train set
@@ -408,6 +514,10 @@ class OfflineTrainer(Trainer):
                 # Reset the early stopper for the next sequence
                 self.early_stopper.reset()
 
+                # the wealth of the sequence is logged even if its last epoch is downsampled
+                if self.wandb_logger is not None:
+                    self.wandb_logger.flush()
+
                 # Log information if wealth exceeds the threshold
                 if wealth > (1.0 / self.alpha):
                     logger.info("Reject null at %f", wealth)
@@ -424,11 +534,32 @@ class OfflineTrainer(Trainer):
 
                     break
 
+                if self.is_futile(wealth, loss_val.detach().cpu().item(), k, num_sequences):
+                    logger.info(f"Stopping for futility at sequence {k} with wealth {wealth}.")
+                    self.futility_stop = True
+                    self.data["futility_stop"] = int(1)
+                    self.log(
+                        {"futility_stop_sequence": k, "total_num_samples": self.num_samples},
+                        self.current_seq,
+                        self.current_epoch,
+                        self.current_total_epoch,
+                        int(self.current_epoch == 0),
+                    )
+
+                    break
+
         if not self.test_positive:
             logger.info(f"Null hypothesis not rejected. Final wealth at {wealth}.")
 
+        logger.info(f"Tested {self.num_samples} scored samples in {self.current_seq + 1} sequences.")
+
+        if self.wandb_logger is not None:
+            self.wandb_logger.close()
+            self.wandb_logger = None
+
         self.data["fold_number"] = self.fold_num
         self.data["test_positive"] = self.data["test_positive"].astype(int)
+        self.data["futility_stop"] = self.data["futility_stop"].astype(int)
 
         if self.calc_stats:
             self.calculate_statistics()
@@ -453,29 +584,38 @@ class OfflineTrainer(Trainer):
             int(self.current_epoch == 0),
         )
 
-        for batch in data_loader:
-            tau1, tau2 = torch.split(batch, 1, dim=1)
-            tau1 = tau1.to(self.device)
-            tau2 = tau2.to(self.device)
-            if mode == "train":
-                self.net.train()
-                # values for tau1 and tau2
-                out = self.net(tau1, tau2)
-            else:
-                self.net.eval()
-                out = self.net(tau1, tau2).detach()
+        with get_tracer().span(
+            f"{mode}_epoch",
+            "training",
+            fold=self.fold_num,
+            sequence=self.current_seq,
+            epoch=self.current_epoch,
+            num_samples=num_samples,
+            batch_size=self.net_bs,
+        ):
+            for batch in data_loader:
+                tau1, tau2 = torch.split(batch, 1, dim=1)
+                tau1 = tau1.to(self.device)
+                tau2 = tau2.to(self.device)
+                if mode == "train":
+                    self.net.train()
+                    # values for tau1 and tau2
+                    out = self.net(tau1, tau2)
+                else:
+                    self.net.eval()
+                    out = self.net(tau1, tau2).detach()
 
-            loss = -out.mean() + self.l1_lambda * self.l1_regularization()
-            aggregated_loss += -out.sum()  # we can leave epsilon out for optimization
+                loss = -out.mean() + self.l1_lambda * self.l1_regularization()
+                aggregated_loss += -out.sum()  # we can leave epsilon out for optimization
 
-            # need epsilon here for calculating the tolerant betting score
-            num_batch_samples = out.shape[0]
-            betting_score *= torch.exp(-self.epsilon * num_batch_samples + out.sum())
+                # need epsilon here for calculating the tolerant betting score
+                num_batch_samples = out.shape[0]
+                betting_score *= torch.exp(-self.epsilon * num_batch_samples + out.sum())
 
-            if mode == "train":
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                if mode == "train":
+                    self.optimizer.zero_grad()
+                    loss.backward()
+                    self.optimizer.step()
 
         self.log(
             {
@@ -563,6 +703,8 @@ class OnlineTrainer(Trainer):
         self.metric = metric if metric else behavior
 
         # Load the dataset
+        from datasets import load_dataset
+
         with time_block("Loading the dataset"):
             self.dataset = load_dataset(self.datagen, split="train")
 
@@ -570,6 +712,10 @@ class OnlineTrainer(Trainer):
 
     def setup_model(self, tau_cfg):
         """ """
+        from peft import AutoPeftModelForCausalLM
+        from transformers import pipeline, AutoTokenizer
+        from transformers.utils import is_flash_attn_2_available
+
         tokenizer = AutoTokenizer.from_pretrained(tau_cfg["model_id"], padding_side="left")
         if tokenizer.pad_token is None:
             tokenizer.pad_token_id = tokenizer.eos_token_id
@@ -617,6 +763,9 @@ class OnlineTrainer(Trainer):
         - logs (dict): Dictionary containing metrics to be logged.
         """
 
+        if self.use_wandb:
+            import wandb
+
         for key, value in logs.items():
             if self.use_wandb:
                 wandb.log(
@@ -848,6 +997,8 @@ class OnlineTrainer(Trainer):
                 continuations2.append(cont2)
 
         # Get metrics for batch
+        from src.evaluation.score import eval_on_metric
+
         with time_block(f"Generating metric scores for {len(indices)} samples"):
             scores1 = eval_on_metric(self.metric, continuations1)
             scores2 = eval_on_metric(self.metric, continuations2)
@@ -885,6 +1036,8 @@ class OnlineTrainer(Trainer):
                     continuations2.append(cont2)
 
         # Get metrics for batch
+        from src.evaluation.score import eval_on_metric
+
         with time_block(f"Generating metric scores for {len(indices)} samples"):
             scores1 = eval_on_metric(self.metric, continuations1)
             scores2 = eval_on_metric(self.metric, continuations2)
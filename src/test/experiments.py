@@ -11,14 +11,8 @@ project_root = Path(__file__).resolve().parents[2]
 if str(project_root) not in sys.path:
     sys.path.append(str(project_root))
 
-# imports from other modules
-from src.evaluation.generate import generate
-from src.test.test import AuditingTest, CalibratedAuditingTest
-from src.test.calibration_strategies import (
-    DefaultStrategy,
-    StdStrategy,
-    IntervalStrategy,
-)
+# imports from other modules are deferred to the experiments that need them, so that a test run does not load the
+# generation stack (transformers, peft, datasets) and vice versa
 
 SCRIPT_DIR = SCRIPT_DIR = Path(__file__).resolve().parent
 
@@ -55,6 +49,7 @@ class GenerationExperiment(Experiment):
             **kwargs: Additional keyword arguments.
         """
         # Call eval_model with the config and any overrides
+        from src.evaluation.generate import generate
 
         generate(
             OmegaConf.to_container(self.cfg, resolve=True),
@@ -81,6 +76,8 @@ class TestExperiment(Experiment):
         use_wandb: Optional[bool] = None,
     ):
         """ """
+        from src.test.test import AuditingTest, CalibratedAuditingTest
+
         cfg_dict = OmegaConf.to_container(self.cfg, resolve=True)
 
         calibrate = calibrate if calibrate is not None else self.cfg.test_params.get("calibrate", False)
@@ -91,6 +88,12 @@ class TestExperiment(Experiment):
         noise = self.cfg.test_params.noise
 
         if calibrate:
+            from src.test.calibration_strategies import (
+                DefaultStrategy,
+                StdStrategy,
+                IntervalStrategy,
+            )
+
             calibration_strategy = self.cfg.calibration_params.get("calibration_strategy", "default")
             calibration_cfg = cfg_dict["calibration_params"]
             overwrite = self.cfg.test_params.get("overwrite", False)
@@ -133,3 +136,35 @@ class TestExperiment(Experiment):
             run_davtt=run_davtt,
             calibrate_only=calibrate_only,
         )
+
+
+class SweepExperiment(Experiment):
+    def run(self):
+        """Runs all test jobs of the sweep section of the config in one process pool, see src.test.sweep."""
+        from src.test.sweep import run_sweep
+
+        return run_sweep(OmegaConf.to_container(self.cfg, resolve=True), self.train_cfg)
+
+
+class PipelineExperiment(Experiment):
+    def run(self):
+        """Brings all artifacts of the configured tests up to date, recomputing only stale ones, see src.pipeline."""
+        from src.pipeline.stages import run_pipeline
+
+        return run_pipeline(OmegaConf.to_container(self.cfg, resolve=True), self.train_cfg)
+
+
+class PowerSimulationExperiment(Experiment):
+    def run(self):
+        """Simulates the test on the scores of tau1 and tau2 for the simulation section of the config."""
+        from src.analysis.power_simulation import run_power_simulation
+
+        return run_power_simulation(OmegaConf.to_container(self.cfg, resolve=True), self.train_cfg)
+
+
+class NullCalibrationExperiment(Experiment):
+    def run(self):
+        """Estimates the type-I error of the models of the null_calibration section of the config."""
+        from src.analysis.power_simulation import run_null_calibration
+
+        return run_null_calibration(OmegaConf.to_container(self.cfg, resolve=True), self.train_cfg)
@@ -7,7 +7,6 @@ import sys
 import numpy as np
 
 from collections import defaultdict
-from datasets import load_dataset
 from pathlib import Path
 from typing import Optional
 from tqdm import tqdm
@@ -17,8 +16,6 @@ project_root = Path(__file__).resolve().parents[2]
 if str(project_root) not in sys.path:
     sys.path.append(str(project_root))
 
-from src.evaluation.evaluate import evaluate_single_model
-from src.evaluation.score import eval_on_metric
 from src.utils.legacy_utils import remove_zero_key_and_flatten
 from src.utils.utils import (
     time_block,
@@ -34,6 +31,24 @@ logger = logging.getLogger(__name__)
 
 ROOT_DIR = Path(__file__).resolve().parents[2]
 
+# (path, size, mtime) -> contents of a model score file, so that e.g. the scores of the base model are only loaded
+# once when it is tested against many checkpoints in the same process
+_score_files = {}
+
+
+def load_score_file(file_path, memoize: bool = True) -> dict:
+    """Loads a model score file, memoized per (path, size, mtime)."""
+    if not memoize:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    stat = os.stat(file_path)
+    memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _score_files:
+        with open(file_path, "r", encoding="utf-8") as f:
+            _score_files[memo_key] = json.load(f)
+    return _score_files[memo_key]
+
 
 def create_common_json(
     model_name1,
@@ -62,9 +77,9 @@ def create_common_json(
         file_name1 = f"{file_path1}/{cont_string}scores{noise_string}.json"
         file_name2 = f"{file_path2}/{cont_string}scores{noise_string}.json"
 
-        with open(file_name1, "r", encoding="utf-8") as file1, open(file_name2, "r", encoding="utf-8") as file2:
-            data1 = json.load(file1)
-            data2 = json.load(file2)
+        # model 1 is the base model that is compared against many others, model 2 changes from test to test
+        data1 = load_score_file(file_name1)
+        data2 = load_score_file(file_name2, memoize=False)
 
         data = defaultdict(list)
         data["metadata1"] = data1["metadata"]
@@ -186,6 +201,9 @@ def create_folds_from_evaluations(
         )
     except FileNotFoundError as e:
         logger.info(f"File not found: {e}. Trying to create the folds from generations.")
+        # scoring pulls in the metric backends (evaluate, perspective api), so only import it when needed
+        from src.evaluation.evaluate import evaluate_single_model
+
         evaluate_single_model(
             model_name=model_name1,
             seed=seed1,
@@ -236,6 +254,8 @@ def create_folds_from_evaluations(
 
 def create_toxic_prompt_mask(dataset_name="allenai/real-toxicity-prompts", impute_with_continuation=False):
     """ """
+    from datasets import load_dataset
+
     dataset = load_dataset(dataset_name, split="train")
 
     high_toxicity_indices = []
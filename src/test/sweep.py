@@ -0,0 +1,285 @@
+import logging
+import os
+import pandas as pd
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
+from dataclasses import dataclass, asdict
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+# torch and the test stack are only imported inside the workers, after their devices and threads are set
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+
+@dataclass
+class SweepJob:
+    """A single auditing test of a sweep."""
+
+    model_name1: str
+    seed1: str
+    model_name2: str
+    seed2: str
+    fold_size: int
+    noise: float = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.pair_dir}_{self.fold_size}_noise_{self.noise}"
+
+    @property
+    def pair_dir(self) -> str:
+        """Directory of the pair in test_outputs, whose fold files are shared by all fold sizes and noise values."""
+        return f"{self.model_name1}_{self.seed1}_{self.model_name2}_{self.seed2}"
+
+
+def expand_sweep(cfg: Dict) -> List[SweepJob]:
+    """
+    Expands the sweep spec into test jobs: every pair in sweep.pairs is tested for every fold size and noise value.
+    Pairs can leave out model_name1/seed1/seed2, which then default to tau1.model_id, tau1.gen_seed and
+    tau2.gen_seed.
+    """
+    sweep_cfg = cfg["sweep"]
+    fold_sizes = sweep_cfg.get("fold_sizes") or [cfg["test_params"]["fold_size"]]
+    noise_values = sweep_cfg.get("noise_values") or [cfg["test_params"].get("noise", 0)]
+
+    jobs = []
+    for noise in noise_values:
+        for fold_size in fold_sizes:
+            for pair in sweep_cfg["pairs"]:
+                jobs.append(
+                    SweepJob(
+                        model_name1=pair.get("model_name1", cfg["tau1"]["model_id"]),
+                        seed1=pair.get("seed1", cfg["tau1"]["gen_seed"]),
+                        model_name2=pair["model_name2"],
+                        seed2=pair.get("seed2", cfg["tau2"]["gen_seed"]),
+                        fold_size=fold_size,
+                        noise=noise,
+                    )
+                )
+    return jobs
+
+
+def get_base_score_paths(cfg: Dict, jobs: List[SweepJob]) -> List[Path]:
+    """Score files of the models that appear as model 1 in the sweep, which are shared by many jobs."""
+    cont_string = "continuation_" if cfg["test_params"]["only_continuations"] else ""
+    score_dir = ROOT_DIR / cfg["dir_prefix"] / "model_scores"
+
+    paths = []
+    for model_name1, seed1, noise in sorted({(job.model_name1, job.seed1, job.noise) for job in jobs}):
+        noise_string = f"_noise_{noise}" if noise > 0 else ""
+        path = score_dir / f"{model_name1}_{seed1}" / f"{cont_string}scores{noise_string}.json"
+        if path.exists():
+            paths.append(path)
+    return paths
+
+
+def init_sweep_worker(device_queue, threads_per_worker: int, base_score_paths: List[Path]):
+    """
+    Pins the worker to one gpu (if there are any), limits its threads and loads the scores of the base models once,
+    so that all jobs of the worker share them.
+    """
+    if device_queue is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device_queue.get())
+
+    from src.analysis.distance_jobs import init_worker
+    from src.test.preprocessing import load_score_file
+
+    init_worker(threads_per_worker)
+    for path in base_score_paths:
+        load_score_file(path)
+
+
+def is_completed(cfg: Dict, train_cfg, job: SweepJob) -> bool:
+    """A job is completed if its test results (with the batch schedule of train_cfg) are in the results store."""
+    from src.analysis.results_store import ResultsStore, get_results_store, get_schedule_suffix
+
+    store = get_results_store(cfg["dir_prefix"], metric=cfg["metric"]["metric"])
+    key = ResultsStore.make_key(
+        cfg["metric"]["metric"],
+        job.model_name1,
+        job.seed1,
+        job.model_name2,
+        job.seed2,
+        job.fold_size,
+        epsilon=cfg["epsilon"],
+        noise=job.noise,
+        only_continuations=cfg["test_params"]["only_continuations"],
+        schedule=get_schedule_suffix(train_cfg),
+    )
+    folds = store.get_folds(key)
+    return folds is not None and len(folds) > 0
+
+
+def run_sweep_job(cfg: Dict, train_cfg, job: SweepJob, analyze_distance: bool) -> float:
+    """Runs the auditing test of a job and returns the fraction of positive tests."""
+    from src.test.test import AuditingTest
+    from src.utils.tracing import span
+
+    job_cfg = deepcopy(cfg)
+    job_cfg["test_params"]["fold_size"] = job.fold_size
+    job_cfg["test_params"]["noise"] = job.noise
+
+    test = AuditingTest(
+        job_cfg,
+        train_cfg,
+        job_cfg["dir_prefix"],
+        overwrite=job_cfg["test_params"].get("overwrite", False),
+        use_wandb=job_cfg["logging"]["use_wandb"],
+        only_continuations=job_cfg["test_params"]["only_continuations"],
+        noise=job.noise,
+    )
+    with span("sweep_job", "sweep", job=job.name):
+        return test.run(
+            model_name1=job.model_name1,
+            seed1=job.seed1,
+            model_name2=job.model_name2,
+            seed2=job.seed2,
+            fold_size=job.fold_size,
+            analyze_distance=analyze_distance,
+        )
+
+
+def run_sweep(cfg: Dict, train_cfg) -> pd.DataFrame:
+    """
+    Runs all jobs of a sweep (see expand_sweep) in one pool of worker processes instead of one python process per
+    test. Completed jobs are skipped unless test_params.overwrite is set, failed jobs are retried up to
+    sweep.max_retries times. Jobs of the same pair run one after another, since they rewrite the same fold files.
+
+    The number of workers defaults to the number of gpus, or to a quarter of the cpus without gpus; the cpus are split
+    evenly over the workers.
+
+    Returns:
+        Summary with one row per job, also saved to {dir_prefix}/test_outputs/{sweep.summary_file}
+    """
+    sweep_cfg = cfg["sweep"]
+    overwrite = cfg["test_params"].get("overwrite", False)
+    analyze_distance = sweep_cfg.get("analyze_distance", False)
+    max_retries = sweep_cfg.get("max_retries", 1)
+
+    jobs = expand_sweep(cfg)
+    records = {
+        i: {**asdict(job), "status": "pending", "attempts": 0, "power": None, "duration_s": None, "error": None}
+        for i, job in enumerate(jobs)
+    }
+
+    pending = []
+    for i, job in enumerate(jobs):
+        if not overwrite and is_completed(cfg, train_cfg, job):
+            records[i]["status"] = "skipped"
+        else:
+            pending.append(i)
+
+    logger.info(f"Sweep with {len(jobs)} jobs, {len(jobs) - len(pending)} of them already completed.")
+
+    if pending:
+        import torch
+
+        num_cpus = os.cpu_count() or 1
+        num_gpus = torch.cuda.device_count()
+        num_workers = sweep_cfg.get("num_workers") or (num_gpus if num_gpus else max(1, num_cpus // 4))
+        num_workers = min(num_workers, len({jobs[i].pair_dir for i in pending}))
+        threads_per_worker = sweep_cfg.get("threads_per_worker") or max(1, num_cpus // num_workers)
+        base_score_paths = get_base_score_paths(cfg, [jobs[i] for i in pending])
+
+        logger.info(
+            f"Running {len(pending)} jobs with {num_workers} workers, {threads_per_worker} threads per worker and "
+            f"{num_gpus} gpus."
+        )
+
+        if num_workers == 1:
+            init_sweep_worker(None, threads_per_worker, base_score_paths)
+            for i in pending:
+                while records[i]["status"] != "completed" and records[i]["attempts"] <= max_retries:
+                    records[i]["attempts"] += 1
+                    start = time.time()
+                    try:
+                        records[i]["power"] = run_sweep_job(cfg, train_cfg, jobs[i], analyze_distance)
+                        records[i]["status"] = "completed"
+                    except Exception:
+                        records[i]["status"] = "failed"
+                        records[i]["error"] = traceback.format_exc()
+                        logger.error(f"Job {jobs[i].name} failed (attempt {records[i]['attempts']}).")
+                    records[i]["duration_s"] = round(time.time() - start, 1)
+
+        else:
+            mp_context = get_context("spawn")
+            device_queue = None
+            if num_gpus:
+                device_queue = mp_context.Queue()
+                for worker in range(num_workers):
+                    device_queue.put(worker % num_gpus)
+
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=mp_context,
+                initializer=init_sweep_worker,
+                initargs=(device_queue, threads_per_worker, base_score_paths),
+            ) as executor:
+
+                def submit(i):
+                    records[i]["attempts"] += 1
+                    future = executor.submit(run_sweep_job, cfg, train_cfg, jobs[i], analyze_distance)
+                    return future, time.time()
+
+                queued = list(pending)
+                running = {}
+                busy_pairs = set()
+                broken = False
+
+                def submit_ready():
+                    for i in list(queued):
+                        if jobs[i].pair_dir not in busy_pairs:
+                            queued.remove(i)
+                            busy_pairs.add(jobs[i].pair_dir)
+                            future, start = submit(i)
+                            running[future] = (i, start)
+
+                submit_ready()
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i, start = running.pop(future)
+                        busy_pairs.discard(jobs[i].pair_dir)
+                        records[i]["duration_s"] = round(time.time() - start, 1)
+                        try:
+                            records[i]["power"] = future.result()
+                            records[i]["status"] = "completed"
+                            logger.info(f"Finished job {jobs[i].name}.")
+                        except Exception as e:
+                            records[i]["status"] = "failed"
+                            records[i]["error"] = traceback.format_exc()
+                            logger.error(f"Job {jobs[i].name} failed (attempt {records[i]['attempts']}).")
+                            # a worker that died (e.g. out of memory) takes down the pool, so nothing can be retried
+                            broken = broken or isinstance(e, BrokenProcessPool)
+                            if records[i]["attempts"] <= max_retries and not broken:
+                                queued.insert(0, i)
+                    if not broken:
+                        submit_ready()
+
+                for i in queued:
+                    records[i]["status"] = "failed"
+                    records[i]["error"] = "The worker pool broke before the job started."
+
+    summary_df = pd.DataFrame(records.values())
+    summary_path = ROOT_DIR / cfg["dir_prefix"] / "test_outputs" / sweep_cfg.get("summary_file", "sweep_summary.csv")
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    summary_df.to_csv(summary_path, index=False)
+
+    logger.info(f"Sweep summary:\n{summary_df.drop(columns=['error']).to_string(index=False)}")
+    logger.info(f"Sweep summary saved to {summary_path}.")
+
+    return summary_df
@@ -5,11 +5,10 @@ import pandas as pd
 import re
 import sys
 import time
-import wandb
 
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Optional, Dict, List, Union, Tuple
+from typing import Optional, Dict, List, Union, Tuple, TYPE_CHECKING
 
 # Add paths to sys.path if not already present
 project_root = Path(__file__).resolve().parents[2]
@@ -20,20 +19,31 @@ if str(project_root) not in sys.path:
 from arguments import TrainCfg
 from logging_config import setup_logging
 
-from src.test.calibration_strategies import CalibrationStrategy
 from src.test.evaltrainer import OfflineTrainer
 from src.test.preprocessing import create_folds_from_evaluations
 
 from src.analysis.nn_distance import CMLP
-from src.analysis.analyze import get_distance_scores, get_mean_and_std_for_nn_distance
-from src.analysis.plot import distance_box_plot, plot_calibrated_detection_rate
 
-from src.utils.utils import create_run_string, cleanup_files
+from src.utils import metrics
+from src.utils.tracing import get_tracer, span
+from src.utils.utils import create_run_string, cleanup_files, time_block
+
+# wandb as well as the analysis and plotting modules (matplotlib, seaborn) are only imported where they are used,
+# so that running the test alone does not pay for them at startup
+if TYPE_CHECKING:
+    from src.test.calibration_strategies import CalibrationStrategy
 
 
 ROOT_DIR = Path(__file__).resolve().parents[2]
 
 
+def get_num_train_samples(config: Dict, train_cfg: TrainCfg, fold_size: int) -> int:
+    """Number of training samples of the distance analysis; by default all full batches of a fold but the last."""
+    if config["analysis"]["num_samples"] == 0:
+        return (fold_size // train_cfg.batch_size) * train_cfg.batch_size - train_cfg.batch_size
+    return config["analysis"]["num_samples"]
+
+
 class Test:
     """ """
 
@@ -78,6 +88,8 @@ class Test:
 
     def initialize_wandb(self, project: str, tags: List[str]):
         """ """
+        import wandb
+
         wandb.init(
             project=project,
             entity=self.config["logging"]["entity"],
@@ -88,6 +100,8 @@ class Test:
 
     def update_wandb(self, info_dict: Dict):
         """ """
+        import wandb
+
         wandb.config.update(info_dict)
 
     def setup_logger(self, tag: str):
@@ -207,25 +221,33 @@ class AuditingTest(Test):
 
         return trainer.train()
 
-    def kfold_davtt(self):
-        """ """
+    def kfold_davtt(self, create_folds: bool = True):
+        """
+        Args:
+            create_folds: whether to create the folds from the model scores first; False if they already exist, e.g.
+                when they were created by the fold stage of the pipeline
+        """
+
+        from src.analysis.results_store import get_schedule_suffix
 
         cont_string = "_continuations" if self.only_continuations else ""
         noise_string = f"_noise_{self.noise}" if self.noise > 0 else ""
+        run_string = f"{noise_string}{get_schedule_suffix(self.train_cfg)}"
 
         file_path = (
             Path(self.directory)
-            / f"kfold_test_results{cont_string}_{self.fold_size}_epsilon_{self.epsilon}{noise_string}.csv"
+            / f"kfold_test_results{cont_string}_{self.fold_size}_epsilon_{self.epsilon}{run_string}.csv"
         )
         stat_file_path = (
             Path(self.directory)
-            / f"kfold_test_stats{cont_string}_{self.fold_size}_epsilon_{self.epsilon}{noise_string}.csv"
+            / f"kfold_test_stats{cont_string}_{self.fold_size}_epsilon_{self.epsilon}{run_string}.csv"
         )
 
         if Path(file_path).exists() and not self.overwrite:
             self.logger.info(f"Skipping test as results file {file_path} already exists.")
 
             df = pd.read_csv(file_path)
+            self.record_results(df, file_path, skip_existing=True)
 
             # calculate positive test rate
             test_positive_per_fold = df.groupby("fold_number")["test_positive"].max()
@@ -240,20 +262,22 @@ class AuditingTest(Test):
             start = time.time()
             folds = []
 
-            create_folds_from_evaluations(
-                self.model_name1,
-                self.seed1,
-                self.model_name2,
-                self.seed2,
-                metric=self.config["metric"]["metric"],
-                fold_size=self.fold_size,
-                overwrite=self.overwrite,
-                score_dir=self.score_dir,
-                gen_dir=self.gen_dir,
-                test_dir=self.test_dir,
-                only_continuations=self.only_continuations,
-                noise=self.noise,
-            )
+            if create_folds:
+                with span("prepare_folds", "folds", fold_size=self.fold_size):
+                    create_folds_from_evaluations(
+                        self.model_name1,
+                        self.seed1,
+                        self.model_name2,
+                        self.seed2,
+                        metric=self.config["metric"]["metric"],
+                        fold_size=self.fold_size,
+                        overwrite=self.overwrite,
+                        score_dir=self.score_dir,
+                        gen_dir=self.gen_dir,
+                        test_dir=self.test_dir,
+                        only_continuations=self.only_continuations,
+                        noise=self.noise,
+                    )
 
             for file_name in os.listdir(self.directory):
                 match = re.search(self.FOLD_PATTERN, file_name)
@@ -269,15 +293,24 @@ class AuditingTest(Test):
             )
 
             if self.use_wandb:
+                import wandb
+
                 wandb.config.update({"total_num_folds": folds})
 
             # Iterate over the folds and call test
             all_folds_data = pd.DataFrame()
             all_folds_stats = pd.DataFrame()
 
-            for fold_num in folds:
+            metrics.set_gauge("test_folds_remaining", len(folds))
+            for i, fold_num in enumerate(folds):
                 self.logger.info(f"Now starting experiment for fold {fold_num}.")
-                data, test_positive, stat_df = self.davtt(fold_num)
+                fold_start = time.time()
+                with time_block(f"Experiment for fold {fold_num}", span="fold", category="test", fold=fold_num):
+                    data, test_positive, stat_df = self.davtt(fold_num)
+                    get_tracer().set_attributes(test_positive=test_positive)
+                metrics.observe("test_fold_seconds", time.time() - fold_start)
+                metrics.inc("test_folds_completed", test_positive=int(test_positive))
+                metrics.set_gauge("test_folds_remaining", len(folds) - i - 1)
                 all_folds_data = pd.concat([all_folds_data, data], ignore_index=True)
                 if stat_df is not None:
                     all_folds_stats = pd.concat([all_folds_stats, stat_df], ignore_index=True)
@@ -285,8 +318,13 @@ class AuditingTest(Test):
                     sum_positive += 1
 
             all_folds_data.to_csv(file_path, index=False)
+            self.record_results(all_folds_data, file_path)
             positive_rate = sum_positive / len(folds)
 
+            num_futility_stops = all_folds_data.groupby("fold_number")["futility_stop"].max().sum()
+            if num_futility_stops > 0:
+                self.logger.info(f"{num_futility_stops} of {len(folds)} folds stopped for futility.")
+
             if all_folds_stats.shape[0] > 0:
                 all_folds_stats.to_csv(stat_file_path, index=False)
 
@@ -296,26 +334,42 @@ class AuditingTest(Test):
 
         return positive_rate
 
-    def analyze_and_plot_distance(self):
-        """ """
+    def record_results(self, data: pd.DataFrame, file_path: Path, skip_existing: bool = False):
+        """Adds the results of kfold_davtt to the results store that the analysis and plotting functions query."""
+        from src.analysis.results_store import ResultsStore, get_results_store, get_schedule_suffix
 
-        if self.config["analysis"]["num_samples"] == 0:
-            num_train_samples = (
-                self.fold_size // self.train_cfg.batch_size
-            ) * self.train_cfg.batch_size - self.train_cfg.batch_size
+        store = get_results_store(self.dir_prefix, self.test_dir, self.metric)
+        key = ResultsStore.make_key(
+            self.metric,
+            self.model_name1,
+            self.seed1,
+            self.model_name2,
+            self.seed2,
+            self.fold_size,
+            epsilon=self.epsilon,
+            noise=self.noise,
+            only_continuations=self.only_continuations,
+            schedule=get_schedule_suffix(self.train_cfg),
+        )
+        if skip_existing and store.get_run(key) is not None:
+            return
+        store.add_run(key, data, source_file=file_path)
 
-        else:
-            num_train_samples = self.config["analysis"]["num_samples"]
+    def analyze_and_plot_distance(self, plot: bool = True):
+        """ """
+        from src.analysis.analyze import (
+            get_bootstrap_distance_scores,
+            get_distance_scores,
+            get_distance_file_name,
+            get_mean_and_std_for_nn_distance,
+        )
+        from src.analysis.bootstrap import summarize_bootstrap
 
+        num_train_samples = get_num_train_samples(self.config, self.train_cfg, self.fold_size)
         num_runs = self.config["analysis"]["num_runs"]
 
-        noise_string = f"_noise_{self.noise}" if self.noise > 0 else ""
-
-        dist_path = Path(self.directory) / f"distance_scores_{num_train_samples}_{num_runs}{noise_string}.csv"
-        if dist_path.exists():
-            self.logger.info(f"Skipping distance analysis as results file {dist_path} already exists.")
-            distance_df = pd.read_csv(dist_path)
-        else:
+        # results are looked up in the distance cache, which is keyed by the scores and the full distance config
+        with span("distance", "distance", num_runs=num_runs, num_train_samples=num_train_samples):
             distance_df = get_distance_scores(
                 self.model_name1,
                 self.seed1,
@@ -328,18 +382,42 @@ class AuditingTest(Test):
                 num_samples=[self.train_cfg.batch_size, num_train_samples],
                 num_test_samples=self.train_cfg.batch_size,
                 only_continuations=self.only_continuations,
-                score_dir=self.score_dir,
+                dir_prefix=self.dir_prefix,
+                test_dir=self.test_dir,
                 noise=self.noise,
             )
 
-            distance_df.to_csv(dist_path, index=False)
-            self.logger.info(f"Distance analysis results saved to {dist_path}.")
+        dist_path = Path(self.directory) / get_distance_file_name(num_train_samples, num_runs, self.noise)
+        distance_df.to_csv(dist_path, index=False)
+        self.logger.info(f"Distance analysis results saved to {dist_path}.")
 
         mean_nn_distance, std_nn_distance = get_mean_and_std_for_nn_distance(distance_df)
         self.logger.info(f"Average nn distance: {mean_nn_distance}, std: {std_nn_distance}")
         self.logger.info(f"Wasserstein distance: {distance_df['Wasserstein_comparison'].mean()}")
 
+        bootstrap_df = None
+        num_bootstrap = self.config["analysis"].get("num_bootstrap", 0)
+        if num_bootstrap:
+            bootstrap_df = get_bootstrap_distance_scores(
+                self.model_name1,
+                self.seed1,
+                self.seed2,
+                model_name2=self.model_name2,
+                metric=self.metric,
+                test_dir=self.test_dir,
+                dir_prefix=self.dir_prefix,
+                num_bootstrap=num_bootstrap,
+                only_continuations=self.only_continuations,
+                save=True,
+                overwrite=self.overwrite,
+                noise=self.noise,
+            )
+            if bootstrap_df is not None:
+                self.logger.info(f"Bootstrap confidence intervals:\n{summarize_bootstrap(bootstrap_df)}")
+
         if self.use_wandb:
+            import wandb
+
             wandb.log(
                 {
                     "average_nn_distance": distance_df["NeuralNet"].mean(),
@@ -348,6 +426,11 @@ class AuditingTest(Test):
                 }
             )
 
+        if not plot:
+            return
+
+        from src.analysis.plot import distance_box_plot
+
         try:
             # Plot the results
             distance_box_plot(
@@ -357,6 +440,7 @@ class AuditingTest(Test):
                 self.seed2,
                 self.model_name2,
                 metric=self.metric,
+                bootstrap_df=bootstrap_df,
             )
 
         except FileNotFoundError as e:
@@ -371,6 +455,8 @@ class AuditingTest(Test):
         fold_size=2000,
         analyze_distance=True,
         run_davtt=True,
+        create_folds=True,
+        plot_distance=True,
         **kwargs,
     ):
         """ """
@@ -388,12 +474,14 @@ class AuditingTest(Test):
         self.directory = f"{self.test_dir}/{self.model_name1}_{self.seed1}_{self.model_name2}_{self.seed2}"
 
         if run_davtt:
-            power = self.kfold_davtt()
+            power = self.kfold_davtt(create_folds=create_folds)
 
         if analyze_distance:
-            self.analyze_and_plot_distance()
+            self.analyze_and_plot_distance(plot=plot_distance)
 
         if self.use_wandb:
+            import wandb
+
             wandb.finish()
 
         if run_davtt:
@@ -406,7 +494,7 @@ class CalibratedAuditingTest(AuditingTest):
         config: Dict,
         train_cfg: TrainCfg,
         dir_prefix: str,
-        calibration_strategy: CalibrationStrategy,
+        calibration_strategy: "CalibrationStrategy",
         overwrite: bool = False,
         use_wandb: Optional[bool] = None,
         # calibration_strategy: Optional[CalibrationStrategy] = None,
@@ -458,6 +546,9 @@ class CalibratedAuditingTest(AuditingTest):
         **kwargs,
     ):
         """ """
+        from src.analysis.analyze import get_distance_file_name, get_mean_and_std_for_nn_distance
+        from src.analysis.bootstrap import bootstrap_mean_interval
+        from src.analysis.plot import plot_calibrated_detection_rate
 
         self.model_name1 = model_name1 if model_name1 else self.config["tau1"]["model_id"]
         self.seed1 = seed1 if seed1 else self.config["tau1"]["gen_seed"]
@@ -483,9 +574,7 @@ class CalibratedAuditingTest(AuditingTest):
 
         if epsilon_path.exists() and not self.overwrite:
             self.logger.info(f"Calibrated testing results already exist in {epsilon_path}.")
-            dist_path = (
-                Path(self.directory) / f"distance_scores_{self.num_train_samples}_{self.num_runs}{noise_string}.csv"
-            )
+            dist_path = Path(self.directory) / get_distance_file_name(num_train_samples, self.num_runs, self.noise)
             try:
                 distance_df = pd.read_csv(dist_path)
                 true_epsilon, std_epsilon = get_mean_and_std_for_nn_distance(distance_df)
@@ -537,6 +626,13 @@ class CalibratedAuditingTest(AuditingTest):
                 power_df.to_csv(epsilon_path, index=False)
                 self.logger.info(f"Calibrated testing results saved to {epsilon_path}.")
 
+        epsilon_interval = None
+        num_bootstrap = self.config["analysis"].get("num_bootstrap", 0)
+        dist_path = Path(self.directory) / get_distance_file_name(num_train_samples, self.num_runs, self.noise)
+        if num_bootstrap and dist_path.exists():
+            epsilon_interval = bootstrap_mean_interval(pd.read_csv(dist_path)["NeuralNet"], num_bootstrap=num_bootstrap)
+            self.logger.info(f"Bootstrap confidence interval of the true distance: {epsilon_interval}")
+
         plot_calibrated_detection_rate(
             self.model_name1,
             self.seed1,
@@ -544,6 +640,7 @@ class CalibratedAuditingTest(AuditingTest):
             self.seed2,
             true_epsilon=true_epsilon,
             std_epsilon=std_epsilon,
+            epsilon_interval=epsilon_interval,
             result_file=epsilon_path,
             draw_in_std=True,
             draw_in_first_checkpoint=False,
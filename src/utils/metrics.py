@@ -0,0 +1,350 @@
+import atexit
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+# set by enable_metrics and inherited by worker processes, which then flush their metrics into the same directory
+METRICS_DIR_ENV = "AUDIT_METRICS_DIR"
+METRICS_INTERVAL_ENV = "AUDIT_METRICS_INTERVAL"
+
+# upper bounds in seconds of the histogram buckets, from fast scoring batches to slow folds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+# counters are exported with this suffix in the prometheus text format
+COUNTER_SUFFIX = "_total"
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of the observed values, as in the prometheus histogram type."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """ """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def to_dict(self) -> Dict:
+        """ """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "buckets": dict(zip([str(bound) for bound in self.buckets], self.bucket_counts)),
+        }
+
+
+class MetricsRegistry:
+    """
+    In-process registry of counters, gauges and histograms, e.g. generated tokens, scoring requests, Perspective
+    retries, training epochs and completed folds. Metrics are identified by their name and labels. Updates are cheap
+    (a lock and a dict lookup) and no-ops while the registry is disabled; a background thread (see enable_metrics)
+    flushes the registry periodically, together with the per-second rates of the counters since the last flush.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics_dir = None
+        self.formats = ["prometheus", "jsonl"]
+        self.use_wandb = False
+        self.interval_s = 30
+        self.reset()
+
+    def reset(self):
+        """Drops all metrics, e.g. in a forked worker that inherited those of its parent."""
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple, float] = {}
+        self.gauges: Dict[Tuple, float] = {}
+        self.histograms: Dict[Tuple, Histogram] = {}
+        self.last_counters: Dict[Tuple, float] = {}
+        self.last_flush = time.time()
+        self.start_time = self.last_flush
+
+        self.flush_thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def make_key(name: str, labels: Dict) -> Tuple:
+        """ """
+        return (name,) + tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increases a counter, e.g. inc("scoring_requests", len(batch), metric="perspective")."""
+        if not self.enabled:
+            return
+        key = self.make_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """Sets a gauge to its current value, e.g. the wealth of the running fold."""
+        if not self.enabled:
+            return
+        key = self.make_key(name, labels)
+        with self.lock:
+            self.gauges[key] = float(value)
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        """Adds a value (usually a duration in seconds) to a histogram."""
+        if not self.enabled:
+            return
+        key = self.make_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def snapshot(self) -> Dict:
+        """
+        Current values of all metrics and the per-second rates of the counters since the previous snapshot, which
+        starts the next rate interval.
+        """
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: histogram.to_dict() for key, histogram in self.histograms.items()}
+            elapsed = now - self.last_flush
+            rates = {
+                key: (value - self.last_counters.get(key, 0)) / elapsed if elapsed > 0 else 0.0
+                for key, value in counters.items()
+            }
+            self.last_counters = counters
+            self.last_flush = now
+
+        return {
+            "time": now,
+            "uptime_s": now - self.start_time,
+            "pid": os.getpid(),
+            "counters": counters,
+            "rates": rates,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def flush(self) -> Optional[Dict]:
+        """Writes a snapshot to {metrics_dir}/metrics_{pid}.prom and/or appends it to metrics_{pid}.jsonl."""
+        if self.metrics_dir is None:
+            return None
+
+        snapshot = self.snapshot()
+        if not snapshot["counters"] and not snapshot["gauges"] and not snapshot["histograms"]:
+            return snapshot
+
+        pid = snapshot["pid"]
+        if "prometheus" in self.formats:
+            # written to a temporary file and renamed, so that scrapers (e.g. the textfile collector of the node
+            # exporter) never read a half-written file
+            prom_path = self.metrics_dir / f"metrics_{pid}.prom"
+            tmp_path = prom_path.with_suffix(".prom.tmp")
+            with open(tmp_path, "w") as f:
+                f.write(to_prometheus_text(snapshot))
+            os.replace(tmp_path, prom_path)
+
+        if "jsonl" in self.formats:
+            with open(self.metrics_dir / f"metrics_{pid}.jsonl", "a") as f:
+                f.write(json.dumps(to_json_record(snapshot)) + "\n")
+
+        if self.use_wandb:
+            log_to_wandb(snapshot)
+
+        return snapshot
+
+    def start(self, interval_s: float):
+        """Starts the background thread that flushes the registry every interval_s seconds."""
+        if self.flush_thread is not None and self.flush_thread.is_alive():
+            return
+        self.interval_s = interval_s
+
+        def flush_periodically():
+            while not self.stop_event.wait(interval_s):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.warning(f"Could not flush metrics: {e}")
+
+        self.stop_event.clear()
+        self.flush_thread = threading.Thread(target=flush_periodically, name="metrics-flush", daemon=True)
+        self.flush_thread.start()
+
+    def stop(self):
+        """Stops the background thread and writes a last snapshot."""
+        if self.flush_thread is not None:
+            self.stop_event.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        if self.enabled:
+            self.flush()
+
+
+def format_key(key: Tuple, suffix: str = "", extra_labels: Optional[List[Tuple[str, str]]] = None) -> str:
+    """Prometheus series name, e.g. scoring_requests_total{metric="perspective",pid="123"}."""
+    labels = list(key[1:]) + (extra_labels or [])
+    if not labels:
+        return f"{key[0]}{suffix}"
+    label_string = ",".join(f'{name}="{value}"' for name, value in labels)
+    return f"{key[0]}{suffix}{{{label_string}}}"
+
+
+def to_prometheus_text(snapshot: Dict) -> str:
+    """Renders a snapshot in the prometheus text exposition format; rates are exported as gauges."""
+    pid_label = [("pid", str(snapshot["pid"]))]
+    lines, seen = [], set()
+
+    def add_type(name, metric_type):
+        if name not in seen:
+            lines.append(f"# TYPE {name} {metric_type}")
+            seen.add(name)
+
+    for key, value in sorted(snapshot["counters"].items()):
+        add_type(f"{key[0]}{COUNTER_SUFFIX}", "counter")
+        lines.append(f"{format_key(key, COUNTER_SUFFIX, pid_label)} {value}")
+
+    for key, value in sorted(snapshot["rates"].items()):
+        add_type(f"{key[0]}_per_second", "gauge")
+        lines.append(f"{format_key(key, '_per_second', pid_label)} {value}")
+
+    for key, value in sorted(snapshot["gauges"].items()):
+        add_type(key[0], "gauge")
+        lines.append(f"{format_key(key, '', pid_label)} {value}")
+
+    for key, histogram in sorted(snapshot["histograms"].items()):
+        add_type(key[0], "histogram")
+        for bound, count in histogram["buckets"].items():
+            lines.append(f"{format_key(key, '_bucket', pid_label + [('le', bound)])} {count}")
+        lines.append(f"{format_key(key, '_bucket', pid_label + [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{format_key(key, '_sum', pid_label)} {histogram['sum']}")
+        lines.append(f"{format_key(key, '_count', pid_label)} {histogram['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def to_json_record(snapshot: Dict) -> Dict:
+    """Flattens a snapshot into one json record, with the series named as in the prometheus format."""
+    record = {"time": snapshot["time"], "uptime_s": round(snapshot["uptime_s"], 3), "pid": snapshot["pid"]}
+    for key, value in snapshot["counters"].items():
+        record[format_key(key, COUNTER_SUFFIX)] = value
+    for key, value in snapshot["rates"].items():
+        record[format_key(key, "_per_second")] = value
+    for key, value in snapshot["gauges"].items():
+        record[format_key(key)] = value
+    for key, histogram in snapshot["histograms"].items():
+        record[format_key(key, "_count")] = histogram["count"]
+        record[format_key(key, "_mean")] = histogram["mean"]
+    return record
+
+
+def log_to_wandb(snapshot: Dict):
+    """Mirrors a snapshot to the active wandb run as one batched log call, with all series under metrics/."""
+    import wandb
+
+    if wandb.run is None:
+        return
+    record = to_json_record(snapshot)
+    wandb.log(
+        {
+            f"metrics/{name}": value
+            for name, value in record.items()
+            if name not in ["time", "pid"] and value is not None and not math.isnan(value)
+        }
+    )
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    """The metrics registry of the current process."""
+    return _registry
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Increases a counter of the registry of the current process; a no-op unless metrics are enabled."""
+    _registry.inc(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    """Sets a gauge of the registry of the current process; a no-op unless metrics are enabled."""
+    _registry.set(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    """Adds a value to a histogram of the registry of the current process; a no-op unless metrics are enabled."""
+    _registry.observe(name, value, **labels)
+
+
+def enable_metrics(
+    metrics_dir: Union[str, Path],
+    interval_s: float = 30,
+    formats: Optional[List[str]] = None,
+    use_wandb: bool = False,
+):
+    """
+    Enables the metrics registry in this process and in all processes started from it (pool workers read
+    METRICS_DIR_ENV at import) and starts flushing it every interval_s seconds. Every process writes its own
+    metrics_{pid}.prom (prometheus text format) and/or metrics_{pid}.jsonl (one record per flush).
+
+    Args:
+        metrics_dir: output directory
+        interval_s: seconds between flushes
+        formats: subset of ["prometheus", "jsonl"], both by default
+        use_wandb: whether to mirror every flush to the active wandb run of this process
+    """
+    os.environ[METRICS_DIR_ENV] = str(metrics_dir)
+    os.environ[METRICS_INTERVAL_ENV] = str(interval_s)
+    _start(metrics_dir, interval_s, formats, use_wandb)
+
+
+def _start(metrics_dir: Union[str, Path], interval_s: float, formats: Optional[List[str]], use_wandb: bool):
+    _registry.metrics_dir = Path(metrics_dir)
+    _registry.metrics_dir.mkdir(parents=True, exist_ok=True)
+    _registry.formats = formats or ["prometheus", "jsonl"]
+    _registry.use_wandb = use_wandb
+    _registry.enabled = True
+    _registry.start(interval_s)
+
+
+def disable_metrics():
+    """Stops flushing and writes the final values."""
+    _registry.stop()
+    _registry.enabled = False
+
+
+if os.environ.get(METRICS_DIR_ENV):
+    _start(os.environ[METRICS_DIR_ENV], float(os.environ.get(METRICS_INTERVAL_ENV, 30)), None, False)
+
+# the final values are written when the process exits; multiprocessing workers exit through their own finalizers
+atexit.register(_registry.stop)
+Finalize(None, _registry.stop, exitpriority=10)
+
+
+def _restart_after_fork():
+    """Forked workers start with empty metrics and need their own flush thread."""
+    _registry.reset()
+    if _registry.enabled:
+        _registry.start(_registry.interval_s)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,233 @@
+import atexit
+import json
+import logging
+import os
+import pandas as pd
+import sys
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Optional, Dict, List, Union
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+# set by enable_tracing and inherited by worker processes, which then record their spans into the same directory
+TRACE_DIR_ENV = "AUDIT_TRACE_DIR"
+
+# returned by span when tracing is disabled, so that disabled spans cost one attribute lookup
+_NULL_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Records nested spans (name, category, start, duration and attributes such as fold, sequence or batch size) of one
+    process. Spans are kept per thread, so that a span opened in a thread is nested under the spans of that thread
+    only, and carry pid and tid, so that the traces of pool workers can be merged into one Chrome trace.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_dir = None
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, trace_dir: Union[str, Path]):
+        """ """
+        self.trace_dir = Path(trace_dir)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        self.enabled = True
+
+    def disable(self):
+        """ """
+        self.enabled = False
+
+    def reset(self):
+        """Drops the recorded spans, e.g. in a forked worker that inherited those of its parent."""
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self) -> List[Dict]:
+        """Open spans of the current thread."""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name: str, category: str = "audit", **attributes):
+        """Context manager that records a span, nested under the innermost open span of the thread."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, category, attributes)
+
+    @contextmanager
+    def _span(self, name: str, category: str, attributes: Dict):
+        stack = self.get_stack()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {key: to_trace_value(value) for key, value in attributes.items()},
+            "depth": len(stack),
+            "parent": stack[-1]["name"] if stack else None,
+        }
+        stack.append(event)
+        start = time.perf_counter_ns()
+        event["ts"] = time.time_ns() // 1000
+        try:
+            yield event
+        finally:
+            event["dur"] = (time.perf_counter_ns() - start) // 1000
+            stack.pop()
+            with self.lock:
+                self.events.append(event)
+
+    def set_attributes(self, **attributes):
+        """Adds attributes to the innermost open span, e.g. results that are only known at its end."""
+        if not self.enabled:
+            return
+        stack = self.get_stack()
+        if stack:
+            stack[-1]["args"].update({key: to_trace_value(value) for key, value in attributes.items()})
+
+    def save(self) -> Optional[Path]:
+        """Writes the spans recorded so far to {trace_dir}/trace_{pid}.json and clears them."""
+        if self.trace_dir is None:
+            return None
+
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return None
+
+        trace_path = self.trace_dir / f"trace_{os.getpid()}.json"
+        if trace_path.exists():
+            with open(trace_path, "r") as f:
+                events = json.load(f) + events
+        with open(trace_path, "w") as f:
+            json.dump(events, f)
+
+        return trace_path
+
+
+def to_trace_value(value):
+    """Attributes are stored as json values."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """The tracer of the current process."""
+    return _tracer
+
+
+def span(name: str, category: str = "audit", **attributes):
+    """Records a span with the tracer of the current process; a no-op unless tracing is enabled."""
+    return _tracer.span(name, category, **attributes)
+
+
+def enable_tracing(trace_dir: Union[str, Path]):
+    """
+    Enables tracing in this process and in all processes started from it (pool workers read TRACE_DIR_ENV at import).
+    Every process writes its spans to {trace_dir}/trace_{pid}.json when it exits.
+    """
+    os.environ[TRACE_DIR_ENV] = str(trace_dir)
+    _tracer.enable(trace_dir)
+
+
+def load_trace_events(trace_dir: Union[str, Path]) -> List[Dict]:
+    """Spans of all processes that wrote into trace_dir."""
+    events = []
+    for trace_path in sorted(Path(trace_dir).glob("trace_*.json")):
+        with open(trace_path, "r") as f:
+            events.extend(json.load(f))
+    return events
+
+
+def export_chrome_trace(trace_dir: Union[str, Path], output_path: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Merges the spans of all processes into one Chrome trace (open with chrome://tracing or ui.perfetto.dev).
+
+    Returns:
+        Path of the trace, {trace_dir}/trace.json by default
+    """
+    _tracer.save()
+    output_path = Path(output_path) if output_path else Path(trace_dir) / "trace.json"
+
+    trace_events = []
+    for event in load_trace_events(trace_dir):
+        trace_events.append({key: value for key, value in event.items() if key not in ["depth", "parent"]})
+
+    with open(output_path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    logger.info(f"Saved Chrome trace with {len(trace_events)} spans to {output_path}.")
+    return output_path
+
+
+def summarize_trace(trace_dir: Union[str, Path]) -> pd.DataFrame:
+    """
+    Flat per-stage summary of all spans: number of calls, total, mean and max duration and share of the wall-clock
+    time of the trace. Spans of parallel workers overlap, so shares can add up to more than 1.
+    """
+    _tracer.save()
+    events = load_trace_events(trace_dir)
+    columns = ["name", "category", "count", "total_s", "mean_s", "max_s", "share"]
+    if not events:
+        return pd.DataFrame(columns=columns)
+
+    trace_df = pd.DataFrame(events)
+    trace_df["dur_s"] = trace_df["dur"] / 1e6
+    traced_time = ((trace_df["ts"] + trace_df["dur"]).max() - trace_df["ts"].min()) / 1e6
+
+    summary_df = (
+        trace_df.groupby(["name", "cat"])["dur_s"]
+        .agg(count="count", total_s="sum", mean_s="mean", max_s="max")
+        .reset_index()
+        .rename(columns={"cat": "category"})
+        .sort_values("total_s", ascending=False)
+    )
+    summary_df["share"] = summary_df["total_s"] / traced_time if traced_time > 0 else float("nan")
+
+    return summary_df[columns].reset_index(drop=True)
+
+
+def finish_tracing(trace_dir: Optional[Union[str, Path]] = None) -> Optional[pd.DataFrame]:
+    """Exports the Chrome trace and the summary table (trace_summary.csv) of a traced run and logs the summary."""
+    trace_dir = trace_dir or _tracer.trace_dir
+    if trace_dir is None:
+        return None
+
+    export_chrome_trace(trace_dir)
+    summary_df = summarize_trace(trace_dir)
+    summary_df.to_csv(Path(trace_dir) / "trace_summary.csv", index=False)
+    logger.info(f"Trace summary:\n{summary_df.round(3).to_string(index=False)}")
+
+    return summary_df
+
+
+if os.environ.get(TRACE_DIR_ENV):
+    _tracer.enable(os.environ[TRACE_DIR_ENV])
+
+# spans are written when the process exits; multiprocessing workers exit through their own finalizers instead
+atexit.register(_tracer.save)
+Finalize(None, _tracer.save, exitpriority=10)
+
+# forked workers start without the spans of their parent
+os.register_at_fork(after_in_child=_tracer.reset)
@@ -6,18 +6,15 @@ import os
 import random
 import time
 import torch
-import wandb
-import yaml
 import sys
 
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
-from typing import Optional, Callable
+from typing import Optional, Callable, TYPE_CHECKING
 from datetime import datetime
 
 from torch.utils.data import Dataset
-from transformers import AutoTokenizer
 
 # Add paths to sys.path if not already present
 project_root = Path(__file__).resolve().parents[2]
@@ -29,6 +26,11 @@ submodule_path = project_root / "deep-anytime-testing"
 if str(submodule_path) not in sys.path:
     sys.path.append(str(submodule_path))
 
+from src.utils.tracing import get_tracer
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
 logger = logging.getLogger(__name__)
 
 terminator = {"llama3": "<|eot_id|>", "mistral": "</s>", "gemma": "<end_of_turn>"}
@@ -69,20 +71,36 @@ def log_scores(scores, prefix="tox"):
         json.dump(data, f)
 
     # Log the JSON file to WandB
+    import wandb
+
     wandb.save(filename)
 
 
 @contextmanager
-def time_block(label):
+def time_block(label, span: Optional[str] = None, category: str = "audit", **attributes):
+    """
+    Logs the duration of the block and records it as a span of the tracer (see src.utils.tracing) if tracing is
+    enabled.
+
+    Args:
+        label: log message
+        span: name of the span, defaults to label; labels that contain e.g. the sequence number should give a fixed
+            name here and pass the number as an attribute, so that the trace summary groups the spans
+        category: category of the span
+        **attributes: attributes of the span, e.g. fold, sequence or batch size
+    """
     start = time.time()
     try:
-        yield
+        with get_tracer().span(span or label, category, **attributes):
+            yield
     finally:
         end = time.time()
         logger.info(f"{label}: {round(end - start, 3)} seconds")
 
 
 def load_config(config_path):
+    import yaml
+
     with open(config_path) as file:
         config = yaml.safe_load(file)
     return config
@@ -210,7 +228,7 @@ class NestedKeyDataset(Dataset):
         key2: str,
         model_id: str,
         format_func: Callable,
-        tokenizer: AutoTokenizer,
+        tokenizer: "AutoTokenizer",
     ):
         self.dataset = dataset
         self.key1 = key1
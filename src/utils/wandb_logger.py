@@ -0,0 +1,115 @@
+import logging
+import queue
+import sys
+import threading
+
+from pathlib import Path
+from typing import Optional, Dict
+
+# Add paths to sys.path if not already present
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the queue for the background thread
+_STOP = object()
+
+
+class BufferedWandbLogger:
+    """
+    Logs to wandb without blocking the training loop. All values logged for the same step (e.g. sequence, epoch and
+    total epoch of the trainer) are merged into one record, and records are passed to wandb.log by a background
+    thread.
+
+    Per-epoch records are downsampled: only every epoch_log_interval-th step is logged, with the mean of the values of
+    the steps in between. flush (at the end of a sequence) logs the current step regardless, so that sequence-level
+    values such as the wealth are never dropped, and close (at the end of a fold) waits until wandb has all records.
+
+    Args:
+        epoch_log_interval: log every n-th step; 1 logs every step
+        max_queue_size: the training loop blocks once this many records wait for wandb
+    """
+
+    def __init__(self, epoch_log_interval: int = 1, max_queue_size: int = 10000):
+        self.epoch_log_interval = max(1, epoch_log_interval)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.step_key = None
+        self.step_fields = {}
+        self.values = {}
+        self.num_steps = 0
+
+        # sums and counts of the values of the steps that were not logged since the last logged step
+        self.skipped_sums = {}
+        self.skipped_counts = {}
+
+        self.thread = threading.Thread(target=self.consume, name="wandb-logger", daemon=True)
+        self.thread.start()
+
+    def consume(self):
+        """Passes the queued records to wandb, one wandb.log call per record."""
+        import wandb
+
+        while True:
+            record = self.queue.get()
+            try:
+                if record is _STOP:
+                    return
+                wandb.log(record)
+            except Exception as e:
+                logger.warning(f"Could not log to wandb: {e}")
+            finally:
+                self.queue.task_done()
+
+    def log(self, values: Dict, step_fields: Dict):
+        """
+        Adds values to the record of a step. step_fields (e.g. sequence and epoch) identify the step and are logged
+        with it; values of a new step complete the record of the previous one.
+        """
+        step_key = tuple(step_fields.items())
+        if self.step_key is not None and step_key != self.step_key:
+            self.end_step()
+
+        self.step_key = step_key
+        self.step_fields = dict(step_fields)
+        self.values.update(values)
+
+    def end_step(self, force: bool = False):
+        """Logs the record of the current step if it is due (or forced), otherwise keeps it for the next mean."""
+        if self.step_key is None:
+            return
+
+        self.num_steps += 1
+        if force or self.num_steps % self.epoch_log_interval == 0:
+            record = {**self.get_means(), **self.step_fields}
+            self.skipped_sums, self.skipped_counts = {}, {}
+            self.queue.put(record)
+        else:
+            for key, value in self.values.items():
+                if isinstance(value, (int, float)):
+                    self.skipped_sums[key] = self.skipped_sums.get(key, 0) + value
+                    self.skipped_counts[key] = self.skipped_counts.get(key, 0) + 1
+
+        self.step_key, self.step_fields, self.values = None, {}, {}
+
+    def get_means(self) -> Dict:
+        """Values of the current step, averaged with those of the skipped steps."""
+        means = {key: self.skipped_sums[key] / self.skipped_counts[key] for key in self.skipped_sums}
+        for key, value in self.values.items():
+            if key in self.skipped_sums and isinstance(value, (int, float)):
+                means[key] = (self.skipped_sums[key] + value) / (self.skipped_counts[key] + 1)
+            else:
+                means[key] = value
+        return means
+
+    def flush(self):
+        """Logs the current step, e.g. at the end of a sequence."""
+        self.end_step(force=True)
+
+    def close(self, timeout: Optional[float] = None):
+        """Logs the current step and waits until all records were passed to wandb, e.g. at the end of a fold."""
+        self.flush()
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
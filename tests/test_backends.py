@@ -0,0 +1,157 @@
+import asyncio
+import pytest
+import sys
+import threading
+
+from aiohttp import web
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parents[1]
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from src.evaluation.backends import GenerationRequestError, OpenAICompatibleBackend
+
+
+class StandInServer:
+    """OpenAI-compatible stand-in on localhost that echoes the prompt and can fail requests on demand."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.seeds = []
+        self.attempts = {}
+        # prompt -> list of status codes returned on the first attempts for this prompt
+        self.failures = {}
+        self.delay = 0.01
+
+    async def handle(self, request):
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"] if "messages" in payload else payload["prompt"]
+        self.attempts[prompt] = self.attempts.get(prompt, 0) + 1
+        self.seeds.append(payload.get("seed"))
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # later prompts answer faster, so results arrive out of order
+            await asyncio.sleep(self.delay / (1 + int(prompt.split("-")[-1])))
+        finally:
+            self.in_flight -= 1
+
+        failures = self.failures.get(prompt, [])
+        if self.attempts[prompt] <= len(failures):
+            return web.json_response({"error": "failed"}, status=failures[self.attempts[prompt] - 1])
+
+        if "messages" in payload:
+            return web.json_response({"choices": [{"message": {"content": f"re: {prompt}"}}]})
+        return web.json_response({"choices": [{"text": f"re: {prompt}"}]})
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", stand_in.handle)
+    app.router.add_post("/v1/completions", stand_in.handle)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    stand_in.api_base = f"http://127.0.0.1:{port}/v1"
+    yield stand_in
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def make_backend(server, endpoint="chat", **kwargs):
+    return OpenAICompatibleBackend(
+        server.api_base, "stand-in", endpoint=endpoint, api_key="", backoff=0.01, max_backoff=0.05, **kwargs
+    )
+
+
+@pytest.mark.parametrize("endpoint", ["chat", "completions"])
+def test_results_are_in_order_across_chunks(server, endpoint):
+    prompts = [f"prompt-{i}" for i in range(50)]
+    backend = make_backend(server, endpoint=endpoint, max_concurrency=4)
+    try:
+        # chunks of 4 * max_concurrency = 16 prompts
+        continuations = list(backend.generate(prompts, {"max_new_tokens": 5}, batch_size=1))
+    finally:
+        backend.close()
+
+    assert continuations == [f"re: {prompt}" for prompt in prompts]
+
+
+def test_concurrency_is_bounded(server):
+    server.delay = 0.05
+    prompts = [f"prompt-{i}" for i in range(40)]
+    backend = make_backend(server, max_concurrency=3)
+    try:
+        list(backend.generate(prompts, {}))
+    finally:
+        backend.close()
+
+    assert server.max_in_flight == 3
+
+
+def test_seed_is_passed_per_prompt(server):
+    prompts = [f"prompt-{i}" for i in range(20)]
+    backend = make_backend(server, max_concurrency=2)
+    try:
+        list(backend.generate(prompts, {}, seed=100))
+        seeds = sorted(server.seeds)
+        server.seeds = []
+        list(backend.generate(prompts[:3], {}))
+    finally:
+        backend.close()
+
+    assert seeds == list(range(100, 120))
+    assert server.seeds == [None, None, None]
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_on_rate_limits_and_server_errors(server, status):
+    prompts = [f"prompt-{i}" for i in range(6)]
+    server.failures = {"prompt-2": [status, status], "prompt-5": [status]}
+    backend = make_backend(server, max_concurrency=2, max_retries=3)
+    try:
+        continuations = list(backend.generate(prompts, {}))
+    finally:
+        backend.close()
+
+    assert continuations == [f"re: {prompt}" for prompt in prompts]
+    assert server.attempts["prompt-2"] == 3
+    assert server.attempts["prompt-5"] == 2
+
+
+def test_raises_after_retries_are_exhausted(server):
+    server.failures = {"prompt-1": [500, 500, 500]}
+    backend = make_backend(server, max_retries=3)
+    try:
+        with pytest.raises(GenerationRequestError):
+            list(backend.generate([f"prompt-{i}" for i in range(4)], {}))
+    finally:
+        backend.close()
+
+    assert server.attempts["prompt-1"] == 3
+
+
+def test_raises_on_non_retryable_status(server):
+    server.failures = {"prompt-0": [400]}
+    backend = make_backend(server, max_retries=3)
+    try:
+        with pytest.raises(GenerationRequestError):
+            list(backend.generate(["prompt-0"], {}))
+    finally:
+        backend.close()
+
+    assert server.attempts["prompt-0"] == 1